@@ -1,62 +1,332 @@
 #!/usr/bin/python3
 #-*- encoding: Utf-8 -*-
-from numpy import fft, array as nparray, maximum, log, hanning, mean, abs, round
-from typing import Dict, List, Set, Sequence, Union, Optional, Any
+from numpy import fft, array as nparray, maximum, log, hanning, mean, abs, round, concatenate, zeros, full, searchsorted, arange, sqrt, int16, int32, float64, ndarray, frombuffer
+from numpy.lib.stride_tricks import sliding_window_view
+from typing import Dict, List, Set, Sequence, Union, Optional, Any, Iterable, Iterator
 from struct import pack, unpack
 from enum import IntEnum
-from copy import copy
+from array import array
+from math import ceil
+from bisect import bisect_left
+from time import perf_counter
 
 HANNING_MATRIX = hanning(2050)[1:-1] # Wipe trailing and leading zeroes
 
+# Offsets of the bins of the FFT spread 49 passes earlier, and of the spread
+# FFTs (relative to the last one), that a peak has to be greater than
+
+PEAK_FREQUENCY_NEIGHBOR_OFFSETS = [*range(-10, -3, 3), -3, 1, *range(2, 9, 3)]
+PEAK_TIME_NEIGHBOR_OFFSETS = [-53, -45, *range(165, 201, 7), *range(214, 250, 7)]
+
+# Lower bounds of FrequencyBand._250_520 to FrequencyBand._3500_5500 (the
+# latter being bounded by 5500 Hz, included)
+
+FREQUENCY_BAND_LOWER_BOUNDS_HZ = [250, 520, 1450, 3500]
+
+# Every bin of the FFT of a frame whose windowed samples have a L1 norm
+# below sqrt(2 ** 17 / 64) has a magnitude below the 1 / 64 peak threshold
+# (with some margin for rounding errors), so that the frame can not yield
+# nor hide any peak
+
+SILENT_FRAME_MAX_L1_NORM = sqrt(2 ** 17 / 64) * 0.99
+
 
 from signature_format import DecodedMessage, FrequencyPeak, RawSignatureHeader, FrequencyBand
+from resampling import PolyphaseResampler
+
 
+"""
+    Obtain a NumPy view over signed 16-bit mono PCM samples, without copying
+    them when they are passed as a buffer (bytes, memoryview, array('h') or
+    int16 NumPy array). Other sequences of integers are converted.
+"""
 
-class RingBuffer(list):
+def as_s16le_mono_samples(s16le_mono_samples : Union[bytes, bytearray, memoryview, array, nparray, List[int]]) -> nparray:
     
-    def __init__(self, buffer_size : int, default_value : Any = None):
+    if isinstance(s16le_mono_samples, ndarray):
+        return s16le_mono_samples.astype(int16, copy = False)
+    
+    if isinstance(s16le_mono_samples, (bytes, bytearray, memoryview)):
+        return frombuffer(s16le_mono_samples, dtype = '<i2')
+    
+    if isinstance(s16le_mono_samples, array):
+        assert s16le_mono_samples.itemsize == 2
         
-        if default_value is not None:
-            list.__init__(self, [copy(default_value) for position in range(buffer_size)])
-        else:
-            list.__init__(self, [None] * buffer_size)
+        return frombuffer(s16le_mono_samples, dtype = int16)
+    
+    return nparray(s16le_mono_samples, dtype = int16)
+
+
+"""
+    Fixed-size circular buffer of values (or of rows of values), stored in
+    a preallocated NumPy array that is written in place.
+"""
+
+class RingBuffer:
+    
+    def __init__(self, buffer_size : int, row_size : Optional[int] = None, dtype : Any = float64):
+        
+        self.buffer : nparray = zeros((buffer_size,) if row_size is None else (buffer_size, row_size), dtype = dtype)
         
         self.position : int = 0
         self.buffer_size : int = buffer_size
         self.num_written : int = 0
     
+    def __getitem__(self, index : Any) -> Any:
+        
+        return self.buffer[index]
+    
+    def __setitem__(self, index : Any, value : Any):
+        
+        self.buffer[index] = value
+    
+    def __len__(self) -> int:
+        
+        return self.buffer_size
+    
     def append(self, value : Any):
         
-        self[self.position] = value
+        self.buffer[self.position] = value
+        
+        self.advance()
+    
+    """
+        Return the slot (a view, to be written in place) that will be filled
+        by the next call to self.advance().
+    """
+    
+    def get_next_slot(self) -> nparray:
+        
+        return self.buffer[self.position]
+    
+    def advance(self, num_values : int = 1):
         
-        self.position += 1
+        self.position += num_values
         self.position %= self.buffer_size
-        self.num_written += 1
+        self.num_written += num_values
+    
+    """
+        Append a sequence of values at once, wrapping around the end of the
+        buffer (only the last self.buffer_size ones are actually kept).
+    """
+    
+    def write(self, values : nparray):
         
-class SignatureGenerator:
+        kept_values : nparray = values[-self.buffer_size:]
+        
+        first_kept_position : int = self.position + len(values) - len(kept_values)
+        
+        self.buffer[(first_kept_position + arange(len(kept_values))) % self.buffer_size] = kept_values
+        
+        self.advance(len(values))
+    
+    def in_chronological_order(self) -> nparray:
+        
+        return concatenate([self.buffer[self.position:], self.buffer[:self.position]])
+    
+    def reset(self):
+        
+        self.buffer.fill(0)
+        
+        self.position = 0
+        self.num_written = 0
+        
+"""
+    Frequency peaks computed continuously over a whole input (without the
+    state of the generator being reset between signatures), from which any
+    number of possibly overlapping signatures can be cut.
+    
+    FFT pass numbers are counted from the first sample of the stream.
+"""
+
+class PeakStream:
+    
+    def __init__(self, first_sample : int, sample_rate_hz : int = 16000):
+        
+        self.first_sample : int = first_sample # Position of the first sample of the stream in the generator input
+        self.sample_rate_hz : int = sample_rate_hz
+        self.number_samples : int = 0 # Number of samples processed so far
+        
+        self.frequency_band_to_sound_peaks : Dict[FrequencyBand, List[FrequencyPeak]] = {}
+        self.frequency_band_to_fft_pass_numbers : Dict[FrequencyBand, List[int]] = {} # Kept in parallel, for bisecting
+    
+    def add_peak(self, frequency_band : FrequencyBand, frequency_peak : FrequencyPeak):
+        
+        if frequency_band not in self.frequency_band_to_sound_peaks:
+            self.frequency_band_to_sound_peaks[frequency_band] = []
+            self.frequency_band_to_fft_pass_numbers[frequency_band] = []
+        
+        self.frequency_band_to_sound_peaks[frequency_band].append(frequency_peak)
+        self.frequency_band_to_fft_pass_numbers[frequency_band].append(frequency_peak.fft_pass_number)
+    
+    def count_peaks(self, first_fft_pass : int, end_fft_pass : int) -> int:
+        
+        return sum(
+            bisect_left(fft_pass_numbers, end_fft_pass) - bisect_left(fft_pass_numbers, first_fft_pass)
+            for fft_pass_numbers in self.frequency_band_to_fft_pass_numbers.values()
+        )
+    
+    """
+        Build a signature out of the peaks of the FFT passes from
+        first_fft_pass (included) to end_fft_pass (excluded).
+    """
+    
+    def cut_signature(self, first_fft_pass : int, end_fft_pass : int) -> DecodedMessage:
+        
+        signature = DecodedMessage()
+        signature.sample_rate_hz = self.sample_rate_hz
+        signature.number_samples = (end_fft_pass - first_fft_pass) * 128
+        signature.frequency_band_to_sound_peaks = {}
+        
+        for frequency_band, fft_pass_numbers in self.frequency_band_to_fft_pass_numbers.items():
+            
+            frequency_peaks : List[FrequencyPeak] = self.frequency_band_to_sound_peaks[frequency_band][
+                bisect_left(fft_pass_numbers, first_fft_pass):bisect_left(fft_pass_numbers, end_fft_pass)
+            ]
+            
+            if frequency_peaks:
+                signature.frequency_band_to_sound_peaks[frequency_band] = [
+                    FrequencyPeak(frequency_peak.fft_pass_number - first_fft_pass, frequency_peak.peak_magnitude,
+                        frequency_peak.corrected_peak_frequency_bin, frequency_peak.sample_rate_hz)
+                    for frequency_peak in frequency_peaks
+                ]
+        
+        return signature
+    
+    def drop_peaks_before(self, fft_pass : int):
+        
+        for frequency_band, fft_pass_numbers in self.frequency_band_to_fft_pass_numbers.items():
+            
+            num_peaks_to_drop : int = bisect_left(fft_pass_numbers, fft_pass)
+            
+            del fft_pass_numbers[:num_peaks_to_drop]
+            del self.frequency_band_to_sound_peaks[frequency_band][:num_peaks_to_drop]
+
+"""
+    Cumulative profiling data of a SignatureGenerator, collected once
+    SignatureGenerator.enable_stats() has been called: time spent in and
+    number of calls to each processing stage, number of 128-sample hops
+    processed and number of peaks emitted per frequency band.
+"""
+
+class SignatureGeneratorStats:
     
     def __init__(self):
         
+        self.stage_seconds : Dict[str, float] = {}
+        self.stage_calls : Dict[str, int] = {}
+        
+        self.hops_processed : int = 0
+        self.frequency_band_to_num_peaks : Dict[FrequencyBand, int] = {}
+    
+    def add_stage_call(self, stage_name : str, seconds : float):
+        
+        self.stage_seconds[stage_name] = self.stage_seconds.get(stage_name, 0) + seconds
+        self.stage_calls[stage_name] = self.stage_calls.get(stage_name, 0) + 1
+    
+    def add_peaks(self, frequency_band : FrequencyBand, num_peaks : int):
+        
+        self.frequency_band_to_num_peaks[frequency_band] = self.frequency_band_to_num_peaks.get(frequency_band, 0) + num_peaks
+    
+    """
+        JSON-serializable representation, for logging or exporting.
+    """
+    
+    def to_dict(self) -> Dict[str, Any]:
+        
+        return {
+            'stage_seconds': dict(self.stage_seconds),
+            'stage_calls': dict(self.stage_calls),
+            'hops_processed': self.hops_processed,
+            'peaks_per_band': {frequency_band.name.strip('_'): num_peaks
+                for frequency_band, num_peaks in sorted(self.frequency_band_to_num_peaks.items())}
+        }
+
+class SignatureGenerator:
+    
+    """
+        Passing "dtype = float32" selects a reduced-precision mode, in which
+        the FFT, spreading and peak recognition stages work over single
+        precision floats (halving their memory bandwidth). Peaks may then
+        slightly differ from the ones obtained in the default double precision
+        mode (see "utils/compare_fingerprint_precisions.py").
+    """
+    
+    def __init__(self, dtype : Any = float64):
+        
+        self.dtype : Any = dtype
+        self.hanning_matrix : nparray = HANNING_MATRIX.astype(dtype)
+        
         # Used when storing input that will be processed when requiring to
         # generate a signature:
         
-        self.input_pending_processing : List[int] = [] # Signed 16-bits, 16 KHz mono samples to be processed
+        self.input_pending_processing : nparray = zeros(0, dtype = int16) # Signed 16-bits, 16 KHz mono samples to be processed
+        
+        self.input_buffer : nparray = self.input_pending_processing # Storage of "self.input_pending_processing", grown geometrically so that input fed in many chunks is not copied again for every chunk
         
         self.samples_processed : int = 0 # Number of samples processed out of "self.input_pending_processing"
         
+        self.samples_dropped : int = 0 # Number of processed samples released from the beginning of "self.input_pending_processing" (in streaming mode)
+        
+        self.resampler : Optional[PolyphaseResampler] = None # Converts input that is not 16 KHz mono, while more of it is expected
+        
         # Used when processing input:
         
-        self.ring_buffer_of_samples : RingBuffer[int] = RingBuffer(buffer_size = 2048, default_value = 0)
+        self.ring_buffer_of_samples : RingBuffer = RingBuffer(buffer_size = 2048, dtype = int16)
+        
+        self.fft_outputs : RingBuffer = RingBuffer(buffer_size = 256, row_size = 1025, dtype = dtype) # Rows of 1025 floats, premultiplied with a Hanning function before being passed through FFT, computed from the ring buffer every new 128 samples
         
-        self.fft_outputs : RingBuffer[List[float]] = RingBuffer(buffer_size = 256, default_value = [0. * 1025]) # Lists of 1025 floats, premultiplied with a Hanning function before being passed through FFT, computed from the ring buffer every new 128 samples
+        self.spread_ffts_output : RingBuffer = RingBuffer(buffer_size = 256, row_size = 1025, dtype = dtype)
         
-        self.spread_ffts_output : RingBuffer[List[float]] = RingBuffer(buffer_size = 256, default_value = [0] * 1025)
+        self.silent_fft_outputs : RingBuffer = RingBuffer(buffer_size = 256, dtype = bool) # Whether the FFT of the same slot of self.fft_outputs was skipped for being silent
+        
+        self.hanning_maxima_per_hop : nparray = abs(HANNING_MATRIX).reshape(16, 128).max(axis = 1)
 
         # How much data to send to Shazam at once?
 
         self.MAX_TIME_SECONDS = 3.1
         self.MAX_PEAKS = 255
         
+        # Minimal number of 128-sample hops to compute FFTs for at once
+        
+        self.FFT_BATCH_MIN_HOPS = 32
+        
+        # Skip the FFT and peak recognition of frames that are too quiet to
+        # contain any peak (see SILENT_FRAME_MAX_L1_NORM), such as padding
+        # or gaps between loops. This does not change the signatures.
+        
+        self.SKIP_SILENT_FRAMES = True
+        
+        # In streaming mode, samples are released as soon as they have been
+        # processed, so that memory usage does not grow with the input length
+        # (self.samples_processed may then not be moved backwards)
+        
+        self.STREAMING_MODE = False
+        
+        # In rolling window mode, the spectrogram and peaks are computed once
+        # over the whole input (see self.peak_stream), and signatures are cut
+        # from the shared peaks. Windows start ROLLING_WINDOW_STEP_SECONDS
+        # after each other (possibly overlapping), or where the previous one
+        # ended if None. In the former case, windows that would be cut
+        # shorter than ROLLING_WINDOW_MIN_SECONDS by the end of the input,
+        # or that would end where the previous one did, are not cut (except
+        # for the first one).
+        
+        self.ROLLING_WINDOW_MODE = False
+        self.ROLLING_WINDOW_STEP_SECONDS : Optional[float] = None
+        self.ROLLING_WINDOW_MIN_SECONDS : float = 1
+        
+        self.peak_stream : Optional[PeakStream] = None
+        self.rolling_window_first_fft_pass : int = 0 # FFT pass number within self.peak_stream where the next window starts
+        self.rolling_window_last_end_fft_pass : int = 0 # FFT pass number within self.peak_stream where the previous window ended
+        
+        self.last_signature_offset : Optional[int] = None # Position, in the input, of the first sample of the last signature returned (or skipped) by self.get_next_signature()
+        
+        # Profiling data, only collected after self.enable_stats() has
+        # been called
+        
+        self.stats : Optional[SignatureGeneratorStats] = None
+        
         # The object that will hold information about the next fingerpring
         # to be produced
         
@@ -65,15 +335,148 @@ class SignatureGenerator:
         self.next_signature.number_samples = 0
         self.next_signature.frequency_band_to_sound_peaks = {}
     
+    """
+        Start collecting profiling data into self.stats (returned). The
+        processing stages are then wrapped with timing code on this
+        instance only, so that generators without stats enabled run
+        exactly as before.
+    """
+    
+    def enable_stats(self) -> SignatureGeneratorStats:
+        
+        if self.stats is not None:
+            return self.stats
+        
+        self.stats = SignatureGeneratorStats()
+        
+        for stage_name in ['do_fft', 'do_fft_batch', 'do_peak_spreading', 'do_peak_recognition']:
+            
+            setattr(self, stage_name, self.make_timed_stage(stage_name, getattr(self, stage_name)))
+        
+        return self.stats
+    
+    def make_timed_stage(self, stage_name : str, stage_method : Any) -> Any:
+        
+        stats : SignatureGeneratorStats = self.stats
+        
+        def timed_stage(*args, **kwargs):
+            
+            if stage_name == 'do_peak_recognition':
+                frequency_band_to_sound_peaks = (self.peak_stream if self.ROLLING_WINDOW_MODE else self.next_signature).frequency_band_to_sound_peaks
+                num_peaks_before : Dict[FrequencyBand, int] = {frequency_band: len(peaks) for frequency_band, peaks in frequency_band_to_sound_peaks.items()}
+            
+            start_time : float = perf_counter()
+            
+            try:
+                return stage_method(*args, **kwargs)
+            
+            finally:
+                stats.add_stage_call(stage_name, perf_counter() - start_time)
+                
+                if stage_name == 'do_peak_spreading':
+                    stats.hops_processed += 1 # Peaks are spread once per hop
+                
+                elif stage_name == 'do_peak_recognition':
+                    for frequency_band, peaks in frequency_band_to_sound_peaks.items():
+                        if len(peaks) != num_peaks_before.get(frequency_band, 0):
+                            stats.add_peaks(frequency_band, len(peaks) - num_peaks_before.get(frequency_band, 0))
+        
+        return timed_stage
+    
     """
         Add data to be generated a signature for, which will be
         processed when self.get_next_signature() is called. This
-        function expects signed 16-bit 16 KHz mono PCM samples.
+        function expects signed 16-bit PCM samples, 16 KHz mono by
+        default.
+        
+        Buffers (bytes, memoryview, array('h') as returned by pydub or
+        int16 NumPy arrays) are kept as NumPy views without being copied,
+        as long as no other samples are pending processing.
+        
+        Samples at another rate of the SampleRate enum, or with several
+        (interleaved) channels, are downmixed and resampled to 16 KHz mono
+        first. Pass "end_of_input = False" when feeding such input in
+        several chunks, so that the resampler state is kept in between
+        (its last samples are then only output once a chunk with
+        "end_of_input = True" is fed).
+    """
+    
+    def feed_input(self, s16le_mono_samples : Union[bytes, bytearray, memoryview, array, nparray, List[int]],
+        sample_rate_hz : int = 16000, num_channels : int = 1, end_of_input : bool = True):
+        
+        new_samples : nparray = as_s16le_mono_samples(s16le_mono_samples)
+        
+        if (sample_rate_hz, num_channels) != (16000, 1) or self.resampler:
+            new_samples = self.resample_input(new_samples, sample_rate_hz, num_channels, end_of_input)
+        
+        if self.STREAMING_MODE:
+            self.drop_processed_input()
+        
+        num_pending_samples : int = len(self.input_pending_processing)
+        
+        if not num_pending_samples:
+            self.input_buffer = self.input_pending_processing = new_samples
+            return
+        
+        # The buffer of the first chunk belongs to the caller: it is never
+        # written to, as it is exactly full
+        
+        if num_pending_samples + len(new_samples) > len(self.input_buffer):
+            
+            self.input_buffer = zeros(max(num_pending_samples + len(new_samples), 2 * len(self.input_buffer)), dtype = int16)
+            self.input_buffer[:num_pending_samples] = self.input_pending_processing
+        
+        self.input_buffer[num_pending_samples:num_pending_samples + len(new_samples)] = new_samples
+        self.input_pending_processing = self.input_buffer[:num_pending_samples + len(new_samples)]
+    
+    def resample_input(self, s16le_samples : nparray, sample_rate_hz : int, num_channels : int, end_of_input : bool) -> nparray:
+        
+        resampled_samples : List[nparray] = []
+        
+        # Terminate the previous input if its format changed
+        
+        if self.resampler and (self.resampler.input_sample_rate_hz, self.resampler.num_channels) != (sample_rate_hz, num_channels):
+            
+            resampled_samples.append(self.resampler.flush())
+            self.resampler = None
+        
+        if (sample_rate_hz, num_channels) == (16000, 1):
+            resampled_samples.append(s16le_samples)
+        
+        else:
+            if not self.resampler:
+                self.resampler = PolyphaseResampler(sample_rate_hz, num_channels)
+            
+            resampled_samples.append(self.resampler.resample(s16le_samples))
+            
+            if end_of_input:
+                resampled_samples.append(self.resampler.flush())
+                self.resampler = None
+        
+        return concatenate(resampled_samples)
+    
+    """
+        Release the samples of self.input_pending_processing that have
+        already been processed (only the remaining ones are copied).
+    """
+    
+    def drop_processed_input(self):
+        
+        num_samples_to_drop : int = min(self.samples_processed - self.samples_dropped, len(self.input_pending_processing))
+        
+        if num_samples_to_drop > 0:
+            
+            self.input_buffer = self.input_pending_processing = self.input_pending_processing[num_samples_to_drop:].copy()
+            self.samples_dropped += num_samples_to_drop
+    
+    """
+        Number of samples fed to self.feed_input() that were not processed
+        yet.
     """
     
-    def feed_input(self, s16le_mono_samples : List[int]):
+    def get_num_pending_samples(self) -> int:
         
-        self.input_pending_processing += s16le_mono_samples
+        return self.samples_dropped + len(self.input_pending_processing) - self.samples_processed
     
     """
         Consume some of the samples fed to self.feed_input(), and return
@@ -86,17 +489,182 @@ class SignatureGenerator:
     
     def get_next_signature(self) -> Optional[DecodedMessage]:
         
-        if len(self.input_pending_processing) - self.samples_processed < 128:
+        signature_offset : int = self.get_next_signature_offset()
+        
+        if self.ROLLING_WINDOW_MODE:
+            
+            returned_signature : Optional[DecodedMessage] = self.get_next_rolling_signature()
+            
+            if returned_signature is not None:
+                self.last_signature_offset = signature_offset
+            
+            return returned_signature
+        
+        if self.get_num_pending_samples() < 128:
             return None
         
-        while (len(self.input_pending_processing) - self.samples_processed >= 128 and
-            (self.next_signature.number_samples / self.next_signature.sample_rate_hz < self.MAX_TIME_SECONDS or
-            sum(len(peaks) for peaks in self.next_signature.frequency_band_to_sound_peaks.values()) < self.MAX_PEAKS
-            )):
+        self.last_signature_offset = signature_offset
+        
+        self.process_pending_input()
+        
+        returned_signature = self.pop_next_signature()
+        
+        if self.STREAMING_MODE:
+            self.drop_processed_input()
+        
+        return returned_signature
+    
+    """
+        Take PCM chunks (in any of the formats accepted by self.feed_input())
+        from an iterable, such as a generator reading a stream, and yield
+        Shazam signatures as soon as they have gathered enough data. The
+        last, incomplete signature is yielded when the chunks are exhausted.
+        
+        Processed samples are released as the chunks are consumed, so that
+        memory usage stays constant regardless of the input length.
+        
+        In rolling window mode, the same windows as over the whole input
+        are yielded, each as soon as its peaks are known.
+    """
+    
+    def iter_signatures(self, s16le_mono_chunks : Iterable[Union[bytes, bytearray, memoryview, array, nparray, List[int]]],
+        sample_rate_hz : int = 16000, num_channels : int = 1) -> Iterator[DecodedMessage]:
+        
+        if self.ROLLING_WINDOW_MODE:
+            yield from self.iter_rolling_signatures(s16le_mono_chunks, sample_rate_hz, num_channels)
+            return
+        
+        for s16le_mono_chunk in s16le_mono_chunks:
+            
+            self.feed_input(s16le_mono_chunk, sample_rate_hz, num_channels, end_of_input = False)
+            
+            self.process_pending_input()
+            
+            while self.is_next_signature_complete():
+                
+                yield self.pop_next_signature()
+                
+                self.process_pending_input()
+            
+            self.drop_processed_input()
+        
+        if self.resampler:
+            self.feed_input(b'', sample_rate_hz, num_channels) # Output the last resampled samples
+        
+        if self.get_num_pending_samples() >= 128 or self.next_signature.number_samples:
+            
+            self.process_pending_input()
+            
+            yield self.pop_next_signature()
+            
+            self.drop_processed_input()
+    
+    """
+        Rolling window mode counterpart of self.iter_signatures(). The peaks
+        of the windows already yielded are released as the chunks are
+        consumed.
+    """
+    
+    def iter_rolling_signatures(self, s16le_mono_chunks : Iterable[Union[bytes, bytearray, memoryview, array, nparray, List[int]]],
+        sample_rate_hz : int = 16000, num_channels : int = 1) -> Iterator[DecodedMessage]:
+        
+        for s16le_mono_chunk in s16le_mono_chunks:
+            
+            self.feed_input(s16le_mono_chunk, sample_rate_hz, num_channels, end_of_input = False)
+            
+            while self.is_next_rolling_signature_complete():
+                
+                yield self.get_next_rolling_signature()
+                
+                self.peak_stream.drop_peaks_before(self.rolling_window_first_fft_pass)
+            
+            self.drop_processed_input()
+        
+        if self.resampler:
+            self.feed_input(b'', sample_rate_hz, num_channels) # Output the last resampled samples
+        
+        for signature in iter(self.get_next_rolling_signature, None):
+            
+            yield signature
+            
+            self.peak_stream.drop_peaks_before(self.rolling_window_first_fft_pass)
+        
+        self.drop_processed_input()
+    
+    """
+        Whether the next rolling window can be cut from the input fed so
+        far, and would not change if more input was fed (its end, where
+        both MAX_TIME_SECONDS and MAX_PEAKS are reached, is followed by the
+        46 FFT passes after which its peaks are known).
+    """
+    
+    def is_next_rolling_signature_complete(self) -> bool:
+        
+        first_fft_pass : int = self.rolling_window_first_fft_pass
+        end_fft_pass : int = first_fft_pass + ceil(self.MAX_TIME_SECONDS * 16000 / 128)
+        
+        self.update_peak_stream(end_fft_pass + 46)
+        
+        while (self.get_num_stream_fft_passes() >= end_fft_pass + 46 and
+            self.peak_stream.count_peaks(first_fft_pass, end_fft_pass) < self.MAX_PEAKS):
+            
+            end_fft_pass += 1
+            
+            self.update_peak_stream(end_fft_pass + 46)
+        
+        return self.get_num_stream_fft_passes() >= end_fft_pass + 46
+    
+    """
+        Process the pending samples, 128-sample hop by 128-sample hop, for
+        as long as the signature being built needs more data.
+    """
+    
+    def process_pending_input(self):
+        
+        while self.should_process_next_hop():
+            
+            # Compute the FFTs of all the hops we know will be needed to
+            # reach MAX_TIME_SECONDS at once, then of smaller blocks while
+            # we wait for MAX_PEAKS to be reached
+            
+            samples_until_max_time : float = self.MAX_TIME_SECONDS * self.next_signature.sample_rate_hz - self.next_signature.number_samples
             
-            self.process_input(self.input_pending_processing[self.samples_processed:self.samples_processed + 128])
+            num_hops : int = min(
+                self.get_num_pending_samples() // 128,
+                max(ceil(samples_until_max_time / 128), self.FFT_BATCH_MIN_HOPS)
+            )
             
-            self.samples_processed += 128
+            first_sample : int = self.samples_processed - self.samples_dropped
+            
+            samples : nparray = self.input_pending_processing[first_sample:first_sample + num_hops * 128]
+            
+            silent_frames : nparray = self.get_silent_frames(samples)
+            
+            fft_outputs_batch : nparray = self.do_fft_batch(samples, silent_frames)
+            
+            for fft_results, is_silent in zip(fft_outputs_batch, silent_frames.tolist()):
+                
+                # When stopping here, the signature is complete and the
+                # ring buffers will be reset by self.pop_next_signature()
+                
+                if not self.should_process_next_hop():
+                    break
+                
+                self.next_signature.number_samples += 128
+                
+                self.fft_outputs.append(fft_results)
+                self.silent_fft_outputs.append(is_silent)
+                
+                self.do_peak_spreading_and_recognition()
+                
+                self.samples_processed += 128
+    
+    """
+        Return the signature being built, and start a new one from a clean
+        state.
+    """
+    
+    def pop_next_signature(self) -> DecodedMessage:
 
         returned_signature = self.next_signature
 
@@ -105,160 +673,439 @@ class SignatureGenerator:
         self.next_signature.number_samples = 0
         self.next_signature.frequency_band_to_sound_peaks = {}
         
-        self.ring_buffer_of_samples : RingBuffer[int] = RingBuffer(buffer_size = 2048, default_value = 0)
-        self.fft_outputs : RingBuffer[List[float]] = RingBuffer(buffer_size = 256, default_value = [0. * 1025])
-        self.spread_ffts_output : RingBuffer[List[float]] = RingBuffer(buffer_size = 256, default_value = [0] * 1025)
+        self.ring_buffer_of_samples.reset()
+        self.fft_outputs.reset()
+        self.spread_ffts_output.reset()
+        self.silent_fft_outputs.reset()
         
         return returned_signature
+    
+    """
+        Whether the signature being built has reached both MAX_TIME_SECONDS
+        and MAX_PEAKS, and thus needs no more samples.
+    """
+    
+    def is_next_signature_complete(self) -> bool:
+        
+        return not (self.next_signature.number_samples / self.next_signature.sample_rate_hz < self.MAX_TIME_SECONDS or
+            sum(len(peaks) for peaks in self.next_signature.frequency_band_to_sound_peaks.values()) < self.MAX_PEAKS
+            )
+    
+    """
+        Whether the signature being built still needs more samples, and
+        there are enough samples left to process another 128-sample hop.
+    """
+    
+    def should_process_next_hop(self) -> bool:
+        
+        return self.get_num_pending_samples() >= 128 and not self.is_next_signature_complete()
 
     
+    """
+        Rolling window mode counterpart of self.get_next_signature(): cut a
+        signature, meeting the same MAX_TIME_SECONDS and MAX_PEAKS
+        requirements, from the shared peak stream.
+    """
+    
+    def get_next_rolling_signature(self) -> Optional[DecodedMessage]:
+        
+        first_fft_pass : int = self.rolling_window_first_fft_pass
+        min_fft_passes : int = ceil(self.MAX_TIME_SECONDS * 16000 / 128)
+        
+        # Peaks of a FFT pass are only known 46 passes later
+        
+        self.update_peak_stream(first_fft_pass + min_fft_passes + 46)
+        
+        if self.get_num_stream_fft_passes() - first_fft_pass < 1:
+            return None
+        
+        end_fft_pass : int = min(first_fft_pass + min_fft_passes, self.get_num_stream_fft_passes())
+        
+        # With overlapping windows, once a window has reached the end of
+        # the input, the next ones would only be shorter parts of it
+        
+        if self.ROLLING_WINDOW_STEP_SECONDS is not None and first_fft_pass > 0 and (
+            self.rolling_window_last_end_fft_pass >= self.get_num_stream_fft_passes() or
+            end_fft_pass - first_fft_pass < ceil(self.ROLLING_WINDOW_MIN_SECONDS * 16000 / 128)):
+            
+            return None
+        
+        while (end_fft_pass < self.get_num_stream_fft_passes() and
+            self.peak_stream.count_peaks(first_fft_pass, end_fft_pass) < self.MAX_PEAKS):
+            
+            end_fft_pass += 1
+            
+            self.update_peak_stream(end_fft_pass + 46)
+        
+        returned_signature : DecodedMessage = self.peak_stream.cut_signature(first_fft_pass, end_fft_pass)
+        
+        self.rolling_window_first_fft_pass += self.get_rolling_window_step(end_fft_pass - first_fft_pass)
+        self.rolling_window_last_end_fft_pass = end_fft_pass
+        
+        if self.STREAMING_MODE:
+            self.peak_stream.drop_peaks_before(self.rolling_window_first_fft_pass)
+            self.drop_processed_input()
+        
+        return returned_signature
+    
+    """
+        Number of FFT passes between the start of a rolling window of the
+        given length and the start of the next one.
+    """
+    
+    def get_rolling_window_step(self, num_fft_passes : int) -> int:
+        
+        if self.ROLLING_WINDOW_STEP_SECONDS is None:
+            return num_fft_passes
+        
+        return max(1, int(round(self.ROLLING_WINDOW_STEP_SECONDS * 16000 / 128)))
+    
+    """
+        Position, in the input fed to self.feed_input(), of the first sample
+        of the signature that the next call to self.get_next_signature()
+        would return.
+    """
+    
+    def get_next_signature_offset(self) -> int:
+        
+        if self.ROLLING_WINDOW_MODE:
+            
+            first_sample : int = self.peak_stream.first_sample if self.peak_stream else self.samples_processed
+            
+            return first_sample + self.rolling_window_first_fft_pass * 128
+        
+        return self.samples_processed
+    
+    """
+        Move past the signature that the next call to self.get_next_signature()
+        would return, when it is already known to span "number_samples"
+        samples (for example because it was obtained from a cache).
+    """
+    
+    def skip_next_signature(self, number_samples : int):
+        
+        self.last_signature_offset = self.get_next_signature_offset()
+        
+        if self.ROLLING_WINDOW_MODE:
+            
+            if self.peak_stream is None:
+                self.peak_stream = PeakStream(self.samples_processed)
+            
+            self.rolling_window_first_fft_pass += self.get_rolling_window_step(number_samples // 128)
+        
+        else:
+            
+            self.samples_processed += number_samples
+    
+    """
+        Cut a signature of the given length from the shared peak stream, at
+        the given offset from its beginning (which is where the input stood
+        when it was first computed). Both are rounded to 128-sample hops.
+        
+        Return None if there is no input at this offset.
+    """
+    
+    def get_signature_at(self, offset_seconds : float, duration_seconds : float) -> Optional[DecodedMessage]:
+        
+        first_fft_pass : int = int(round(offset_seconds * 16000 / 128))
+        end_fft_pass : int = first_fft_pass + ceil(duration_seconds * 16000 / 128)
+        
+        self.update_peak_stream(end_fft_pass + 46)
+        
+        end_fft_pass = min(end_fft_pass, self.get_num_stream_fft_passes())
+        
+        if end_fft_pass <= first_fft_pass:
+            return None
+        
+        return self.peak_stream.cut_signature(first_fft_pass, end_fft_pass)
+    
+    def get_num_stream_fft_passes(self) -> int:
+        
+        return self.peak_stream.number_samples // 128 if self.peak_stream else 0
+    
+    """
+        Extend the shared peak stream until it holds (at least) the given
+        number of FFT passes, or the pending input is exhausted. The state of
+        the generator is never reset in between.
+    """
+    
+    def update_peak_stream(self, num_fft_passes : int):
+        
+        if self.peak_stream is None:
+            self.peak_stream = PeakStream(self.samples_processed)
+        
+        while self.get_num_stream_fft_passes() < num_fft_passes and self.get_num_pending_samples() >= 128:
+            
+            num_hops : int = min(
+                self.get_num_pending_samples() // 128,
+                max(num_fft_passes - self.get_num_stream_fft_passes(), self.FFT_BATCH_MIN_HOPS)
+            )
+            
+            first_sample : int = self.samples_processed - self.samples_dropped
+            
+            samples : nparray = self.input_pending_processing[first_sample:first_sample + num_hops * 128]
+            
+            silent_frames : nparray = self.get_silent_frames(samples)
+            
+            for fft_results, is_silent in zip(self.do_fft_batch(samples, silent_frames), silent_frames.tolist()):
+                
+                self.peak_stream.number_samples += 128
+                
+                self.fft_outputs.append(fft_results)
+                self.silent_fft_outputs.append(is_silent)
+                
+                self.do_peak_spreading_and_recognition()
+                
+                self.samples_processed += 128
+    
     def process_input(self, s16le_mono_samples : List[int]):
     
         self.next_signature.number_samples += len(s16le_mono_samples)
         
-        for position_of_chunk in range(0, len(s16le_mono_samples), 128):
+        num_full_hops : int = len(s16le_mono_samples) // 128
+        
+        silent_frames : nparray = self.get_silent_frames(s16le_mono_samples[:num_full_hops * 128])
+        
+        for fft_results, is_silent in zip(self.do_fft_batch(s16le_mono_samples[:num_full_hops * 128], silent_frames), silent_frames.tolist()):
             
-            self.do_fft(s16le_mono_samples[position_of_chunk:position_of_chunk + 128])
+            self.fft_outputs.append(fft_results)
+            self.silent_fft_outputs.append(is_silent)
             
             self.do_peak_spreading_and_recognition()
         
-    def do_fft(self, batch_of_128_s16le_mono_samples):
+        if len(s16le_mono_samples) % 128:
+            
+            self.do_fft(s16le_mono_samples[num_full_hops * 128:])
+            
+            self.do_peak_spreading_and_recognition()
         
-        self.ring_buffer_of_samples[
-            self.ring_buffer_of_samples.position:
-            self.ring_buffer_of_samples.position + len(batch_of_128_s16le_mono_samples)
-        ] = batch_of_128_s16le_mono_samples
+    def do_fft(self, batch_of_128_s16le_mono_samples):
         
-        self.ring_buffer_of_samples.position += len(batch_of_128_s16le_mono_samples)
-        self.ring_buffer_of_samples.position %= 2048
-        self.ring_buffer_of_samples.num_written +=  len(batch_of_128_s16le_mono_samples)
+        self.ring_buffer_of_samples.write(nparray(batch_of_128_s16le_mono_samples, dtype = int16))
         
-        excerpt_from_ring_buffer : list = (
-            self.ring_buffer_of_samples[self.ring_buffer_of_samples.position:] +
-            self.ring_buffer_of_samples[:self.ring_buffer_of_samples.position]
-        )
+        excerpt_from_ring_buffer : nparray = self.ring_buffer_of_samples.in_chronological_order()
         
         # The premultiplication of the array is for applying a windowing function before the DFT (slighty rounded Hanning without zeros at edges)
         
-        fft_results : nparray = fft.rfft(HANNING_MATRIX * excerpt_from_ring_buffer)
+        fft_results : nparray = fft.rfft(self.hanning_matrix * excerpt_from_ring_buffer)
 
         assert len(fft_results) == 1025 and len(excerpt_from_ring_buffer) == 2048 == len(HANNING_MATRIX)
         
         fft_results = (fft_results.real ** 2 + fft_results.imag ** 2) / (1 << 17)
-        fft_results = maximum(fft_results, 0.0000000001)
+        maximum(fft_results, 0.0000000001, out = self.fft_outputs.get_next_slot())
+        
+        self.fft_outputs.advance()
+        self.silent_fft_outputs.append(False)
+    
+    """
+        Batched equivalent of self.do_fft(): frame all the passed samples
+        (a multiple of 128) at once as a strided view over the contents
+        of the ring buffer followed by the new samples, and run a single
+        2-D FFT over it.
+        
+        Returns one row of 1025 floats per 128-sample hop, identical to
+        what successive calls to self.do_fft() would have appended to
+        self.fft_outputs (the caller is responsible for appending them).
+        
+        The FFT of the frames flagged in "silent_frames" (as returned by
+        self.get_silent_frames()) is not computed, their rows being filled
+        with the floor value instead.
+    """
+    
+    def do_fft_batch(self, s16le_mono_samples : Sequence[int], silent_frames : Optional[nparray] = None) -> nparray:
+        
+        assert len(s16le_mono_samples) % 128 == 0
+        
+        s16le_mono_samples = as_s16le_mono_samples(s16le_mono_samples)
+        
+        samples_with_history : nparray = concatenate([self.ring_buffer_of_samples.in_chronological_order(), s16le_mono_samples])
+        
+        # Frame number N ends with the N-th new hop, and thus starts (N + 1) * 128
+        # samples after the beginning of the ring buffer excerpt
+        
+        frames : nparray = sliding_window_view(samples_with_history[128:], 2048)[::128]
+        
+        if silent_frames is not None and silent_frames.any():
+            
+            fft_results : nparray = full((len(frames), 1025), 0.0000000001, dtype = self.dtype)
+            
+            if not silent_frames.all():
+                fft_results[~silent_frames] = self.do_fft_of_frames(frames[~silent_frames])
+        
+        else:
+            fft_results : nparray = self.do_fft_of_frames(frames)
+        
+        # Keep the ring buffer in the same state as if self.do_fft() had been
+        # called for every hop
+        
+        self.ring_buffer_of_samples.write(s16le_mono_samples)
+        
+        return fft_results
+        
+    
+    def do_fft_of_frames(self, frames : nparray) -> nparray:
+        
+        fft_results : nparray = fft.rfft(self.hanning_matrix * frames, axis = 1)
+        
+        fft_results = (fft_results.real ** 2 + fft_results.imag ** 2) / (1 << 17)
+        
+        return maximum(fft_results, 0.0000000001)
+    
+    """
+        Flag the frames (one per 128-sample hop of the passed samples, as
+        framed by self.do_fft_batch()) that can not contain any peak.
+        
+        Their windowed L1 norm is bounded from the L1 norms of their 16 hops,
+        each weighted by the maximal value of the window over the hop, so
+        that the test costs much less than the FFT it avoids.
+    """
+    
+    def get_silent_frames(self, s16le_mono_samples : Sequence[int]) -> nparray:
+        
+        s16le_mono_samples = as_s16le_mono_samples(s16le_mono_samples)
+        
+        if not self.SKIP_SILENT_FRAMES:
+            return zeros(len(s16le_mono_samples) // 128, dtype = bool)
         
-        self.fft_outputs.append(fft_results)
+        samples_with_history : nparray = concatenate([self.ring_buffer_of_samples.in_chronological_order(), s16le_mono_samples])
         
+        l1_norms_per_hop : nparray = abs(samples_with_history.astype(int32)).reshape(-1, 128).sum(axis = 1)
+        
+        # Frame number N is made of the hops 1 + N to 16 + N of the excerpt
+        
+        max_l1_norms : nparray = sliding_window_view(l1_norms_per_hop[1:], 16) @ self.hanning_maxima_per_hop
+        
+        return max_l1_norms < SILENT_FRAME_MAX_L1_NORM
     
     def do_peak_spreading_and_recognition(self):
         
         self.do_peak_spreading()
         
-        if self.spread_ffts_output.num_written >= 46:
+        # Silent FFTs yield no peaks (their spreading still has to be done,
+        # as it propagates the values of the more recent FFTs)
+        
+        if self.spread_ffts_output.num_written >= 46 and not self.silent_fft_outputs[(self.silent_fft_outputs.position - 46) % self.silent_fft_outputs.buffer_size]:
             
             self.do_peak_recognition()
     
     def do_peak_spreading(self):
         
-        origin_last_fft : List[float] = self.fft_outputs[self.fft_outputs.position - 1]
+        origin_last_fft : nparray = self.fft_outputs[self.fft_outputs.position - 1]
         
-        spread_last_fft : List[float] = list(origin_last_fft)
+        # The spread FFT is written in place into the oldest slot of the ring
+        # buffer, which is not one of the former FFTs updated below
         
-        for position in range(1025):
-            
-            # Perform frequency-domain spreading of peak values
-            
-            if position < 1023:
-            
-                spread_last_fft[position] = max(spread_last_fft[position:position + 3])
+        spread_last_fft : nparray = self.spread_ffts_output.get_next_slot()
+        
+        # Perform frequency-domain spreading of peak values (sliding maximum
+        # over each bin and its two upper neighbors, the last two bins being
+        # left untouched)
+        
+        maximum(origin_last_fft[:1023], origin_last_fft[1:1024], out = spread_last_fft[:1023])
+        spread_last_fft[1023:] = origin_last_fft[1023:]
+        maximum(spread_last_fft[:1023], origin_last_fft[2:1025], out = spread_last_fft[:1023])
+        
+        # Perform time-domain spreading of peak values, each former FFT
+        # receiving the maximum of itself and of the value propagated to
+        # the more recent one
+        
+        max_values : nparray = spread_last_fft
+        
+        for former_fft_num in [-1, -3, -6]:
             
-            # Perform time-domain spreading of peak values
+            former_fft_output : nparray = self.spread_ffts_output[(self.spread_ffts_output.position + former_fft_num) % self.spread_ffts_output.buffer_size]
             
-            max_value = spread_last_fft[position]
+            maximum(former_fft_output, max_values, out = former_fft_output)
             
-            for former_fft_num in [-1, -3, -6]:
-                
-                former_fft_output = self.spread_ffts_output[(self.spread_ffts_output.position + former_fft_num) % self.spread_ffts_output.buffer_size]
-                
-                former_fft_output[position] = max_value = max(former_fft_output[position], max_value)
-                
-        # Save output locally
+            max_values = former_fft_output
         
-        self.spread_ffts_output.append(spread_last_fft)
+        # Save output locally
         
-        pass
+        self.spread_ffts_output.advance()
     
     def do_peak_recognition(self):
         
-        fft_minus_46 = self.fft_outputs[(self.fft_outputs.position - 46) % self.fft_outputs.buffer_size]
-        fft_minus_49 = self.spread_ffts_output[(self.spread_ffts_output.position - 49) % self.spread_ffts_output.buffer_size]
-        fft_minus_53 = self.spread_ffts_output[(self.spread_ffts_output.position - 53) % self.spread_ffts_output.buffer_size]
-        fft_minus_45 = self.spread_ffts_output[(self.spread_ffts_output.position - 45) % self.spread_ffts_output.buffer_size]
+        fft_minus_46 : nparray = self.fft_outputs[(self.fft_outputs.position - 46) % self.fft_outputs.buffer_size]
+        fft_minus_49 : nparray = self.spread_ffts_output[(self.spread_ffts_output.position - 49) % self.spread_ffts_output.buffer_size]
+        
+        # Evaluate the peak conditions for all the bins from 10 to 1014 at
+        # once, as boolean masks
+        
+        candidate_magnitudes : nparray = fft_minus_46[10:1015]
+        
+        # Ensure that the bin is large enough to be a peak
         
-        for bin_position in range(10, 1015):
+        is_peak : nparray = (candidate_magnitudes >= 1 / 64) & (candidate_magnitudes >= fft_minus_49[9:1014])
+        
+        # Ensure that it is frequency-domain local minimum
+        
+        max_neighbor_in_fft_minus_49 : nparray = zeros(1005, dtype = self.dtype)
+        
+        for neighbor_offset in PEAK_FREQUENCY_NEIGHBOR_OFFSETS:
             
-            # Ensure that the bin is large enough to be a peak
+            maximum(max_neighbor_in_fft_minus_49, fft_minus_49[10 + neighbor_offset:1015 + neighbor_offset], out = max_neighbor_in_fft_minus_49)
+        
+        is_peak &= candidate_magnitudes > max_neighbor_in_fft_minus_49
+        
+        # Ensure that it is a time-domain local minimum
+        
+        max_neighbor_in_other_adjacent_ffts : nparray = max_neighbor_in_fft_minus_49
+        
+        for other_offset in PEAK_TIME_NEIGHBOR_OFFSETS:
             
-            if (fft_minus_46[bin_position] >= 1 / 64 and
-                fft_minus_46[bin_position] >= fft_minus_49[bin_position - 1]):
-                
-                # Ensure that it is frequency-domain local minimum
-                
-                max_neighbor_in_fft_minus_49 = 0
-                
-                for neighbor_offset in [*range(-10, -3, 3), -3, 1, *range(2, 9, 3)]:
-                
-                    max_neighbor_in_fft_minus_49 = max(fft_minus_49[bin_position + neighbor_offset], max_neighbor_in_fft_minus_49)
-                
-                if fft_minus_46[bin_position] > max_neighbor_in_fft_minus_49:
-                    
-                    # Ensure that it is a time-domain local minimum
-                    
-                    max_neighbor_in_other_adjacent_ffts = max_neighbor_in_fft_minus_49
-                    
-                    for other_offset in [-53, -45, *range(165, 201, 7), *range(214, 250, 7)]:
-                    
-                        max_neighbor_in_other_adjacent_ffts = max(
-                            self.spread_ffts_output[(self.spread_ffts_output.position + other_offset) % self.spread_ffts_output.buffer_size][bin_position - 1],
-                            max_neighbor_in_other_adjacent_ffts
-                        )
-                    
-                    if fft_minus_46[bin_position] > max_neighbor_in_other_adjacent_ffts:
-                        
-                        # This is a peak, store the peak
-                        
-                        fft_number = self.spread_ffts_output.num_written - 46
-                        
-                        peak_magnitude = log(max(1 / 64, fft_minus_46[bin_position])) * 1477.3 + 6144
-                        peak_magnitude_before = log(max(1 / 64, fft_minus_46[bin_position - 1])) * 1477.3 + 6144
-                        peak_magnitude_after = log(max(1 / 64, fft_minus_46[bin_position + 1])) * 1477.3 + 6144
-                        
-                        peak_variation_1 = peak_magnitude * 2 - peak_magnitude_before - peak_magnitude_after
-                        peak_variation_2 = (peak_magnitude_after - peak_magnitude_before) * 32 / peak_variation_1
-                        
-                        corrected_peak_frequency_bin = bin_position * 64 + peak_variation_2
-                        
-                        assert peak_variation_1 > 0
-                        
-                        frequency_hz = corrected_peak_frequency_bin * (16000 / 2 / 1024 / 64)
-                        
-                        if frequency_hz < 250:
-                            continue
-                        elif frequency_hz < 520:
-                            band = FrequencyBand._250_520
-                        elif frequency_hz < 1450:
-                            band = FrequencyBand._520_1450
-                        elif frequency_hz < 3500:
-                            band = FrequencyBand._1450_3500
-                        elif frequency_hz <= 5500:
-                            band = FrequencyBand._3500_5500
-                        else:
-                            continue
-                        
-                        if band not in self.next_signature.frequency_band_to_sound_peaks:
-                            self.next_signature.frequency_band_to_sound_peaks[band] = []
-                        
-                        self.next_signature.frequency_band_to_sound_peaks[band].append(
-                            FrequencyPeak(fft_number, int(peak_magnitude), int(corrected_peak_frequency_bin), 16000)
-                        )
-                        
+            maximum(
+                max_neighbor_in_other_adjacent_ffts,
+                self.spread_ffts_output[(self.spread_ffts_output.position + other_offset) % self.spread_ffts_output.buffer_size][9:1014],
+                out = max_neighbor_in_other_adjacent_ffts
+            )
+        
+        is_peak &= candidate_magnitudes > max_neighbor_in_other_adjacent_ffts
+        
+        bin_positions : nparray = is_peak.nonzero()[0] + 10
+        
+        if not len(bin_positions):
+            return
+        
+        # These are peaks, interpolate their frequency and magnitude (always
+        # in double precision)
+        
+        fft_number = self.spread_ffts_output.num_written - 46
+        
+        peak_magnitudes : nparray = log(maximum(1 / 64, fft_minus_46[bin_positions].astype(float64))) * 1477.3 + 6144
+        peak_magnitudes_before : nparray = log(maximum(1 / 64, fft_minus_46[bin_positions - 1].astype(float64))) * 1477.3 + 6144
+        peak_magnitudes_after : nparray = log(maximum(1 / 64, fft_minus_46[bin_positions + 1].astype(float64))) * 1477.3 + 6144
+        
+        peak_variations_1 : nparray = peak_magnitudes * 2 - peak_magnitudes_before - peak_magnitudes_after
+        peak_variations_2 : nparray = (peak_magnitudes_after - peak_magnitudes_before) * 32 / peak_variations_1
+        
+        corrected_peak_frequency_bins : nparray = bin_positions * 64 + peak_variations_2
+        
+        assert (peak_variations_1 > 0).all()
+        
+        frequencies_hz : nparray = corrected_peak_frequency_bins * (16000 / 2 / 1024 / 64)
+        
+        # Classify the peaks into frequency bands, and store them (in the
+        # order of their bins)
+        
+        bands : nparray = searchsorted(FREQUENCY_BAND_LOWER_BOUNDS_HZ, frequencies_hz, side = 'right') - 1
+        
+        is_stored : nparray = (bands >= 0) & (frequencies_hz <= 5500)
+        
+        for band_id, peak_magnitude, corrected_peak_frequency_bin in zip(
+            bands[is_stored].tolist(),
+            peak_magnitudes[is_stored].astype(int).tolist(),
+            corrected_peak_frequency_bins[is_stored].astype(int).tolist()
+        ):
+            
+            band = FrequencyBand(band_id)
+            
+            frequency_peak = FrequencyPeak(fft_number, peak_magnitude, corrected_peak_frequency_bin, 16000)
+            
+            if self.ROLLING_WINDOW_MODE:
+                self.peak_stream.add_peak(band, frequency_peak)
+                continue
+            
+            if band not in self.next_signature.frequency_band_to_sound_peaks:
+                self.next_signature.frequency_band_to_sound_peaks[band] = []
+            
+            self.next_signature.frequency_band_to_sound_peaks[band].append(frequency_peak)
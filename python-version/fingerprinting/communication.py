@@ -7,7 +7,10 @@ from json import dumps
 from time import time
 from pytz import all_timezones
 
+import asyncio
+import logging
 import requests
+from requests.adapters import HTTPAdapter
 
 from signature_format import DecodedMessage
 from user_agent import USER_AGENTS
@@ -17,16 +20,26 @@ locale = (getlocale()[0] or 'en_US').split('.')[0]
 first_uuid = str(uuid5(NAMESPACE_DNS, str(getnode()))).upper()
 second_uuid = str(uuid5(NAMESPACE_URL, str(getnode())))
 
+SHAZAM_BASE_URL = 'https://amp.shazam.com'
 
-def recognize_song_from_signature(signature: DecodedMessage) -> dict:
-    # Même si Macron ne veut pas, nous on est là
+EUROPE_TIMEZONES = [timezone for timezone in all_timezones if 'Europe/' in timezone]
+
+logger = logging.getLogger('songrec')  # Configured by the scripts of utils/
 
-    fuzz = random() * 15.3 - 7.65
 
-    seed(getnode())
+class ShazamClient:
+    """
+    Client for the Shazam recognition API, sending every request over the pooled keep-alive connections of a
+    single requests.Session, so that the TCP and TLS handshakes are only paid once per connection. The parts of
+    the requests which do not change are built once.
 
-    try:
-        response = requests.post('https://amp.shazam.com/discovery/v5/fr/FR/android/-/tag/' + first_uuid + '/' + second_uuid, params={
+    "base_url" may point to a local stand-in server for tests. The client may be shared by several threads, up to
+    "pool_maxsize" of which get their own connection at once.
+    """
+
+    def __init__(self, base_url: str = SHAZAM_BASE_URL, pool_maxsize: int = 16, timeout: float = 60):
+        self.url = base_url + '/discovery/v5/fr/FR/android/-/tag/' + first_uuid + '/' + second_uuid
+        self.params = {
             'sync': 'true',
             'webv3': 'true',
             'sampling': 'true',
@@ -34,36 +47,117 @@ def recognize_song_from_signature(signature: DecodedMessage) -> dict:
             'shazamapiversion': 'v3',
             'sharehub': 'true',
             'video': 'v3'
-        }, headers={
+        }
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self.session.headers.update({
             'Content-Type': 'application/json',
-            'User-Agent': choice(USER_AGENTS),
             'Content-Language': locale
-        }, json={
-            "geolocation": {
-                "altitude": random() * 400 + 100 + fuzz,
-                "latitude": random() * 180 - 90 + fuzz,
-                "longitude": random() * 360 - 180 + fuzz
-            },
-            "signature": {
-                "samplems": int(signature.number_samples / signature.sample_rate_hz * 1000),
+        })
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception_info):
+        self.close()
+
+    def recognize_song_from_signature(self, signature: DecodedMessage, timeout: float = None) -> dict:
+        # Même si Macron ne veut pas, nous on est là
+
+        fuzz = random() * 15.3 - 7.65
+
+        seed(getnode())
+
+        try:
+            response = self.session.post(self.url, params=self.params, headers={
+                'User-Agent': choice(USER_AGENTS)
+            }, json={
+                "geolocation": {
+                    "altitude": random() * 400 + 100 + fuzz,
+                    "latitude": random() * 180 - 90 + fuzz,
+                    "longitude": random() * 360 - 180 + fuzz
+                },
+                "signature": {
+                    "samplems": int(signature.number_samples / signature.sample_rate_hz * 1000),
+                    "timestamp": int(time() * 1000),
+                    "uri": signature.encode_to_uri()
+                },
                 "timestamp": int(time() * 1000),
-                "uri": signature.encode_to_uri()
-            },
-            "timestamp": int(time() * 1000),
-            "timezone": choice([timezone for timezone in all_timezones if 'Europe/' in timezone])
-        }, timeout=60)
-
-        response.raise_for_status()
-        return response.json()
-    except requests.HTTPError as e:
-        print('HttpError in shazam api:', e)
-        return {"error":  str(e), "status_code": e.response.status_code, "reason": e.response.reason}
-    except requests.RequestException as e:
-        print('HTTP Request shazam api failed: ', e)
-        return {"error": str(e)}
-    except Exception as e:
-        print('Exception in shazam api:', e)
-        return {"error": str(e)}
+                "timezone": choice(EUROPE_TIMEZONES)
+            }, timeout=self.timeout if timeout is None else timeout)
+
+            response.raise_for_status()
+            return response.json()
+        except requests.HTTPError as e:
+            logger.warning('HttpError in shazam api: %s', e)
+            results = {"error":  str(e), "status_code": e.response.status_code, "reason": e.response.reason}
+            retry_after = e.response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                results["retryms"] = int(retry_after) * 1000
+            return results
+        except requests.RequestException as e:
+            logger.warning('HTTP Request shazam api failed: %s', e)
+            return {"error": str(e)}
+        except Exception as e:
+            logger.error('Exception in shazam api: %s', e, exc_info=True)
+            return {"error": str(e)}
+
+
+class AsyncShazamClient:
+    """
+    Asyncio counterpart of ShazamClient, keeping up to "max_concurrency" requests in flight. Requests run in
+    worker threads (through asyncio.to_thread()) over the pooled session of a ShazamClient, and return results
+    in the same shape, errors included.
+
+    Every request has a deadline, past which an {"error": ...} result is returned. The deadline is also the
+    timeout of the HTTP request, so that its thread ends shortly after. A request keeps its slot until its thread
+    has ended, even when its deadline has passed or the task awaiting it was cancelled, so that no more than
+    "max_concurrency" requests are ever sent at once.
+    """
+
+    def __init__(self, base_url: str = SHAZAM_BASE_URL, max_concurrency: int = 4, deadline_seconds: float = 60):
+        self.client = ShazamClient(base_url, pool_maxsize=max_concurrency, timeout=deadline_seconds)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.deadline_seconds = deadline_seconds
+
+    def close(self):
+        self.client.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exception_info):
+        self.close()
+
+    async def recognize_song_from_signature(self, signature: DecodedMessage, deadline_seconds: float = None) -> dict:
+        if deadline_seconds is None:
+            deadline_seconds = self.deadline_seconds
+
+        await self.semaphore.acquire()
+
+        request = asyncio.ensure_future(
+            asyncio.to_thread(self.client.recognize_song_from_signature, signature, deadline_seconds))
+        request.add_done_callback(lambda request: self.semaphore.release())
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(request), deadline_seconds)
+        except asyncio.TimeoutError:
+            logger.warning('Deadline of %g seconds exceeded in shazam api', deadline_seconds)
+            return {"error": 'Deadline of %g seconds exceeded' % deadline_seconds}
+
+
+def recognize_song_from_signature(signature: DecodedMessage) -> dict:
+    """Send a single request over a client of its own, pass a ShazamClient around to send several."""
+    with ShazamClient() as shazam_client:
+        return shazam_client.recognize_song_from_signature(signature)
 
 
 if __name__ == '__main__':
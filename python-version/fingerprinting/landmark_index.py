@@ -0,0 +1,259 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+from os import fdopen, replace, remove
+from os.path import dirname, abspath, exists
+from tempfile import mkstemp
+from json import dumps, loads
+from typing import Dict, List, Tuple, Optional, Any
+from numpy import load, savez, frombuffer, concatenate, searchsorted, lexsort, argsort, repeat, cumsum, arange, flatnonzero, zeros, int32, int64, uint8, ndarray
+
+from signature_format import DecodedMessage, FrequencyPeakColumns
+
+"""
+    Local inverted index of the "landmarks" of already recognized sounds,
+    used to find out whether a new sound is a re-upload or a crop of one of
+    them without querying Shazam again.
+
+    A landmark is a pair of frequency peaks of the same band (as produced
+    by SignatureGenerator): an anchor peak, and one of the next FAN_OUT
+    peaks following it within MAX_TIME_DELTA FFT passes and MAX_BIN_DELTA
+    frequency bins. It is hashed from the band, the frequency bin of the
+    anchor, and the frequency and time deltas between both peaks, which do
+    not depend on where the sound starts.
+
+    The index maps every hash to the (sound ID, FFT pass number of the
+    anchor) pairs where it occurs, as NumPy arrays sorted by hash. To match
+    a signature, the postings of its landmark hashes are gathered, and a
+    histogram of the differences between the time of each posting and the
+    time of the query landmark is built for every sound: a sound of which
+    the query is a copy shows many landmarks at the same time offset.
+
+    Sound IDs are integers (such as the Shazam track key), each of which
+    may carry JSON-serializable metadata (such as the Shazam response to
+    reuse for matching sounds).
+"""
+
+class LandmarkIndex:
+
+    FAN_OUT = 8
+    MAX_TIME_DELTA = 96 # FFT passes (128 samples at 16 KHz)
+    MAX_BIN_DELTA = 64 # Frequency bins (of 7.8125 Hz at 16 KHz)
+
+    MAX_HASH_OCCURRENCES = 2000 # Ignore hashes more frequent than this within the index, which carry little information
+
+    MIN_MATCHING_LANDMARKS = 50 # Number of landmarks aligned at the same time offset (give or take one FFT pass) to report a match
+    MIN_MATCHING_RATIO = 0.01 # Same, as a proportion of the landmarks of the query
+
+    def __init__(self):
+
+        self.hashes : ndarray = zeros(0, dtype = int64)
+        self.sound_ids : ndarray = zeros(0, dtype = int64)
+        self.times : ndarray = zeros(0, dtype = int32)
+
+        self.pending_postings : List[Tuple[ndarray, ndarray, ndarray]] = [] # Added since the last merge
+
+        self.sound_id_to_metadata : Dict[int, Any] = {}
+
+    """
+        Return the hashes of the landmarks of a signature, along with the
+        FFT pass numbers of their anchor peaks.
+    """
+
+    def extract_landmarks(self, signature : DecodedMessage) -> Tuple[ndarray, ndarray]:
+
+        landmark_hashes : List[ndarray] = []
+        landmark_times : List[ndarray] = []
+
+        for frequency_band, frequency_peaks in signature.frequency_band_to_sound_peaks.items():
+
+            if not isinstance(frequency_peaks, FrequencyPeakColumns):
+                frequency_peaks = FrequencyPeakColumns.from_peaks(frequency_peaks, signature.sample_rate_hz)
+
+            order : ndarray = argsort(frequency_peaks.fft_pass_numbers, kind = 'stable')
+
+            times : ndarray = frequency_peaks.fft_pass_numbers[order].astype(int64)
+            bins : ndarray = frequency_peaks.corrected_peak_frequency_bins[order].astype(int64) >> 6 # Drop the 1/64th bin correction
+
+            for distance in range(1, self.FAN_OUT + 1):
+
+                time_deltas : ndarray = times[distance:] - times[:-distance]
+                bin_deltas : ndarray = bins[distance:] - bins[:-distance]
+
+                in_target_zone : ndarray = flatnonzero((time_deltas > 0) & (time_deltas <= self.MAX_TIME_DELTA) & (abs(bin_deltas) <= self.MAX_BIN_DELTA))
+
+                # 3 bits of band, 10 bits of anchor bin, 11 bits of bin delta,
+                # 8 bits of time delta
+
+                landmark_hashes.append(
+                    (int(frequency_band) + 1) << 29 |
+                    (bins[in_target_zone] & 0x3ff) << 19 |
+                    (bin_deltas[in_target_zone] + 0x400) << 8 |
+                    time_deltas[in_target_zone]
+                )
+                landmark_times.append(times[in_target_zone])
+
+        if not landmark_hashes:
+            return zeros(0, dtype = int64), zeros(0, dtype = int64)
+
+        return concatenate(landmark_hashes), concatenate(landmark_times)
+
+    def add(self, sound_id : int, signature : DecodedMessage, metadata : Any = None):
+
+        self.add_landmarks(sound_id, *self.extract_landmarks(signature), metadata)
+
+    def add_landmarks(self, sound_id : int, hashes : ndarray, times : ndarray, metadata : Any = None):
+
+        self.pending_postings.append((hashes.astype(int64), repeat(int64(sound_id), len(hashes)), times.astype(int32)))
+
+        if metadata is not None or sound_id not in self.sound_id_to_metadata:
+            self.sound_id_to_metadata[sound_id] = metadata
+
+    def __len__(self) -> int:
+
+        return len(self.sound_id_to_metadata)
+
+    def __contains__(self, sound_id : int) -> bool:
+
+        return sound_id in self.sound_id_to_metadata
+
+    def get_metadata(self, sound_id : int) -> Any:
+
+        return self.sound_id_to_metadata.get(sound_id)
+
+    """
+        Merge the postings added since the last call into the sorted arrays.
+    """
+
+    def merge_pending_postings(self):
+
+        if not self.pending_postings:
+            return
+
+        hashes, sound_ids, times = (concatenate(columns) for columns in zip((self.hashes, self.sound_ids, self.times), *self.pending_postings))
+
+        order : ndarray = argsort(hashes, kind = 'stable')
+
+        self.hashes, self.sound_ids, self.times = hashes[order], sound_ids[order], times[order]
+
+        self.pending_postings = []
+
+    """
+        Return the (sound ID, number of aligned landmarks, time offset of
+        the query within the sound in seconds) tuples of the indexed sounds
+        which the passed signature matches, best first.
+    """
+
+    def find_matches(self, signature : DecodedMessage) -> List[Tuple[int, int, float]]:
+
+        query_hashes, query_times = self.extract_landmarks(signature)
+
+        if not len(query_hashes):
+            return []
+
+        query_indexes, sound_ids, posting_times = self.get_postings(query_hashes)
+
+        if not len(sound_ids):
+            return []
+
+        offsets : ndarray = posting_times.astype(int64) - query_times[query_indexes]
+
+        # Count the votes for every (sound, offset) pair, as runs of the
+        # sorted pairs, then add the votes of the neighbouring offsets (as
+        # peaks may move by one FFT pass between two cuts of a sound)
+
+        order : ndarray = lexsort((offsets, sound_ids))
+        sound_ids, offsets = sound_ids[order], offsets[order]
+
+        run_starts : ndarray = flatnonzero(concatenate([[True], (sound_ids[1:] != sound_ids[:-1]) | (offsets[1:] != offsets[:-1])]))
+        run_sound_ids, run_offsets = sound_ids[run_starts], offsets[run_starts]
+        run_votes : ndarray = concatenate([run_starts[1:], [len(offsets)]]) - run_starts
+
+        scores : ndarray = run_votes.copy()
+
+        previous_is_neighbour : ndarray = (run_sound_ids[1:] == run_sound_ids[:-1]) & (run_offsets[1:] == run_offsets[:-1] + 1)
+
+        scores[1:] += run_votes[:-1] * previous_is_neighbour
+        scores[:-1] += run_votes[1:] * previous_is_neighbour
+
+        min_score : float = max(self.MIN_MATCHING_LANDMARKS, self.MIN_MATCHING_RATIO * len(query_hashes))
+
+        # Keep the best offset of every sound
+
+        matches : Dict[int, Tuple[int, int, float]] = {}
+
+        for run in flatnonzero(scores >= min_score)[argsort(-scores[scores >= min_score], kind = 'stable')]:
+
+            sound_id : int = int(run_sound_ids[run])
+
+            if sound_id not in matches:
+                matches[sound_id] = (sound_id, int(scores[run]), int(run_offsets[run]) * 128 / signature.sample_rate_hz)
+
+        return list(matches.values())
+
+    """
+        Return the postings of the passed landmark hashes, as (index of the
+        matching query hash, sound ID, anchor FFT pass number) arrays.
+    """
+
+    def get_postings(self, query_hashes : ndarray) -> Tuple[ndarray, ndarray, ndarray]:
+
+        self.merge_pending_postings()
+
+        first_postings : ndarray = searchsorted(self.hashes, query_hashes, 'left')
+        num_postings : ndarray = searchsorted(self.hashes, query_hashes, 'right') - first_postings
+
+        num_postings[num_postings > self.MAX_HASH_OCCURRENCES] = 0
+
+        posting_indexes : ndarray = arange(int(num_postings.sum())) + repeat(first_postings - (cumsum(num_postings) - num_postings), num_postings)
+
+        return repeat(arange(len(query_hashes)), num_postings), self.sound_ids[posting_indexes], self.times[posting_indexes]
+
+    def find_best_match(self, signature : DecodedMessage) -> Optional[Tuple[int, int, float]]:
+
+        matches : List[Tuple[int, int, float]] = self.find_matches(signature)
+
+        return matches[0] if matches else None
+
+    """
+        Save the index to a NumPy .npz file, atomically.
+    """
+
+    def save(self, path : str):
+
+        self.merge_pending_postings()
+
+        metadata : ndarray = frombuffer(dumps([[sound_id, metadata] for sound_id, metadata in self.sound_id_to_metadata.items()]).encode('utf-8'), dtype = uint8)
+
+        temporary_file_descriptor, temporary_path = mkstemp(dir = dirname(abspath(path)), suffix = '.tmp')
+
+        try:
+            with fdopen(temporary_file_descriptor, 'wb') as temporary_file:
+                savez(temporary_file, hashes = self.hashes, sound_ids = self.sound_ids, times = self.times, metadata = metadata)
+
+            replace(temporary_path, path)
+
+        except BaseException:
+            remove(temporary_path)
+            raise
+
+    """
+        Load an index saved with self.save(), or return an empty one if
+        "path" does not exist yet.
+    """
+
+    @classmethod
+    def load(cls, path : str):
+
+        landmark_index = cls()
+
+        if exists(path):
+
+            with load(path) as index_data:
+
+                landmark_index.hashes = index_data['hashes']
+                landmark_index.sound_ids = index_data['sound_ids']
+                landmark_index.times = index_data['times']
+
+                landmark_index.sound_id_to_metadata = {sound_id: metadata for sound_id, metadata in loads(index_data['metadata'].tobytes().decode('utf-8'))}
+
+        return landmark_index
@@ -0,0 +1,459 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+from os import fsync, fstat, stat, replace, urandom
+from os.path import exists
+from mmap import mmap, ACCESS_READ
+from struct import Struct
+from binascii import crc32
+from fcntl import flock, LOCK_EX, LOCK_NB
+from json import dumps, loads
+from typing import Dict, List, Tuple, Optional, Any
+from numpy import dtype, frombuffer, zeros, concatenate, argsort, unique, nonzero, flatnonzero, searchsorted, cumsum, arange, repeat, int32, int64, uint64, ndarray
+
+from landmark_index import LandmarkIndex
+
+"""
+    Persistent LandmarkIndex, which several processes may share: one of
+    them writing to it, the others reading it through read-only memory
+    mappings. It is made of two files:
+
+    - "<path>.table": a header, then a hash table of landmark hash ->
+      (sound ID, anchor FFT pass number) entries using open addressing
+      over buckets of BUCKET_SIZE entries (an entry whose home bucket is
+      full goes to the next one), then the sorted IDs of the indexed
+      sounds and their JSON metadata. Lookups read it in place, so that
+      opening a store takes no time whatever its size.
+
+    - "<path>.wal": a write-ahead segment, where self.add() appends the
+      landmarks and metadata of every new sound (as CRC-checked records,
+      which are also kept in memory). It is merged into a new hash table
+      by self.merge(), which happens when it holds more than
+      MAX_WAL_POSTINGS postings.
+
+    Both files carry the generation of the hash table, so that readers and
+    an interrupted merge can tell whether the write-ahead segment has
+    already been merged. Readers pick up the writes of the writer on every
+    lookup, as long as its records are flushed.
+
+    The writer holds an exclusive flock() on "<path>.lock" (rather than on
+    the write-ahead segment, which is replaced by merges) while the store
+    is open, so that a second writer fails instead of corrupting it.
+"""
+
+TABLE_HEADER = Struct('<8sQQQQQ') # Magic, generation, number of buckets, entries per bucket, number of sounds, size of the metadata
+WAL_HEADER = Struct('<8sQ') # Magic, generation of the table it applies to
+WAL_RECORD_HEADER = Struct('<IqII') # CRC-32 of the rest of the record, sound ID, number of postings, size of the metadata
+
+TABLE_MAGIC = b'LMTABLE1'
+WAL_MAGIC = b'LMWALOG1'
+
+TABLE_ENTRY_DTYPE = dtype([('hash', '<u4'), ('time', '<i4'), ('sound_id', '<i8')]) # Hash 0 for free slots
+WAL_POSTING_DTYPE = dtype([('hash', '<u4'), ('time', '<i4')])
+
+class LandmarkStore(LandmarkIndex):
+
+    BUCKET_SIZE = 8
+    MAX_LOAD_FACTOR = 0.7
+
+    MAX_WAL_POSTINGS = 2000000
+
+    def __init__(self, path : str, read_only : bool = False):
+
+        super().__init__()
+
+        self.table_path : str = path + '.table'
+        self.wal_path : str = path + '.wal'
+        self.read_only : bool = read_only
+
+        self.table_file = None
+        self.table_map : Optional[mmap] = None
+        self.wal_file = None
+        self.lock_file = None
+
+        if not read_only:
+
+            self.lock_file = open(path + '.lock', 'ab')
+
+            try:
+                flock(self.lock_file, LOCK_EX | LOCK_NB) # Released when the file is closed
+
+            except BlockingIOError:
+                self.lock_file.close()
+                self.lock_file = None
+
+                raise PermissionError('The landmark store %s is already opened for writing by another process' % path) from None
+
+        if not exists(self.table_path):
+
+            if read_only:
+                raise FileNotFoundError(self.table_path)
+
+            self.write_table(self.table_path, int.from_bytes(urandom(8), 'little') >> 1, zeros(0, dtype = TABLE_ENTRY_DTYPE), {})
+
+        self.open_table()
+        self.open_wal()
+
+    def close(self):
+
+        self.close_files()
+
+        if self.lock_file:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def close_files(self):
+
+        if self.table_map:
+            self.release_table()
+
+        if self.wal_file:
+            self.wal_file.close()
+            self.wal_file = None
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exception_info):
+
+        self.close()
+
+    def open_table(self):
+
+        self.table_file = open(self.table_path, 'rb')
+        self.table_map = mmap(self.table_file.fileno(), 0, access = ACCESS_READ)
+
+        magic, self.generation, num_buckets, bucket_size, num_sounds, _ = TABLE_HEADER.unpack_from(self.table_map)
+
+        if magic != TABLE_MAGIC:
+            raise ValueError('Not a landmark store: %s' % self.table_path)
+
+        # Zero-copy views over the sections of the file
+
+        offset : int = TABLE_HEADER.size
+
+        self.buckets : ndarray = frombuffer(self.table_map, TABLE_ENTRY_DTYPE, num_buckets * bucket_size, offset).reshape(num_buckets, bucket_size)
+        offset += self.buckets.nbytes
+
+        self.table_sound_ids : ndarray = frombuffer(self.table_map, int64, num_sounds, offset)
+        offset += self.table_sound_ids.nbytes
+
+        self.metadata_offsets : ndarray = frombuffer(self.table_map, int64, num_sounds + 1, offset)
+        offset += self.metadata_offsets.nbytes
+
+        self.metadata_start : int = offset
+
+    def release_table(self):
+
+        # NumPy views must be dropped before the mapping may be closed
+
+        self.buckets = self.table_sound_ids = self.metadata_offsets = None
+
+        self.table_map.close()
+        self.table_file.close()
+
+        self.table_map = self.table_file = None
+
+    """
+        Load the records of the write-ahead segment, when it applies to the
+        current table. A writer drops a segment that does not (it has
+        already been merged), as well as any torn record at its end.
+    """
+
+    def open_wal(self):
+
+        self.hashes, self.sound_ids, self.times = zeros(0, dtype = int64), zeros(0, dtype = int64), zeros(0, dtype = int32)
+        self.pending_postings = []
+        self.sound_id_to_metadata = {}
+        self.num_wal_postings : int = 0
+
+        if not exists(self.wal_path):
+
+            if self.read_only:
+                return
+
+            self.reset_wal()
+
+        self.wal_file = open(self.wal_path, 'rb' if self.read_only else 'r+b')
+
+        magic, generation = WAL_HEADER.unpack(self.wal_file.read(WAL_HEADER.size))
+
+        if magic != WAL_MAGIC:
+            raise ValueError('Not a landmark store write-ahead segment: %s' % self.wal_path)
+
+        self.wal_size : int = WAL_HEADER.size
+
+        if generation != self.generation:
+
+            if self.read_only:
+                self.wal_file.close()
+                self.wal_file = None
+                return
+
+            self.wal_file.close()
+            self.reset_wal()
+
+            self.wal_file = open(self.wal_path, 'r+b')
+            self.wal_file.seek(WAL_HEADER.size)
+
+        self.read_wal_records()
+
+        if not self.read_only:
+            self.wal_file.truncate(self.wal_size)
+
+    def reset_wal(self):
+
+        with open(self.wal_path + '.tmp', 'wb') as wal_file:
+            wal_file.write(WAL_HEADER.pack(WAL_MAGIC, self.generation))
+            wal_file.flush()
+            fsync(wal_file.fileno())
+
+        replace(self.wal_path + '.tmp', self.wal_path)
+
+    def read_wal_records(self):
+
+        self.wal_file.seek(self.wal_size)
+
+        while True:
+
+            record_header : bytes = self.wal_file.read(WAL_RECORD_HEADER.size)
+
+            if len(record_header) < WAL_RECORD_HEADER.size:
+                break
+
+            checksum, sound_id, num_postings, metadata_size = WAL_RECORD_HEADER.unpack(record_header)
+
+            record_body : bytes = self.wal_file.read(num_postings * WAL_POSTING_DTYPE.itemsize + metadata_size)
+
+            if len(record_body) < num_postings * WAL_POSTING_DTYPE.itemsize + metadata_size or crc32(record_body, crc32(record_header[4:])) != checksum:
+                break # Torn record, being written or left by a crash
+
+            postings : ndarray = frombuffer(record_body, WAL_POSTING_DTYPE, num_postings)
+
+            super().add_landmarks(sound_id, postings['hash'], postings['time'], loads(record_body[num_postings * WAL_POSTING_DTYPE.itemsize:].decode('utf-8')))
+
+            self.num_wal_postings += num_postings
+            self.wal_size += WAL_RECORD_HEADER.size + len(record_body)
+
+    """
+        Take the writes of the writer process into account: reopen both files
+        if the table was merged since, otherwise read the new records of
+        the write-ahead segment.
+    """
+
+    def refresh(self):
+
+        if stat(self.table_path).st_ino != fstat(self.table_file.fileno()).st_ino:
+
+            self.close_files()
+            self.open_table()
+            self.open_wal()
+
+        elif self.wal_file:
+
+            self.read_wal_records()
+
+        elif exists(self.wal_path):
+
+            self.open_wal()
+
+    def add_landmarks(self, sound_id : int, hashes : ndarray, times : ndarray, metadata : Any = None):
+
+        if self.read_only:
+            raise PermissionError('The landmark store is opened read-only')
+
+        postings : ndarray = zeros(len(hashes), dtype = WAL_POSTING_DTYPE)
+        postings['hash'], postings['time'] = hashes, times
+
+        record_body : bytes = postings.tobytes() + dumps(metadata).encode('utf-8')
+
+        record_header : bytes = WAL_RECORD_HEADER.pack(0, sound_id, len(postings), len(record_body) - postings.nbytes)
+        record_header = WAL_RECORD_HEADER.pack(crc32(record_body, crc32(record_header[4:])), sound_id, len(postings), len(record_body) - postings.nbytes)
+
+        self.wal_file.seek(self.wal_size)
+        self.wal_file.write(record_header + record_body)
+        self.wal_file.flush()
+
+        self.wal_size += len(record_header) + len(record_body)
+        self.num_wal_postings += len(postings)
+
+        super().add_landmarks(sound_id, hashes, times, metadata)
+
+        if self.num_wal_postings > self.MAX_WAL_POSTINGS:
+            self.merge()
+
+    def __len__(self) -> int:
+
+        return len(self.table_sound_ids) + sum(1 for sound_id in self.sound_id_to_metadata if not self.is_in_table(sound_id))
+
+    def __contains__(self, sound_id : int) -> bool:
+
+        return sound_id in self.sound_id_to_metadata or self.is_in_table(sound_id)
+
+    def is_in_table(self, sound_id : int) -> bool:
+
+        position : int = int(searchsorted(self.table_sound_ids, sound_id))
+
+        return position < len(self.table_sound_ids) and self.table_sound_ids[position] == sound_id
+
+    def get_metadata(self, sound_id : int) -> Any:
+
+        if self.read_only:
+            self.refresh()
+
+        if self.sound_id_to_metadata.get(sound_id) is not None or not self.is_in_table(sound_id):
+            return self.sound_id_to_metadata.get(sound_id)
+
+        position : int = int(searchsorted(self.table_sound_ids, sound_id))
+
+        return loads(self.table_map[self.metadata_start + self.metadata_offsets[position]:self.metadata_start + self.metadata_offsets[position + 1]].decode('utf-8'))
+
+    def get_postings(self, query_hashes : ndarray) -> Tuple[ndarray, ndarray, ndarray]:
+
+        if self.read_only:
+            self.refresh()
+
+        wal_postings : Tuple[ndarray, ndarray, ndarray] = super().get_postings(query_hashes)
+
+        # Probe the buckets of all the query hashes at once, following the
+        # ones whose bucket is full to the next bucket
+
+        query_indexes : List[ndarray] = [wal_postings[0]]
+        sound_ids : List[ndarray] = [wal_postings[1]]
+        times : List[ndarray] = [wal_postings[2]]
+
+        num_buckets : int = len(self.buckets)
+
+        home_buckets : ndarray = get_home_buckets(query_hashes, num_buckets)
+
+        probed_queries : ndarray = arange(len(query_hashes))
+
+        for probe in range(num_buckets):
+
+            if not len(probed_queries):
+                break
+
+            bucket_entries : ndarray = self.buckets[(home_buckets[probed_queries] + probe) & (num_buckets - 1)]
+
+            matching_queries, matching_slots = nonzero(bucket_entries['hash'] == query_hashes[probed_queries, None])
+
+            query_indexes.append(probed_queries[matching_queries])
+            sound_ids.append(bucket_entries['sound_id'][matching_queries, matching_slots])
+            times.append(bucket_entries['time'][matching_queries, matching_slots])
+
+            probed_queries = probed_queries[bucket_entries['hash'][:, -1] != 0] # Slots are filled in order
+
+        return concatenate(query_indexes), concatenate(sound_ids), concatenate(times)
+
+    """
+        Rewrite the hash table with the contents of the write-ahead
+        segment, then empty the latter.
+    """
+
+    def merge(self):
+
+        if self.read_only:
+            raise PermissionError('The landmark store is opened read-only')
+
+        self.merge_pending_postings()
+
+        table_entries : ndarray = self.buckets[self.buckets['hash'] != 0]
+
+        entries : ndarray = zeros(len(table_entries) + len(self.hashes), dtype = TABLE_ENTRY_DTYPE)
+        entries[:len(table_entries)] = table_entries
+        entries['hash'][len(table_entries):], entries['time'][len(table_entries):], entries['sound_id'][len(table_entries):] = self.hashes, self.times, self.sound_ids
+
+        # Drop the hashes which are too frequent to be looked up anyway
+
+        _, inverse, counts = unique(entries['hash'], return_inverse = True, return_counts = True)
+
+        entries = entries[counts[inverse] <= self.MAX_HASH_OCCURRENCES]
+
+        sound_id_to_metadata : Dict[int, Any] = {int(sound_id): None for sound_id in self.table_sound_ids}
+        sound_id_to_metadata.update({sound_id: self.get_metadata(sound_id) for sound_id in list(sound_id_to_metadata) + list(self.sound_id_to_metadata)})
+
+        # The table is replaced first: should we stop before the write-ahead
+        # segment is reset, its generation will not match and it will be
+        # dropped when reopened
+
+        generation : int = (self.generation + 1) & (2 ** 63 - 1)
+
+        self.write_table(self.table_path + '.tmp', generation, entries, sound_id_to_metadata)
+
+        self.close_files()
+
+        replace(self.table_path + '.tmp', self.table_path)
+
+        self.open_table()
+
+        self.reset_wal()
+        self.open_wal()
+
+    def write_table(self, path : str, generation : int, entries : ndarray, sound_id_to_metadata : Dict[int, Any]):
+
+        num_buckets : int = 16
+
+        while len(entries) > num_buckets * self.BUCKET_SIZE * self.MAX_LOAD_FACTOR:
+            num_buckets *= 2
+
+        buckets : ndarray = zeros((num_buckets, self.BUCKET_SIZE), dtype = TABLE_ENTRY_DTYPE)
+
+        # Insert entries by rounds: at round N, the entries not placed yet
+        # fill the free slots of the Nth bucket after their home bucket, in
+        # order, so that an entry is only ever stored after full buckets
+
+        bucket_fills : ndarray = zeros(num_buckets, dtype = int64)
+
+        home_buckets : ndarray = get_home_buckets(entries['hash'], num_buckets)
+        unplaced_entries : ndarray = arange(len(entries))
+
+        for probe in range(num_buckets):
+
+            if not len(unplaced_entries):
+                break
+
+            target_buckets : ndarray = (home_buckets[unplaced_entries] + probe) & (num_buckets - 1)
+
+            order : ndarray = argsort(target_buckets, kind = 'stable')
+            unplaced_entries, target_buckets = unplaced_entries[order], target_buckets[order]
+
+            group_starts : ndarray = flatnonzero(concatenate([[True], target_buckets[1:] != target_buckets[:-1]]))
+            ranks : ndarray = arange(len(target_buckets)) - repeat(group_starts, concatenate([group_starts[1:], [len(target_buckets)]]) - group_starts)
+
+            slots : ndarray = bucket_fills[target_buckets] + ranks
+            placed : ndarray = slots < self.BUCKET_SIZE
+
+            buckets[target_buckets[placed], slots[placed]] = entries[unplaced_entries[placed]]
+
+            bucket_fills[target_buckets[placed]] = slots[placed] + 1 # The last write of a bucket is its highest slot
+
+            unplaced_entries = unplaced_entries[~placed]
+
+        # Sounds and their metadata
+
+        table_sound_ids : ndarray = concatenate([zeros(0, dtype = int64), sorted(sound_id_to_metadata)]).astype(int64)
+
+        metadata : List[bytes] = [dumps(sound_id_to_metadata[int(sound_id)]).encode('utf-8') for sound_id in table_sound_ids]
+
+        metadata_offsets : ndarray = concatenate([[0], cumsum([len(sound_metadata) for sound_metadata in metadata], dtype = int64)]).astype(int64)
+
+        with open(path, 'wb') as table_file:
+
+            table_file.write(TABLE_HEADER.pack(TABLE_MAGIC, generation, num_buckets, self.BUCKET_SIZE, len(table_sound_ids), int(metadata_offsets[-1])))
+            table_file.write(buckets.tobytes())
+            table_file.write(table_sound_ids.tobytes())
+            table_file.write(metadata_offsets.tobytes())
+            table_file.write(b''.join(metadata))
+
+            table_file.flush()
+            fsync(table_file.fileno())
+
+
+"""
+    Spread landmark hashes (whose bits are not uniformly distributed) over
+    the buckets of the table, with a multiplicative hash.
+"""
+
+def get_home_buckets(hashes : ndarray, num_buckets : int) -> ndarray:
+
+    return ((hashes.astype(uint64) * uint64(0x9e3779b97f4a7c15)) >> uint64(64 - (num_buckets.bit_length() - 1))).astype(int64)
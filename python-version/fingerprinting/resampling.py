@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+from numpy import arange, zeros, concatenate, kaiser, sinc, where, maximum, rint, clip, int16, float64, ndarray
+from numpy.lib.stride_tricks import sliding_window_view
+from math import gcd
+
+from signature_format import SampleRate
+
+SUPPORTED_SAMPLE_RATES_HZ = [int(sample_rate.name.strip('_')) for sample_rate in SampleRate]
+
+"""
+    Streaming polyphase resampler, converting interleaved signed 16-bit
+    PCM samples with any number of channels, at any of the rates of the
+    SampleRate enum, to mono samples at 16 KHz (or another output rate).
+
+    Channels are averaged, then the signal is upsampled by "up", low-pass
+    filtered and downsampled by "down" in a single step: every output
+    sample is the dot product of the input samples around it with one of
+    the "up" phases of a Kaiser-windowed sinc filter (designed like the
+    filter of SciPy's resample_poly()). This is computed for blocks of
+    output samples at once, as one matrix product per phase over a strided
+    view of the input.
+
+    Input may be passed in successive chunks, the filter state being kept
+    in between. Since every output sample depends on a few input samples
+    after it, the last output samples are only returned once self.flush()
+    is called (the input being then padded with silence).
+"""
+
+class PolyphaseResampler:
+
+    OUTPUT_BLOCK_SIZE = 16384 # Number of output samples computed at once, bounding memory usage
+
+    def __init__(self, input_sample_rate_hz : int, num_channels : int = 1, output_sample_rate_hz : int = 16000):
+
+        if input_sample_rate_hz not in SUPPORTED_SAMPLE_RATES_HZ:
+            raise ValueError('Unsupported sample rate: %s Hz (supported: %s)' % (input_sample_rate_hz,
+                ', '.join(map(str, SUPPORTED_SAMPLE_RATES_HZ))))
+
+        if num_channels < 1:
+            raise ValueError('Invalid number of channels: %s' % num_channels)
+
+        self.input_sample_rate_hz : int = input_sample_rate_hz
+        self.num_channels : int = num_channels
+        self.output_sample_rate_hz : int = output_sample_rate_hz
+
+        divisor : int = gcd(input_sample_rate_hz, output_sample_rate_hz)
+
+        self.up : int = output_sample_rate_hz // divisor
+        self.down : int = input_sample_rate_hz // divisor
+
+        # Filter, at the upsampled rate, cutting at the lowest of the two
+        # Nyquist frequencies
+
+        max_rate : int = max(self.up, self.down)
+
+        self.half_length : int = 10 * max_rate
+
+        filter_times : ndarray = arange(-self.half_length, self.half_length + 1) / max_rate
+
+        lowpass_filter : ndarray = sinc(filter_times) * kaiser(2 * self.half_length + 1, 5.0)
+        lowpass_filter *= self.up / lowpass_filter.sum() # Unity gain once downsampled
+
+        # Split it into phases: output sample number M is the dot product of
+        # phase_filters[P] with the input samples N_MIN to N_MIN + TAPS - 1,
+        # where N_MIN is the first input sample within the filter span and
+        # P = N_MIN * up - (M * down - half_length)
+
+        self.num_taps : int = 2 * self.half_length // self.up + 1
+
+        filter_indexes : ndarray = 2 * self.half_length - arange(self.up)[:, None] - arange(self.num_taps)[None, :] * self.up
+
+        self.phase_filters : ndarray = where(filter_indexes >= 0, lowpass_filter[maximum(filter_indexes, 0)], 0)
+
+        # Input samples (downmixed) not consumed yet, preceded by silence
+        # so that the first output samples are centered like the others
+
+        self.num_history_samples : int = -(-self.half_length // self.up) + 1
+
+        self.pending_input : ndarray = zeros(self.num_history_samples, dtype = float64)
+        self.pending_input_start : int = -self.num_history_samples # Index of self.pending_input[0] within the whole input
+
+        self.num_input_samples : int = 0
+        self.num_output_samples : int = 0
+
+    """
+        Consume a chunk of interleaved samples, and return the output
+        samples that can be computed so far (as an int16 NumPy array).
+    """
+
+    def resample(self, s16le_samples : ndarray) -> ndarray:
+
+        if len(s16le_samples) % self.num_channels:
+            raise ValueError('The number of samples is not a multiple of the number of channels')
+
+        if self.num_channels == 1:
+            mono_samples : ndarray = s16le_samples.astype(float64)
+        else:
+            mono_samples : ndarray = s16le_samples.reshape(-1, self.num_channels).mean(axis = 1)
+
+        self.pending_input = concatenate([self.pending_input, mono_samples])
+        self.num_input_samples += len(mono_samples)
+
+        # Output samples whose last input sample is available
+
+        num_available_outputs : int = (self.num_input_samples - self.num_taps) * self.up + self.half_length
+        num_available_outputs = max(num_available_outputs // self.down + 1, self.num_output_samples) if num_available_outputs >= 0 else self.num_output_samples
+
+        return self.compute_output(num_available_outputs)
+
+    """
+        Return the last output samples, as if the input was followed with
+        silence (the total number of output samples is then the duration
+        of the input, at the output rate).
+    """
+
+    def flush(self) -> ndarray:
+
+        self.pending_input = concatenate([self.pending_input, zeros(self.num_taps, dtype = float64)])
+
+        return self.compute_output(-(-self.num_input_samples * self.up // self.down))
+
+    def compute_output(self, end_output_sample : int) -> ndarray:
+
+        output_blocks : list = []
+
+        for first_output_sample in range(self.num_output_samples, end_output_sample, self.OUTPUT_BLOCK_SIZE):
+
+            output_block : ndarray = zeros(min(self.OUTPUT_BLOCK_SIZE, end_output_sample - first_output_sample), dtype = float64)
+
+            input_windows : ndarray = sliding_window_view(self.pending_input, self.num_taps)
+
+            # Output samples "up" apart use the same phase of the filter, over
+            # input samples "down" apart, hence a matrix product per phase over
+            # a strided view of the input
+
+            for first_phase_output in range(min(self.up, len(output_block))):
+
+                filter_start : int = (first_output_sample + first_phase_output) * self.down - self.half_length
+                first_input_sample : int = -(-filter_start // self.up)
+                phase : int = first_input_sample * self.up - filter_start
+
+                phase_outputs : ndarray = output_block[first_phase_output::self.up]
+
+                phase_outputs[:] = input_windows[first_input_sample - self.pending_input_start::self.down][:len(phase_outputs)] @ self.phase_filters[phase]
+
+            output_blocks.append(output_block)
+
+        self.num_output_samples = max(self.num_output_samples, end_output_sample)
+
+        # Release the input samples that no further output sample needs
+
+        next_first_input_sample : int = -(-(self.num_output_samples * self.down - self.half_length) // self.up)
+        num_released_samples : int = min(next_first_input_sample - self.pending_input_start, len(self.pending_input))
+
+        if num_released_samples > 0:
+            self.pending_input = self.pending_input[num_released_samples:]
+            self.pending_input_start += num_released_samples
+
+        if not output_blocks:
+            return zeros(0, dtype = int16)
+
+        return clip(rint(concatenate(output_blocks)), -32768, 32767).astype(int16)
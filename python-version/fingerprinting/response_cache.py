@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+from sqlite3 import connect, Connection
+from threading import Lock
+from hashlib import blake2b
+from json import dumps, loads
+from time import time
+from typing import Optional
+
+from signature_format import DecodedMessage
+
+"""
+    Size-bounded SQLite cache of the Shazam responses to signatures, so that
+    sending the same signature again (when a sound without a result is
+    checked again, or a copy of an already checked sound is downloaded)
+    does not cost a request.
+
+    Entries are keyed by a hash of the binary signature and its number of
+    samples. Responses with matches are kept for "match_ttl_seconds", and
+    responses without a match for "no_match_ttl_seconds", which should be
+    shorter, as Shazam may learn the song meanwhile. Errors (such as 429
+    answers) are never cached.
+
+    The database may be shared by several processes and pipeline runs. The
+    least recently used entries are evicted when there are more than
+    "max_entries" of them.
+"""
+
+class ResponseCache:
+
+    def __init__(self, path : str, match_ttl_seconds : float = 30 * 24 * 3600, no_match_ttl_seconds : float = 24 * 3600, max_entries : int = 100000):
+
+        self.path : str = path
+        self.match_ttl_seconds : float = match_ttl_seconds
+        self.no_match_ttl_seconds : float = no_match_ttl_seconds
+        self.max_entries : int = max_entries
+
+        self.num_hits : int = 0
+        self.num_misses : int = 0
+
+        self.lock : Lock = Lock() # The connection is shared by the threads of the asyncio driver
+
+        self.connection : Connection = connect(path, timeout = 30, check_same_thread = False, isolation_level = None)
+
+        self.connection.execute('PRAGMA journal_mode = WAL')
+
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                key             TEXT PRIMARY KEY,
+                response        TEXT NOT NULL,
+                expires_at      REAL NOT NULL,
+                last_used_at    REAL NOT NULL
+            )
+        ''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS responses_last_used_at ON responses (last_used_at)')
+
+        self.approximate_num_entries : int = self.connection.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    def close(self):
+
+        self.connection.close()
+
+    @staticmethod
+    def make_key(signature : DecodedMessage) -> str:
+
+        return blake2b(signature.encode_to_binary() + int(signature.number_samples).to_bytes(8, 'little'), digest_size = 20).hexdigest()
+
+    """
+        Return the cached response to the passed signature, or None.
+    """
+
+    def get(self, signature : DecodedMessage) -> Optional[dict]:
+
+        key : str = self.make_key(signature)
+        now : float = time()
+
+        with self.lock:
+
+            row = self.connection.execute('SELECT response FROM responses WHERE key = ? AND expires_at > ?', (key, now)).fetchone()
+
+            if row is None:
+                self.num_misses += 1
+                return None
+
+            self.connection.execute('UPDATE responses SET last_used_at = ? WHERE key = ?', (now, key))
+
+        self.num_hits += 1
+
+        return loads(row[0])
+
+    def put(self, signature : DecodedMessage, response : dict):
+
+        if not isinstance(response, dict) or response.get('error'):
+            return
+
+        if response.get('matches'):
+            ttl_seconds : float = self.match_ttl_seconds
+
+        else:
+            ttl_seconds : float = self.no_match_ttl_seconds
+
+            # "retryms" only paces the requests for the next signatures of
+            # the same sound, and is not an outcome to replay
+
+            response = {name: value for name, value in response.items() if name != 'retryms'}
+
+        now : float = time()
+
+        with self.lock:
+
+            self.connection.execute('INSERT OR REPLACE INTO responses (key, response, expires_at, last_used_at) VALUES (?, ?, ?, ?)',
+                (self.make_key(signature), dumps(response, ensure_ascii = False), now + ttl_seconds, now))
+
+            self.approximate_num_entries += 1
+
+            if self.approximate_num_entries > self.max_entries:
+                self.evict()
+
+    """
+        Remove the expired entries, then the least recently used ones until
+        the cache is back to 90% of its maximal number of entries.
+    """
+
+    def evict(self):
+
+        self.connection.execute('DELETE FROM responses WHERE expires_at <= ?', (time(),))
+
+        num_entries : int = self.connection.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+        num_evicted : int = max(num_entries - int(self.max_entries * 0.9), 0)
+
+        if num_evicted:
+            self.connection.execute('DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used_at LIMIT ?)', (num_evicted,))
+
+        self.approximate_num_entries = num_entries - num_evicted
@@ -0,0 +1,527 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+from os import replace, fsync, urandom
+from os.path import exists, getsize
+from mmap import mmap, ACCESS_READ, ACCESS_WRITE
+from struct import Struct, unpack_from
+from binascii import crc32
+from typing import Dict, List, Tuple, Iterable, Iterator, Callable, Optional, Union
+
+from signature_format import DecodedMessage, RawSignatureHeader, SampleRate
+
+"""
+    Append-only archive of Shazam signatures (the output of
+    DecodedMessage.encode_to_binary()), made of two files:
+
+    - "<path>.data": a header, then (20-byte key, signature) records packed
+      back-to-back, in the order they were appended. Signatures describe
+      their own length and CRC-32 (see RawSignatureHeader), so that this
+      file can be scanned and checked on its own.
+
+    - "<path>.index": a header, then a memory-mapped open-addressing hash
+      table of fixed-width entries (key, offset of the signature within the
+      data file, length, CRC-32 and number of samples), for O(1) lookups.
+      It is rebuilt from the data file when both do not match (after a
+      crash or an interrupted compaction).
+
+    Keys are 20-byte digests, passed as bytes or as hexadecimal strings
+    (such as the keys of SignatureCache). Appending a signature under an
+    existing key replaces it, the former one being left in the data file
+    until self.compact() is called.
+
+    Signatures are read without copies, as memoryviews over the mapped
+    data file. A single process may write to an archive at once.
+"""
+
+DATA_HEADER = Struct('<8sQ') # Magic, generation
+INDEX_HEADER = Struct('<8sQQQQ24x') # Magic, generation, capacity, number of entries, size of the data file
+
+INDEX_ENTRY = Struct('<20sQIII') # Key, offset, length (0 for free slots), CRC-32, number of samples
+
+DATA_MAGIC = b'SIGDATA1'
+INDEX_MAGIC = b'SIGINDX1'
+
+KEY_SIZE = 20
+
+class SignatureArchive:
+
+    INITIAL_CAPACITY = 1024
+    MAX_LOAD_FACTOR = 0.7
+
+    def __init__(self, path : str, read_only : bool = False):
+
+        self.data_path : str = path + '.data'
+        self.index_path : str = path + '.index'
+        self.read_only : bool = read_only
+
+        if not exists(self.data_path):
+
+            if read_only:
+                raise FileNotFoundError(self.data_path)
+
+            with open(self.data_path, 'wb') as data_file:
+                data_file.write(DATA_HEADER.pack(DATA_MAGIC, int.from_bytes(urandom(8), 'little')))
+
+        self.data_file = open(self.data_path, 'rb' if read_only else 'r+b')
+
+        magic, self.generation = DATA_HEADER.unpack(self.data_file.read(DATA_HEADER.size))
+
+        if magic != DATA_MAGIC:
+            raise ValueError('Not a signature archive: %s' % self.data_path)
+
+        self.data_map : Optional[mmap] = None
+        self.index_file = None
+        self.index_map : Optional[mmap] = None
+
+        if not self.is_index_consistent():
+
+            if read_only:
+                raise ValueError('The index of the signature archive needs to be rebuilt: %s' % self.index_path)
+
+            self.rebuild_index()
+
+        self.open_index()
+
+    def is_index_consistent(self) -> bool:
+
+        if not exists(self.index_path) or getsize(self.index_path) < INDEX_HEADER.size:
+            return False
+
+        with open(self.index_path, 'rb') as index_file:
+            magic, generation, capacity, _, data_size = INDEX_HEADER.unpack(index_file.read(INDEX_HEADER.size))
+
+        return (magic == INDEX_MAGIC and generation == self.generation and data_size == getsize(self.data_path) and
+            getsize(self.index_path) == INDEX_HEADER.size + capacity * INDEX_ENTRY.size)
+
+    def open_index(self):
+
+        self.index_file = open(self.index_path, 'rb' if self.read_only else 'r+b')
+        self.index_map = mmap(self.index_file.fileno(), 0, access = ACCESS_READ if self.read_only else ACCESS_WRITE)
+
+        _, _, self.capacity, self.num_entries, self.data_size = INDEX_HEADER.unpack_from(self.index_map)
+
+    def close(self):
+
+        if self.index_map:
+            self.flush()
+            self.index_map.close()
+            self.index_file.close()
+            self.index_map = self.index_file = None
+
+        self.release_data_map()
+
+        self.data_file.close()
+
+    def release_data_map(self):
+
+        if self.data_map:
+
+            try:
+                self.data_map.close()
+            except BufferError: # Memoryviews over it are still in use, it will be closed with them
+                pass
+
+            self.data_map = None
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exception_info):
+
+        self.close()
+
+    """
+        Make the appended signatures durable.
+    """
+
+    def flush(self):
+
+        if self.read_only:
+            return
+
+        self.data_file.flush()
+        fsync(self.data_file.fileno())
+
+        INDEX_HEADER.pack_into(self.index_map, 0, INDEX_MAGIC, self.generation, self.capacity, self.num_entries, self.data_size)
+        self.index_map.flush()
+
+    def __len__(self) -> int:
+
+        return self.num_entries
+
+    def __contains__(self, key : Union[str, bytes]) -> bool:
+
+        return self.find_slot(to_key_bytes(key))[1] is not None
+
+    """
+        Return the position of "key" within the hash table, and its entry
+        (or the position of the free slot where it would be inserted, and
+        None).
+    """
+
+    def find_slot(self, key : bytes) -> Tuple[int, Optional[Tuple[bytes, int, int, int, int]]]:
+
+        slot : int = int.from_bytes(key[:8], 'little') & (self.capacity - 1)
+
+        while True:
+
+            entry : Tuple[bytes, int, int, int, int] = INDEX_ENTRY.unpack_from(self.index_map, INDEX_HEADER.size + slot * INDEX_ENTRY.size)
+
+            if not entry[2]:
+                return slot, None
+
+            if entry[0] == key:
+                return slot, entry
+
+            slot = (slot + 1) & (self.capacity - 1)
+
+    """
+        Return the binary signature stored under "key" (as a memoryview
+        over the mapped data file, which may be passed as is to
+        DecodedMessage.decode_from_binary()), or None.
+    """
+
+    def get_binary(self, key : Union[str, bytes]) -> Optional[memoryview]:
+
+        entry = self.find_slot(to_key_bytes(key))[1]
+
+        if entry is None:
+            return None
+
+        _, offset, length, _, _ = entry
+
+        return self.get_data_view(offset, length)
+
+    def get(self, key : Union[str, bytes], columnar : bool = False) -> Optional[DecodedMessage]:
+
+        signature_binary : Optional[memoryview] = self.get_binary(key)
+
+        return DecodedMessage.decode_from_binary(signature_binary, columnar) if signature_binary is not None else None
+
+    """
+        Return the (CRC-32, number of samples, length) index entry fields of
+        "key", without reading the signature.
+    """
+
+    def get_info(self, key : Union[str, bytes]) -> Optional[Dict[str, int]]:
+
+        entry = self.find_slot(to_key_bytes(key))[1]
+
+        if entry is None:
+            return None
+
+        return {'offset': entry[1], 'length': entry[2], 'crc32': entry[3], 'number_samples': entry[4]}
+
+    def get_data_view(self, offset : int, length : int) -> memoryview:
+
+        if self.data_map is None or len(self.data_map) < offset + length:
+
+            # Map the file again, now that it has grown (the former mapping
+            # stays alive as long as memoryviews over it do)
+
+            self.data_file.flush()
+            self.data_map = mmap(self.data_file.fileno(), 0, access = ACCESS_READ)
+
+        return memoryview(self.data_map)[offset:offset + length]
+
+    def put(self, key : Union[str, bytes], signature : Union[bytes, DecodedMessage]):
+
+        self.put_many([(key, signature)])
+
+    """
+        Append many signatures at once, with a single write to the data
+        file.
+    """
+
+    def put_many(self, keys_and_signatures : Iterable[Tuple[Union[str, bytes], Union[bytes, DecodedMessage]]]):
+
+        if self.read_only:
+            raise PermissionError('The signature archive is opened read-only')
+
+        records : List[bytes] = []
+        entries : List[Tuple[bytes, int, int, int, int]] = []
+
+        offset : int = self.data_size
+
+        for key, signature in keys_and_signatures:
+
+            key = to_key_bytes(key)
+
+            signature_binary : bytes = signature.encode_to_binary() if isinstance(signature, DecodedMessage) else bytes(signature)
+
+            checksum, number_samples = read_signature_header(signature_binary)
+
+            records.append(key)
+            records.append(signature_binary)
+
+            entries.append((key, offset + KEY_SIZE, len(signature_binary), checksum, number_samples))
+
+            offset += KEY_SIZE + len(signature_binary)
+
+        if not entries:
+            return
+
+        self.data_file.seek(self.data_size)
+        self.data_file.write(b''.join(records))
+
+        self.data_size = offset
+
+        for entry in entries:
+            self.insert_entry(entry)
+
+        INDEX_HEADER.pack_into(self.index_map, 0, INDEX_MAGIC, self.generation, self.capacity, self.num_entries, self.data_size)
+
+    def insert_entry(self, entry : Tuple[bytes, int, int, int, int]):
+
+        if (self.num_entries + 1) > self.capacity * self.MAX_LOAD_FACTOR:
+            self.resize_index(self.capacity * 2)
+
+        slot, former_entry = self.find_slot(entry[0])
+
+        INDEX_ENTRY.pack_into(self.index_map, INDEX_HEADER.size + slot * INDEX_ENTRY.size, *entry)
+
+        if former_entry is None:
+            self.num_entries += 1
+
+    """
+        Iterate over the live entries of the index, in no particular order.
+    """
+
+    def iter_entries(self) -> Iterator[Tuple[bytes, int, int, int, int]]:
+
+        for slot in range(self.capacity):
+
+            entry : Tuple[bytes, int, int, int, int] = INDEX_ENTRY.unpack_from(self.index_map, INDEX_HEADER.size + slot * INDEX_ENTRY.size)
+
+            if entry[2]:
+                yield entry
+
+    def resize_index(self, capacity : int, entries : Optional[Iterable[Tuple[bytes, int, int, int, int]]] = None):
+
+        entries = list(self.iter_entries()) if entries is None else entries
+
+        self.write_index(capacity, entries)
+
+        self.index_map.close()
+        self.index_file.close()
+
+        self.open_index()
+
+    """
+        Write a new index file holding the passed entries, and move it in
+        place of the current one.
+    """
+
+    def write_index(self, capacity : int, entries : Iterable[Tuple[bytes, int, int, int, int]]):
+
+        index_data : bytearray = bytearray(INDEX_HEADER.size + capacity * INDEX_ENTRY.size)
+
+        num_entries : int = 0
+
+        for entry in entries:
+
+            slot : int = int.from_bytes(entry[0][:8], 'little') & (capacity - 1)
+
+            while True:
+
+                slot_key, _, slot_length, _, _ = INDEX_ENTRY.unpack_from(index_data, INDEX_HEADER.size + slot * INDEX_ENTRY.size)
+
+                if not slot_length or slot_key == entry[0]:
+                    break
+
+                slot = (slot + 1) & (capacity - 1)
+
+            num_entries += not slot_length
+
+            INDEX_ENTRY.pack_into(index_data, INDEX_HEADER.size + slot * INDEX_ENTRY.size, *entry)
+
+        INDEX_HEADER.pack_into(index_data, 0, INDEX_MAGIC, self.generation, capacity, num_entries, self.data_size)
+
+        with open(self.index_path + '.tmp', 'wb') as index_file:
+            index_file.write(index_data)
+            index_file.flush()
+            fsync(index_file.fileno())
+
+        replace(self.index_path + '.tmp', self.index_path)
+
+    """
+        Scan the data file, yielding (key, signature binary, offset) tuples
+        in the order signatures were appended, including the ones that were
+        replaced since. A truncated last record ends the scan.
+
+        When "verify_crc" is True, ValueError is raised for any signature
+        whose CRC-32 does not match its contents.
+    """
+
+    def scan(self, verify_crc : bool = False) -> Iterator[Tuple[bytes, memoryview, int]]:
+
+        self.data_file.flush()
+
+        offset : int = DATA_HEADER.size
+        data_size : int = getsize(self.data_path)
+
+        while offset + KEY_SIZE + 48 <= data_size:
+
+            header : memoryview = self.get_data_view(offset + KEY_SIZE, 48)
+
+            magic1, checksum, size_minus_header = unpack_from('<III', header)
+
+            if magic1 != 0xcafe2580 or offset + KEY_SIZE + 48 + size_minus_header > data_size:
+                break
+
+            key : bytes = self.get_data_view(offset, KEY_SIZE).tobytes()
+            signature_binary : memoryview = self.get_data_view(offset + KEY_SIZE, 48 + size_minus_header)
+
+            if verify_crc and crc32(signature_binary[8:]) & 0xffffffff != checksum:
+                raise ValueError('Corrupted signature in archive at offset %d' % (offset + KEY_SIZE))
+
+            yield key, signature_binary, offset + KEY_SIZE
+
+            offset += KEY_SIZE + 48 + size_minus_header
+
+    """
+        Iterate over the (hexadecimal key, binary signature) pairs of the
+        archive, in the order signatures were appended.
+    """
+
+    def iter_binaries(self, verify_crc : bool = False) -> Iterator[Tuple[str, memoryview]]:
+
+        for key, signature_binary, offset in self.scan(verify_crc):
+
+            entry = self.find_slot(key)[1]
+
+            if entry is not None and entry[1] == offset: # Not replaced since
+                yield key.hex(), signature_binary
+
+    def iter_signatures(self, columnar : bool = False) -> Iterator[Tuple[str, DecodedMessage]]:
+
+        for key, signature_binary in self.iter_binaries():
+            yield key, DecodedMessage.decode_from_binary(signature_binary, columnar)
+
+    """
+        Rebuild the index from the data file, dropping any truncated or
+        corrupted record at its end.
+    """
+
+    def rebuild_index(self):
+
+        entries : List[Tuple[bytes, int, int, int, int]] = []
+
+        data_size : int = DATA_HEADER.size
+
+        for key, signature_binary, offset in self.scan():
+
+            if crc32(signature_binary[8:]) & 0xffffffff != unpack_from('<I', signature_binary, 4)[0]:
+                break
+
+            entries.append((key, offset, len(signature_binary), *read_signature_header(signature_binary)))
+
+            data_size = offset + len(signature_binary)
+
+        signature_binary = None # Release the mapping before truncating the file
+
+        self.release_data_map()
+
+        self.data_file.truncate(data_size)
+
+        self.data_size = data_size
+
+        capacity : int = self.INITIAL_CAPACITY
+
+        while len(entries) > capacity * self.MAX_LOAD_FACTOR:
+            capacity *= 2
+
+        self.write_index(capacity, entries)
+
+    """
+        Rewrite the archive without the replaced signatures, nor the ones
+        for which "keep" (called with the hexadecimal key and the binary
+        signature) returns False.
+    """
+
+    def compact(self, keep : Optional[Callable[[str, memoryview], bool]] = None):
+
+        if self.read_only:
+            raise PermissionError('The signature archive is opened read-only')
+
+        generation : int = int.from_bytes(urandom(8), 'little')
+
+        entries : List[Tuple[bytes, int, int, int, int]] = []
+
+        with open(self.data_path + '.tmp', 'wb') as data_file:
+
+            data_file.write(DATA_HEADER.pack(DATA_MAGIC, generation))
+
+            offset : int = DATA_HEADER.size
+
+            for key, signature_binary in self.iter_binaries():
+
+                if keep and not keep(key, signature_binary):
+                    continue
+
+                key = bytes.fromhex(key)
+
+                data_file.write(key)
+                data_file.write(signature_binary)
+
+                entries.append((key, offset + KEY_SIZE, len(signature_binary), *read_signature_header(signature_binary)))
+
+                offset += KEY_SIZE + len(signature_binary)
+
+            data_file.flush()
+            fsync(data_file.fileno())
+
+        # The data file is replaced first: should we stop before the index
+        # is, its generation will not match and it will be rebuilt
+
+        signature_binary = None
+
+        self.close()
+
+        replace(self.data_path + '.tmp', self.data_path)
+
+        self.data_file = open(self.data_path, 'r+b')
+        self.generation = generation
+        self.data_size = offset
+
+        capacity : int = self.INITIAL_CAPACITY
+
+        while len(entries) > capacity * self.MAX_LOAD_FACTOR:
+            capacity *= 2
+
+        self.write_index(capacity, entries)
+        self.open_index()
+
+
+"""
+    Convert a key passed as a hexadecimal string to bytes, checking its
+    length.
+"""
+
+def to_key_bytes(key : Union[str, bytes]) -> bytes:
+
+    if isinstance(key, str):
+        key = bytes.fromhex(key)
+
+    if len(key) != KEY_SIZE:
+        raise ValueError('Signature archive keys must be %d-byte digests' % KEY_SIZE)
+
+    return key
+
+
+"""
+    Return the CRC-32 and number of samples of a binary signature, from its
+    header.
+"""
+
+def read_signature_header(signature_binary : Union[bytes, memoryview]) -> Tuple[int, int]:
+
+    header = RawSignatureHeader.from_buffer_copy(signature_binary[:48])
+
+    if header.magic1 != 0xcafe2580:
+        raise ValueError('Not a binary signature')
+
+    sample_rate_hz : int = int(SampleRate(header.shifted_sample_rate_id >> 27).name.strip('_'))
+
+    return header.crc32, int(header.number_samples_plus_divided_sample_rate - sample_rate_hz * 0.24)
@@ -0,0 +1,195 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+from os import makedirs, replace, remove, utime, walk, fdopen
+from os.path import join, getsize, getmtime
+from tempfile import mkstemp
+from hashlib import blake2b
+from json import dumps
+from typing import Dict, List, Tuple, Union, Optional, Any
+from numpy import ascontiguousarray, ndarray, dtype
+from array import array
+
+from signature_format import DecodedMessage
+from algorithm import SignatureGenerator, as_s16le_mono_samples
+
+"""
+    Content-addressed, size-bounded on-disk cache of Shazam signatures (the
+    output of DecodedMessage.encode_to_binary()).
+
+    Entries are keyed by a hash of the decoded 16 KHz PCM samples, plus the
+    SignatureGenerator parameters that influence the signature (such as
+    MAX_TIME_SECONDS and the offset at which the signature starts), so that
+    fingerprinting the same audio again only costs one hash.
+
+    Files are written atomically (so that several processes may share the
+    same directory), and the least recently used ones are evicted when the
+    total size of the cache exceeds "max_size_bytes".
+"""
+
+class SignatureCache:
+
+    def __init__(self, directory : str, max_size_bytes : int = 256 * 1024 * 1024):
+
+        self.directory : str = directory
+        self.max_size_bytes : int = max_size_bytes
+
+        makedirs(directory, exist_ok = True)
+
+        # Only computed on the first put(), as walking a large cache is slow
+
+        self.approximate_size_bytes : Optional[int] = None
+
+    """
+        Hash signed 16-bit mono PCM samples (in any of the formats accepted
+        by SignatureGenerator.feed_input()), without copying them.
+    """
+
+    @staticmethod
+    def hash_samples(s16le_mono_samples : Union[bytes, bytearray, memoryview, array, ndarray, List[int]]) -> str:
+
+        return blake2b(ascontiguousarray(as_s16le_mono_samples(s16le_mono_samples)), digest_size = 20).hexdigest()
+
+    """
+        Build the key of the next signature that the passed generator would
+        return, for an input whose samples hash (see self.hash_samples()) is
+        "input_hash".
+    """
+
+    @staticmethod
+    def make_key(input_hash : str, signature_generator : SignatureGenerator) -> str:
+
+        parameters : Dict[str, Any] = {
+            'max_time_seconds': signature_generator.MAX_TIME_SECONDS,
+            'max_peaks': signature_generator.MAX_PEAKS,
+            'dtype': dtype(signature_generator.dtype).name,
+            'rolling_window_mode': signature_generator.ROLLING_WINDOW_MODE,
+            'rolling_window_step_seconds': signature_generator.ROLLING_WINDOW_STEP_SECONDS,
+            'start_offset': signature_generator.get_next_signature_offset()
+        }
+
+        if signature_generator.ROLLING_WINDOW_MODE:
+            parameters['peak_stream_first_sample'] = signature_generator.peak_stream.first_sample if signature_generator.peak_stream else signature_generator.samples_processed
+
+        return blake2b((input_hash + dumps(parameters, sort_keys = True)).encode('ascii'), digest_size = 20).hexdigest()
+
+    def get_path(self, key : str) -> str:
+
+        return join(self.directory, key[:2], key + '.sig')
+
+    def get(self, key : str) -> Optional[bytes]:
+
+        try:
+            with open(self.get_path(key), 'rb') as cache_file:
+                signature_binary : bytes = cache_file.read()
+
+            utime(self.get_path(key)) # Mark the entry as recently used
+
+        except FileNotFoundError:
+            return None
+
+        return signature_binary
+
+    def put(self, key : str, signature_binary : bytes):
+
+        if self.approximate_size_bytes is None:
+            self.approximate_size_bytes = sum(size for modification_time, size, path in self.list_entries())
+
+        makedirs(join(self.directory, key[:2]), exist_ok = True)
+
+        try:
+            replaced_size : int = getsize(self.get_path(key)) # Entry written again, or by another process
+        except FileNotFoundError:
+            replaced_size = 0
+
+        # Write to a temporary file of the same directory first, then move it
+        # in place, so that readers never see a partially written entry
+
+        temporary_file_descriptor, temporary_path = mkstemp(dir = join(self.directory, key[:2]), suffix = '.tmp')
+
+        try:
+            with fdopen(temporary_file_descriptor, 'wb') as temporary_file:
+                temporary_file.write(signature_binary)
+
+            replace(temporary_path, self.get_path(key))
+
+        except BaseException:
+            remove(temporary_path)
+            raise
+
+        self.approximate_size_bytes += len(signature_binary) - replaced_size
+
+        if self.approximate_size_bytes > self.max_size_bytes:
+            self.evict()
+
+    def list_entries(self) -> List[Tuple[float, int, str]]:
+
+        entries : List[Tuple[float, int, str]] = []
+
+        for directory_path, _, file_names in walk(self.directory):
+
+            for file_name in file_names:
+
+                if not file_name.endswith('.sig'):
+                    continue
+
+                try:
+                    entries.append((getmtime(join(directory_path, file_name)), getsize(join(directory_path, file_name)), join(directory_path, file_name)))
+                except FileNotFoundError: # Evicted by another process
+                    pass
+
+        return entries
+
+    """
+        Remove the least recently used entries, until the cache is back to
+        90% of its maximal size.
+    """
+
+    def evict(self):
+
+        entries : List[Tuple[float, int, str]] = sorted(self.list_entries())
+
+        self.approximate_size_bytes = sum(size for modification_time, size, path in entries)
+
+        for modification_time, size, path in entries:
+
+            if self.approximate_size_bytes <= self.max_size_bytes * 0.9:
+                break
+
+            try:
+                remove(path)
+            except FileNotFoundError:
+                pass
+
+            self.approximate_size_bytes -= size
+
+    """
+        Cached equivalent of signature_generator.get_next_signature(), for a
+        generator fed with an input whose samples hash is "input_hash".
+    """
+
+    def get_next_signature(self, signature_generator : SignatureGenerator, input_hash : str) -> Optional[DecodedMessage]:
+
+        key : str = self.make_key(input_hash, signature_generator)
+
+        signature_binary : Optional[bytes] = self.get(key)
+
+        if signature_binary is not None:
+
+            try:
+                signature : DecodedMessage = DecodedMessage.decode_from_binary(signature_binary)
+
+            except Exception: # Corrupted entry, generate it again
+                signature = None
+
+            if signature is not None:
+
+                signature_generator.skip_next_signature(signature.number_samples)
+
+                return signature
+
+        signature : Optional[DecodedMessage] = signature_generator.get_next_signature()
+
+        if signature is not None:
+            self.put(key, signature.encode_to_binary())
+
+        return signature
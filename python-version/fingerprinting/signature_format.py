@@ -1,15 +1,30 @@
 #!/usr/bin/python3
 #-*- encoding: Utf-8 -*-
-from typing import Dict, List, Set, Sequence, Union, Any
+from typing import Dict, List, Set, Sequence, Tuple, Union, Iterator, Any
 from base64 import b64decode, b64encode
 from math import log, exp, sqrt
 from binascii import crc32
 from enum import IntEnum
-from io import BytesIO
 from ctypes import *
+from struct import pack, unpack_from
+from itertools import repeat
+from functools import lru_cache
+from numpy import array as nparray, asarray, dtype, frombuffer, zeros, cumsum, diff, where, arange, uint8, uint16, uint32, int64, ndarray
+from numpy import maximum as npmaximum
 
 DATA_URI_PREFIX = 'data:audio/vnd.shazam.sig;base64,'
 
+# Every frequency peak is stored as a 5-byte record, optionally preceded
+# by a 5-byte record holding its absolute FFT pass number (marked with a
+# 0xff FFT pass offset) when it is 255 or more passes after the previous
+# peak of the band, so that peak lists can be parsed as NumPy arrays of
+# records
+
+PEAK_RECORD_DTYPE = dtype([('fft_pass_offset', uint8), ('peak_magnitude', '<u2'), ('corrected_peak_frequency_bin', '<u2')])
+FFT_PASS_NUMBER_RECORD_DTYPE = dtype([('fft_pass_offset', uint8), ('fft_pass_number', '<u4')])
+
+assert PEAK_RECORD_DTYPE.itemsize == FFT_PASS_NUMBER_RECORD_DTYPE.itemsize == 5
+
 class SampleRate(IntEnum): # Enum keys are sample rates in Hz
     
     _8000 = 1
@@ -47,10 +62,12 @@ class RawSignatureHeader(LittleEndianStructure):
 
 class FrequencyPeak:
     
-    fft_pass_number : int = None
-    peak_magnitude : int = None
-    corrected_peak_frequency_bin : int = None
-    sample_rate_hz : int = None
+    __slots__ = ('fft_pass_number', 'peak_magnitude', 'corrected_peak_frequency_bin', 'sample_rate_hz')
+    
+    fft_pass_number : int
+    peak_magnitude : int
+    corrected_peak_frequency_bin : int
+    sample_rate_hz : int
     
     def __init__(self, fft_pass_number : int, peak_magnitude : int, corrected_peak_frequency_bin : int, sample_rate_hz : int):
         
@@ -80,8 +97,86 @@ class FrequencyPeak:
         
         # ^ Assume that new FFT bins are emitted every 128 samples, on a
         # standard 16 KHz sample rate basis.
+
+
+"""
+    Columnar storage for the frequency peaks of a band: one NumPy array per
+    field (8 bytes per peak in total), instead of one FrequencyPeak object
+    per peak.
+    
+    It can be used in place of a list of FrequencyPeak objects within
+    DecodedMessage.frequency_band_to_sound_peaks: indexing or iterating
+    over it builds FrequencyPeak objects on demand. Derived values are
+    available as whole columns, equal to what the FrequencyPeak methods
+    return.
+"""
+
+class FrequencyPeakColumns:
+    
+    def __init__(self, fft_pass_numbers : Sequence[int], peak_magnitudes : Sequence[int], corrected_peak_frequency_bins : Sequence[int], sample_rate_hz : int):
+        
+        self.fft_pass_numbers : ndarray = asarray(fft_pass_numbers, dtype = uint32)
+        self.peak_magnitudes : ndarray = asarray(peak_magnitudes, dtype = uint16)
+        self.corrected_peak_frequency_bins : ndarray = asarray(corrected_peak_frequency_bins, dtype = uint16)
+        self.sample_rate_hz : int = sample_rate_hz
+    
+    @classmethod
+    def from_peaks(cls, frequency_peaks : Sequence[FrequencyPeak], sample_rate_hz : int):
         
+        if isinstance(frequency_peaks, cls):
+            return frequency_peaks
         
+        return cls(
+            [frequency_peak.fft_pass_number for frequency_peak in frequency_peaks],
+            [frequency_peak.peak_magnitude for frequency_peak in frequency_peaks],
+            [frequency_peak.corrected_peak_frequency_bin for frequency_peak in frequency_peaks],
+            sample_rate_hz
+        )
+    
+    def __len__(self) -> int:
+        
+        return len(self.fft_pass_numbers)
+    
+    def __getitem__(self, index : Any) -> Any: # FrequencyPeak for an integer index, FrequencyPeakColumns for a slice
+        
+        if isinstance(index, slice):
+            return FrequencyPeakColumns(self.fft_pass_numbers[index], self.peak_magnitudes[index],
+                self.corrected_peak_frequency_bins[index], self.sample_rate_hz)
+        
+        return FrequencyPeak(int(self.fft_pass_numbers[index]), int(self.peak_magnitudes[index]),
+            int(self.corrected_peak_frequency_bins[index]), self.sample_rate_hz)
+    
+    def __iter__(self) -> Iterator[FrequencyPeak]:
+        
+        return map(FrequencyPeak, self.fft_pass_numbers.tolist(), self.peak_magnitudes.tolist(),
+            self.corrected_peak_frequency_bins.tolist(), repeat(self.sample_rate_hz))
+    
+    def get_frequencies_hz(self) -> ndarray:
+        
+        return self.corrected_peak_frequency_bins * (self.sample_rate_hz / 2 / 1024 / 64)
+    
+    def get_amplitudes_pcm(self) -> ndarray:
+        
+        return get_amplitude_pcm_table()[self.peak_magnitudes]
+    
+    def get_seconds(self) -> ndarray:
+        
+        return (self.fft_pass_numbers.astype(int64) * 128) / self.sample_rate_hz
+
+
+"""
+    FrequencyPeak.get_amplitude_pcm() for every possible (16-bit) peak
+    magnitude, computed once with the same floating-point operations (the
+    exponential of NumPy may differ from the one of the math module in the
+    last bit).
+"""
+
+@lru_cache(maxsize = None)
+def get_amplitude_pcm_table() -> ndarray:
+    
+    return nparray([sqrt(exp((peak_magnitude - 6144) / 1477.3) * (1 << 17) / 2) / 1024 for peak_magnitude in range(1 << 16)])
+
+
 
 class DecodedMessage:
     
@@ -90,25 +185,26 @@ class DecodedMessage:
     
     frequency_band_to_sound_peaks : Dict[FrequencyBand, List[FrequencyPeak]] = None
     
+    """
+        Passing "columnar = True" stores the peaks of every band as a
+        FrequencyPeakColumns object, rather than as a list of FrequencyPeak
+        objects.
+    """
+    
     @classmethod
-    def decode_from_binary(cls, data : bytes):
+    def decode_from_binary(cls, data : bytes, columnar : bool = False):
         
         self = cls()
-
-        buf = BytesIO(data)
         
-        buf.seek(8)
-        checksummable_data = buf.read()
-        buf.seek(0)
+        data = memoryview(data).cast('B') # Avoid copies when slicing
         
         # Read and check the header
         
-        header = RawSignatureHeader()
-        buf.readinto(header)
+        header = RawSignatureHeader.from_buffer_copy(data[:48])
         
         assert header.magic1 == 0xcafe2580
         assert header.size_minus_header == len(data) - 48
-        assert crc32(checksummable_data) & 0xffffffff == header.crc32
+        assert crc32(data[8:]) & 0xffffffff == header.crc32
         assert header.magic2 == 0x94119c00
         
         self.sample_rate_hz = int(SampleRate(header.shifted_sample_rate_id >> 27).name.strip('_'))
@@ -119,66 +215,57 @@ class DecodedMessage:
         
         # The first chunk is fixed and has no value, but instead just repeats
         # the length of the message size minus the header:
-        assert int.from_bytes(buf.read(4), 'little') == 0x40000000
-        assert int.from_bytes(buf.read(4), 'little') == len(data) - 48
+        assert unpack_from('<II', data, 48) == (0x40000000, len(data) - 48)
         
         # Then, lists of frequency peaks for respective bands follow
         
         self.frequency_band_to_sound_peaks = {}
         
-        while True:
-            
-            tlv_header = buf.read(8)
-            if not tlv_header:
-                break
+        position : int = 56
+        
+        while position < len(data):
             
-            frequency_band_id = int.from_bytes(tlv_header[:4], 'little')
-            frequency_peaks_size = int.from_bytes(tlv_header[4:], 'little')
+            frequency_band_id, frequency_peaks_size = unpack_from('<II', data, position)
             
-            frequency_peaks_padding = -frequency_peaks_size % 4
+            frequency_peaks_data = data[position + 8:position + 8 + frequency_peaks_size]
             
-            frequency_peaks_buf = BytesIO(buf.read(frequency_peaks_size))
-            buf.read(frequency_peaks_padding)
+            position += 8 + frequency_peaks_size + (-frequency_peaks_size % 4)
             
             # Decode frequency peaks
             
             frequency_band = FrequencyBand(frequency_band_id - 0x60030040)
             
-            fft_pass_number = 0
+            fft_pass_numbers, peak_magnitudes, corrected_peak_frequency_bins = decode_frequency_peaks(frequency_peaks_data)
             
-            self.frequency_band_to_sound_peaks[frequency_band] = []
+            frequency_peak_columns = FrequencyPeakColumns(fft_pass_numbers, peak_magnitudes, corrected_peak_frequency_bins, self.sample_rate_hz)
             
-            while True:
-                
-                raw_fft_pass : bytes = frequency_peaks_buf.read(1)
-                if not raw_fft_pass:
-                    break
-                
-                fft_pass_offset : int = raw_fft_pass[0]
-                if fft_pass_offset == 0xff:
-                    fft_pass_number = int.from_bytes(frequency_peaks_buf.read(4), 'little')
-                    continue
-                else:
-                    fft_pass_number += fft_pass_offset
-                
-                peak_magnitude = int.from_bytes(frequency_peaks_buf.read(2), 'little')
-                corrected_peak_frequency_bin = int.from_bytes(frequency_peaks_buf.read(2), 'little')
-                
-                self.frequency_band_to_sound_peaks[frequency_band].append(
-                    FrequencyPeak(fft_pass_number, peak_magnitude, corrected_peak_frequency_bin, self.sample_rate_hz)
-                )
-                
-                
-        
+            self.frequency_band_to_sound_peaks[frequency_band] = frequency_peak_columns if columnar else list(frequency_peak_columns)
         
         return self
     
     @classmethod
-    def decode_from_uri(cls, uri : str):
+    def decode_from_uri(cls, uri : str, columnar : bool = False):
         
         assert uri.startswith(DATA_URI_PREFIX)
         
-        return cls.decode_from_binary(b64decode(uri.replace(DATA_URI_PREFIX, '', 1)))
+        return cls.decode_from_binary(b64decode(uri.replace(DATA_URI_PREFIX, '', 1)), columnar)
+    
+    """
+        Return a copy of the current object whose peaks are stored as
+        FrequencyPeakColumns objects.
+    """
+    
+    def to_columnar(self) -> 'DecodedMessage':
+        
+        message = DecodedMessage()
+        message.sample_rate_hz = self.sample_rate_hz
+        message.number_samples = self.number_samples
+        message.frequency_band_to_sound_peaks = {
+            frequency_band: FrequencyPeakColumns.from_peaks(frequency_peaks, self.sample_rate_hz)
+            for frequency_band, frequency_peaks in self.frequency_band_to_sound_peaks.items()
+        }
+        
+        return message
     
     """
         Encode the current object to a readable JSON format, for debugging
@@ -187,6 +274,8 @@ class DecodedMessage:
     
     def encode_to_json(self) -> dict:
         
+        frequency_band_to_peak_columns : Dict[FrequencyBand, FrequencyPeakColumns] = self.to_columnar().frequency_band_to_sound_peaks
+        
         return {
             "sample_rate_hz": self.sample_rate_hz,
             "number_samples": self.number_samples,
@@ -194,16 +283,23 @@ class DecodedMessage:
             "frequency_band_to_peaks": {
                 frequency_band.name.strip('_'): [
                     {
-                        "fft_pass_number": frequency_peak.fft_pass_number,
-                        "peak_magnitude": frequency_peak.peak_magnitude,
-                        "corrected_peak_frequency_bin": frequency_peak.corrected_peak_frequency_bin,
-                        "_frequency_hz": frequency_peak.get_frequency_hz(),
-                        "_amplitude_pcm": frequency_peak.get_amplitude_pcm(),
-                        "_seconds": frequency_peak.get_seconds()
+                        "fft_pass_number": fft_pass_number,
+                        "peak_magnitude": peak_magnitude,
+                        "corrected_peak_frequency_bin": corrected_peak_frequency_bin,
+                        "_frequency_hz": frequency_hz,
+                        "_amplitude_pcm": amplitude_pcm,
+                        "_seconds": seconds
                     }
-                    for frequency_peak in frequency_peaks
+                    for fft_pass_number, peak_magnitude, corrected_peak_frequency_bin, frequency_hz, amplitude_pcm, seconds in zip(
+                        peak_columns.fft_pass_numbers.tolist(),
+                        peak_columns.peak_magnitudes.tolist(),
+                        peak_columns.corrected_peak_frequency_bins.tolist(),
+                        peak_columns.get_frequencies_hz().tolist(),
+                        peak_columns.get_amplitudes_pcm().tolist(),
+                        peak_columns.get_seconds().tolist()
+                    )
                 ]
-                for frequency_band, frequency_peaks in sorted(self.frequency_band_to_sound_peaks.items())
+                for frequency_band, peak_columns in sorted(frequency_band_to_peak_columns.items())
             }
         }
     
@@ -217,61 +313,35 @@ class DecodedMessage:
         header.fixed_value = ((15 << 19) + 0x40000)
         header.number_samples_plus_divided_sample_rate = int(self.number_samples + self.sample_rate_hz * 0.24)
         
-        contents_buf = BytesIO()
+        contents : List[bytes] = []
         
         for frequency_band, frequency_peaks in sorted(self.frequency_band_to_sound_peaks.items()):
-        
-            peaks_buf = BytesIO()
-        
-            fft_pass_number = 0
-                    
+            
             # NOTE: Correctly filtering and sorting the peaks within the members
             # of "self.frequency_band_to_sound_peaks" is the responsability of the
             # caller
-                    
-            for frequency_peak in frequency_peaks:
-                
-                assert frequency_peak.fft_pass_number >= fft_pass_number
-                
-                if frequency_peak.fft_pass_number - fft_pass_number >= 255:
-                    
-                    peaks_buf.write(b'\xff')
-                    peaks_buf.write((frequency_peak.fft_pass_number).to_bytes(4, 'little'))
-                    
-                    fft_pass_number = frequency_peak.fft_pass_number
-                
-                peaks_buf.write(bytes([frequency_peak.fft_pass_number - fft_pass_number]))
-                peaks_buf.write((frequency_peak.peak_magnitude).to_bytes(2, 'little'))
-                peaks_buf.write((frequency_peak.corrected_peak_frequency_bin).to_bytes(2, 'little'))
-                
-                fft_pass_number = frequency_peak.fft_pass_number
-                
-
-            contents_buf.write((0x60030040 + int(frequency_band)).to_bytes(4, 'little'))
-            contents_buf.write(len(peaks_buf.getvalue()).to_bytes(4, 'little'))
-            contents_buf.write(peaks_buf.getvalue())
-            contents_buf.write(b'\x00' * (-len(peaks_buf.getvalue()) % 4))
-        
-        
-        # Below, write the full message as a binary stream
+            
+            if isinstance(frequency_peaks, FrequencyPeakColumns):
+                peaks_data : bytes = encode_frequency_peak_columns(frequency_peaks)
+            else:
+                peaks_data : bytes = encode_frequency_peaks(frequency_peaks)
+            
+            contents.append(pack('<II', 0x60030040 + int(frequency_band), len(peaks_data)))
+            contents.append(peaks_data)
+            contents.append(b'\x00' * (-len(peaks_data) % 4))
         
-        header.size_minus_header = len(contents_buf.getvalue()) + 8
+        contents_data : bytes = b''.join(contents)
         
-        buf = BytesIO()
-        buf.write(bytes(header)) # We will rewrite it just after in order to include the final CRC-32
+        # Below, write the full message, the header including the CRC-32 of
+        # everything that follows its first 8 bytes
         
-        buf.write((0x40000000).to_bytes(4, 'little'))
-        buf.write((len(contents_buf.getvalue()) + 8).to_bytes(4, 'little'))
+        header.size_minus_header = len(contents_data) + 8
         
-        buf.write(contents_buf.getvalue())
+        message_data : bytes = pack('<II', 0x40000000, len(contents_data) + 8) + contents_data
         
-        buf.seek(8)
-        header.crc32 = crc32(buf.read()) & 0xffffffff
-        buf.seek(0)
-        buf.write(bytes(header))
+        header.crc32 = crc32(message_data, crc32(memoryview(header).cast('B')[8:])) & 0xffffffff
         
-
-        return buf.getvalue()
+        return bytes(header) + message_data
         
     
     def encode_to_uri(self) -> str:
@@ -281,3 +351,110 @@ class DecodedMessage:
 
 
 
+
+
+
+"""
+    Parse the peak records of a frequency band, returning the FFT pass
+    numbers, magnitudes and corrected frequency bins of the peaks as NumPy
+    arrays.
+    
+    The FFT pass number of a peak is the absolute value held by the last
+    0xff-marked record before it (or 0), plus the offsets of the peak
+    records since then: this is computed with cumulative sums over the
+    whole band at once.
+"""
+
+def decode_frequency_peaks(peaks_data : bytes) -> Tuple[ndarray, ndarray, ndarray]:
+    
+    assert len(peaks_data) % 5 == 0
+    
+    peak_records : ndarray = frombuffer(peaks_data, dtype = PEAK_RECORD_DTYPE)
+    
+    is_fft_pass_number : ndarray = peak_records['fft_pass_offset'] == 0xff
+    
+    fft_pass_offsets : ndarray = where(is_fft_pass_number, 0, peak_records['fft_pass_offset']).astype(int64)
+    offsets_sums : ndarray = cumsum(fft_pass_offsets)
+    
+    absolute_fft_pass_numbers : ndarray = where(is_fft_pass_number, frombuffer(peaks_data, dtype = FFT_PASS_NUMBER_RECORD_DTYPE)['fft_pass_number'], 0).astype(int64)
+    
+    # Index of the last 0xff-marked record up to every record (or -1)
+    
+    last_absolute_record : ndarray = npmaximum.accumulate(where(is_fft_pass_number, arange(len(peak_records)), -1))
+    
+    fft_pass_numbers : ndarray = where(last_absolute_record >= 0,
+        absolute_fft_pass_numbers[last_absolute_record] + offsets_sums - offsets_sums[last_absolute_record],
+        offsets_sums
+    )
+    
+    is_peak : ndarray = ~is_fft_pass_number
+    
+    return fft_pass_numbers[is_peak], peak_records['peak_magnitude'][is_peak], peak_records['corrected_peak_frequency_bin'][is_peak]
+
+
+"""
+    Emit the peak records of a frequency band (see decode_frequency_peaks())
+    with a single struct.pack() call, from peaks sorted by FFT pass number.
+"""
+
+def encode_frequency_peaks(frequency_peaks : List[FrequencyPeak]) -> bytes:
+    
+    record_formats : List[str] = ['<']
+    record_values : List[int] = []
+    
+    fft_pass_number : int = 0
+    
+    for frequency_peak in frequency_peaks:
+        
+        fft_pass_offset : int = frequency_peak.fft_pass_number - fft_pass_number
+        
+        assert fft_pass_offset >= 0
+        
+        if fft_pass_offset >= 255:
+            
+            record_formats.append('BI')
+            record_values += (0xff, frequency_peak.fft_pass_number)
+            
+            fft_pass_offset = 0
+        
+        record_formats.append('BHH')
+        record_values += (fft_pass_offset, frequency_peak.peak_magnitude, frequency_peak.corrected_peak_frequency_bin)
+        
+        fft_pass_number = frequency_peak.fft_pass_number
+    
+    return pack(''.join(record_formats), *record_values)
+
+
+"""
+    Columnar equivalent of encode_frequency_peaks(), where the records that
+    precede the peaks too far from the previous one (which is the only
+    FFT pass number an offset is relative to) are placed with cumulative
+    sums.
+"""
+
+def encode_frequency_peak_columns(frequency_peak_columns : FrequencyPeakColumns) -> bytes:
+    
+    fft_pass_numbers : ndarray = frequency_peak_columns.fft_pass_numbers.astype(int64)
+    
+    fft_pass_offsets : ndarray = diff(fft_pass_numbers, prepend = 0)
+    
+    assert (fft_pass_offsets >= 0).all()
+    
+    needs_fft_pass_number : ndarray = fft_pass_offsets >= 255
+    
+    peak_record_indexes : ndarray = arange(len(fft_pass_offsets)) + cumsum(needs_fft_pass_number)
+    fft_pass_number_record_indexes : ndarray = peak_record_indexes[needs_fft_pass_number] - 1
+    
+    records_data : ndarray = zeros((len(fft_pass_offsets) + len(fft_pass_number_record_indexes)) * 5, dtype = uint8)
+    
+    peak_records : ndarray = records_data.view(PEAK_RECORD_DTYPE)
+    fft_pass_number_records : ndarray = records_data.view(FFT_PASS_NUMBER_RECORD_DTYPE)
+    
+    peak_records['fft_pass_offset'][peak_record_indexes] = where(needs_fft_pass_number, 0, fft_pass_offsets)
+    peak_records['peak_magnitude'][peak_record_indexes] = frequency_peak_columns.peak_magnitudes
+    peak_records['corrected_peak_frequency_bin'][peak_record_indexes] = frequency_peak_columns.corrected_peak_frequency_bins
+    
+    fft_pass_number_records['fft_pass_offset'][fft_pass_number_record_indexes] = 0xff
+    fft_pass_number_records['fft_pass_number'][fft_pass_number_record_indexes] = fft_pass_numbers[needs_fft_pass_number]
+    
+    return records_data.tobytes()
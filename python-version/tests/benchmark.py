@@ -0,0 +1,301 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+from os.path import dirname, realpath, exists
+from argparse import ArgumentParser
+from hashlib import sha256
+from json import load, dump, dumps
+from time import perf_counter
+from resource import getrusage, RUSAGE_SELF
+from typing import Dict, List, Callable, Any
+from numpy import arange, zeros, sin, pi, cumsum, clip, int16, uint32, float64, ndarray
+import tracemalloc
+
+TESTS_DIR = realpath(dirname(__file__))
+
+ROOT_DIR = realpath(TESTS_DIR + '/..')
+FINGERPRINTING_DIR = realpath(ROOT_DIR + '/fingerprinting')
+
+import sys
+sys.path.append(FINGERPRINTING_DIR)
+
+from signature_format import DecodedMessage
+from algorithm import SignatureGenerator, SignatureGeneratorStats
+
+"""
+    Benchmark suite for the fingerprinting code: run SignatureGenerator,
+    DecodedMessage.encode_to_binary()/decode_from_binary() and encode_to_uri()
+    over deterministic synthetic audio of several kinds and lengths, report
+    throughput, per-stage time and memory usage, and check that the generated
+    signatures are byte-identical to stored golden outputs.
+
+    Sample usage:
+
+        ./benchmark.py --save-baseline baseline.json # Before a change
+        ./benchmark.py --compare-baseline baseline.json # After it
+
+    Use --update-golden only when the signatures are meant to change.
+"""
+
+GOLDEN_OUTPUTS_PATH = TESTS_DIR + '/benchmark_golden.json'
+
+SAMPLE_RATE = 16000
+
+SIGNAL_LENGTHS_SECONDS = [3, 14, 60]
+
+STAGE_METHOD_NAMES : Dict[str, List[str]] = {
+    'fft': ['do_fft', 'do_fft_batch'],
+    'peak_spreading': ['do_peak_spreading'],
+    'peak_recognition': ['do_peak_recognition']
+}
+
+
+"""
+    Deterministic pseudo-random noise, obtained by hashing the sample
+    indexes with integer operations only (so that it does not depend on
+    the random generators of NumPy).
+"""
+
+def generate_noise(num_samples : int, seed : int = 0) -> ndarray:
+
+    values : ndarray = arange(num_samples, dtype = uint32) * uint32(0x9e3779b1) + uint32(seed)
+
+    values ^= values >> uint32(15)
+    values *= uint32(0x2c1b3c6d)
+    values ^= values >> uint32(12)
+    values *= uint32(0x297a2d39)
+    values ^= values >> uint32(15)
+
+    return (values >> uint32(16)).astype(int16) # Uniform over the 16-bit range
+
+
+def generate_tone(num_samples : int) -> ndarray:
+
+    times : ndarray = arange(num_samples) / SAMPLE_RATE
+
+    return (sin(2 * pi * 440 * times) * 8000 + sin(2 * pi * 1320 * times) * 4000).astype(int16)
+
+
+def generate_silence(num_samples : int) -> ndarray:
+
+    return zeros(num_samples, dtype = int16)
+
+
+"""
+    Music-like signal: a sequence of short notes with harmonics, over a
+    slowly sweeping chirp and some quiet noise.
+"""
+
+def generate_chirps(num_samples : int) -> ndarray:
+
+    times : ndarray = arange(num_samples) / SAMPLE_RATE
+
+    note_frequencies : ndarray = 220 * 2 ** ((generate_noise(num_samples // 4000 + 1, seed = 1).astype(float64) + 32768) // 2731 / 12)
+    frequencies : ndarray = note_frequencies[arange(num_samples) // 4000]
+    phases : ndarray = 2 * pi * cumsum(frequencies) / SAMPLE_RATE
+    envelope : ndarray = 1 - (arange(num_samples) % 4000) / 4000
+
+    signal : ndarray = envelope * (sin(phases) * 6000 + sin(2 * phases) * 3000 + sin(3 * phases) * 1500)
+    signal += sin(2 * pi * (300 + 20 * times) * times) * 2000
+    signal += generate_noise(num_samples, seed = 2) / 64
+
+    return clip(signal, -32768, 32767).astype(int16)
+
+
+SIGNAL_GENERATORS : Dict[str, Callable[[int], ndarray]] = {
+    'tone': generate_tone,
+    'noise': generate_noise,
+    'silence': generate_silence,
+    'chirps': generate_chirps
+}
+
+
+def generate_signatures(samples : ndarray, stage_times : Dict[str, float] = None) -> List[DecodedMessage]:
+
+    signature_generator = SignatureGenerator()
+
+    if stage_times is not None:
+        stats : SignatureGeneratorStats = signature_generator.enable_stats()
+
+    signature_generator.feed_input(samples)
+
+    signatures : List[DecodedMessage] = list(iter(signature_generator.get_next_signature, None))
+
+    if stage_times is not None:
+        for stage_name, method_names in STAGE_METHOD_NAMES.items():
+            stage_times[stage_name] += sum(stats.stage_seconds.get(method_name, 0) for method_name in method_names)
+
+    return signatures
+
+
+def run_case(signal_kind : str, length_seconds : int, repeats : int) -> Dict[str, Any]:
+
+    samples : ndarray = SIGNAL_GENERATORS[signal_kind](length_seconds * SAMPLE_RATE)
+
+    # Signature generation
+
+    stage_times : Dict[str, float] = {'fft': 0, 'peak_spreading': 0, 'peak_recognition': 0}
+
+    start_time : float = perf_counter()
+
+    for repeat in range(repeats):
+        signatures : List[DecodedMessage] = generate_signatures(samples, stage_times)
+
+    generation_time : float = (perf_counter() - start_time) / repeats
+
+    # Signature encoding and decoding
+
+    start_time = perf_counter()
+
+    for repeat in range(repeats):
+        signature_binaries : List[bytes] = [signature.encode_to_binary() for signature in signatures]
+
+    encoding_time : float = (perf_counter() - start_time) / repeats
+
+    start_time = perf_counter()
+
+    for repeat in range(repeats):
+        decoded_signatures : List[DecodedMessage] = [DecodedMessage.decode_from_binary(signature_binary) for signature_binary in signature_binaries]
+
+    decoding_time : float = (perf_counter() - start_time) / repeats
+
+    start_time = perf_counter()
+
+    for repeat in range(repeats):
+        signature_uris : List[str] = [signature.encode_to_uri() for signature in signatures]
+
+    uri_encoding_time : float = (perf_counter() - start_time) / repeats
+
+    assert [signature.encode_to_binary() for signature in decoded_signatures] == signature_binaries
+
+    # Memory usage (in a separate, untimed run)
+
+    tracemalloc.start()
+    generate_signatures(samples)
+    traced_peak_bytes : int = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'num_samples': len(samples),
+        'num_signatures': len(signatures),
+        'num_peaks': sum(len(peaks) for signature in signatures for peaks in signature.frequency_band_to_sound_peaks.values()),
+        'samples_per_second': len(samples) / generation_time,
+        'generation_seconds': generation_time,
+        'stage_seconds': {stage_name: stage_time / repeats for stage_name, stage_time in stage_times.items()},
+        'encode_to_binary_seconds': encoding_time,
+        'decode_from_binary_seconds': decoding_time,
+        'encode_to_uri_seconds': uri_encoding_time,
+        'traced_peak_bytes': traced_peak_bytes,
+        'signature_hashes': [sha256(signature_binary).hexdigest() for signature_binary in signature_binaries]
+    }
+
+
+def run_benchmark(lengths_seconds : List[int], repeats : int) -> Dict[str, Dict[str, Any]]:
+
+    results : Dict[str, Dict[str, Any]] = {}
+
+    for signal_kind in SIGNAL_GENERATORS:
+
+        for length_seconds in lengths_seconds:
+
+            case_name : str = '%s-%ds' % (signal_kind, length_seconds)
+
+            results[case_name] = run_case(signal_kind, length_seconds, repeats)
+
+            print('%-12s %9.0f samples/s (fft %.3fs, spreading %.3fs, recognition %.3fs) - encode %.2fms, decode %.2fms, uri %.2fms - %5.1f MB traced peak' % (
+                case_name,
+                results[case_name]['samples_per_second'],
+                results[case_name]['stage_seconds']['fft'],
+                results[case_name]['stage_seconds']['peak_spreading'],
+                results[case_name]['stage_seconds']['peak_recognition'],
+                results[case_name]['encode_to_binary_seconds'] * 1000,
+                results[case_name]['decode_from_binary_seconds'] * 1000,
+                results[case_name]['encode_to_uri_seconds'] * 1000,
+                results[case_name]['traced_peak_bytes'] / 1024 / 1024
+            ))
+
+    print('Peak RSS: %.1f MB' % (getrusage(RUSAGE_SELF).ru_maxrss / 1024))
+
+    return results
+
+
+"""
+    Return the names of the cases whose signatures differ from the golden
+    outputs (cases without golden outputs are ignored).
+"""
+
+def check_golden_outputs(results : Dict[str, Dict[str, Any]], golden_outputs : Dict[str, List[str]]) -> List[str]:
+
+    return [
+        case_name for case_name, case_results in results.items()
+        if case_name in golden_outputs and case_results['signature_hashes'] != golden_outputs[case_name]
+    ]
+
+
+def compare_to_baseline(results : Dict[str, Dict[str, Any]], baseline : Dict[str, Dict[str, Any]]):
+
+    for case_name, case_results in results.items():
+
+        if case_name not in baseline:
+            continue
+
+        print('%-12s %.2fx speed of the baseline for generation, %.2fx for encoding, %.2fx for decoding' % (
+            case_name,
+            baseline[case_name]['generation_seconds'] / case_results['generation_seconds'],
+            baseline[case_name]['encode_to_binary_seconds'] / max(case_results['encode_to_binary_seconds'], 1e-9),
+            baseline[case_name]['decode_from_binary_seconds'] / max(case_results['decode_from_binary_seconds'], 1e-9)
+        ))
+
+
+if __name__ == '__main__':
+
+    args = ArgumentParser(description = 'Benchmark the generation, encoding ' +
+        'and decoding of Shazam signatures over synthetic audio, and check ' +
+        'the generated signatures against golden outputs.')
+
+    args.add_argument('--lengths', type = int, nargs = '+', default = SIGNAL_LENGTHS_SECONDS, help = 'The ' +
+        'lengths of the synthetic signals, in seconds.')
+
+    args.add_argument('--repeats', type = int, default = 3, help = 'The ' +
+        'number of timed runs to average over.')
+
+    args.add_argument('--save-baseline', help = 'A JSON file where to save the results.')
+
+    args.add_argument('--compare-baseline', help = 'A JSON file of results saved ' +
+        'with --save-baseline, to compare the current results to.')
+
+    args.add_argument('--update-golden', action = 'store_true', help = 'Store ' +
+        'the generated signatures as the new golden outputs.')
+
+    args = args.parse_args()
+
+    results : Dict[str, Dict[str, Any]] = run_benchmark(args.lengths, args.repeats)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            dump(results, baseline_file, indent = 4)
+
+    if args.compare_baseline:
+        with open(args.compare_baseline) as baseline_file:
+            compare_to_baseline(results, load(baseline_file))
+
+    golden_outputs : Dict[str, List[str]] = {}
+
+    if exists(GOLDEN_OUTPUTS_PATH):
+        with open(GOLDEN_OUTPUTS_PATH) as golden_outputs_file:
+            golden_outputs = load(golden_outputs_file)
+
+    if args.update_golden:
+
+        golden_outputs.update({case_name: case_results['signature_hashes'] for case_name, case_results in results.items()})
+
+        with open(GOLDEN_OUTPUTS_PATH, 'w') as golden_outputs_file:
+            dump(golden_outputs, golden_outputs_file, indent = 4, sort_keys = True)
+            golden_outputs_file.write('\n')
+
+    mismatching_cases : List[str] = check_golden_outputs(results, golden_outputs)
+
+    if mismatching_cases:
+        print('Signatures differ from the golden outputs for: %s' % ', '.join(mismatching_cases))
+        sys.exit(1)
+
+    print('Signatures match the golden outputs')
@@ -0,0 +1,272 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+from os.path import dirname, realpath
+from argparse import ArgumentParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Lock
+from hashlib import blake2b
+from json import loads, dumps
+from time import sleep, time, monotonic
+from random import Random
+from typing import Optional
+
+TESTS_DIR = realpath(dirname(__file__))
+
+ROOT_DIR = realpath(TESTS_DIR + '/..')
+FINGERPRINTING_DIR = realpath(ROOT_DIR + '/fingerprinting')
+
+import sys
+sys.path.append(FINGERPRINTING_DIR)
+
+from signature_format import DecodedMessage
+
+"""
+    Local stand-in for the recognition endpoint of the Shazam API
+    (/discovery/v5/.../tag/...), so that the recognition stage can be
+    tested and load-tested without spending real requests.
+
+    Submitted signatures are decoded with DecodedMessage.decode_from_uri()
+    (an undecodable one is answered 400). Whether a signature matches is
+    drawn from a hash of its URI, so that sending the same signature again
+    gets the same answer. Matches carry a track whose key is derived from
+    the same hash; no matches carry "retryms" when "no_match_retryms" is
+    set.
+
+    Answers are delayed by "latency_seconds", plus up to
+    "latency_jitter_seconds" of seeded random jitter. Requests beyond
+    "max_requests_per_second" (a token bucket of one second of requests),
+    and the next "throttle_next_requests" ones, are answered 429, with a
+    Retry-After header when "retry_after_seconds" is set.
+
+    Sample usage:
+
+        ./fake_shazam_server.py --port 8080 --match-probability 0.3 --max-requests-per-second 5
+"""
+
+class FakeShazamHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1' # Keep-alive
+
+    wbufsize = 64 * 1024 # Send the headers and the body of answers at once, rather than waiting for a delayed ACK in between
+
+    def setup(self):
+
+        with self.server.lock:
+            self.server.num_connections += 1
+
+        super().setup()
+
+    def do_POST(self):
+
+        server : FakeShazamServer = self.server
+
+        request : dict = loads(self.rfile.read(int(self.headers['Content-Length'])))
+
+        with server.lock:
+            server.num_requests += 1
+            server.num_requests_in_flight += 1
+            server.max_requests_in_flight = max(server.max_requests_in_flight, server.num_requests_in_flight)
+            latency_seconds : float = server.latency_seconds + server.random.random() * server.latency_jitter_seconds
+
+        try:
+            sleep(latency_seconds)
+
+            try:
+                signature : DecodedMessage = DecodedMessage.decode_from_uri(request['signature']['uri'])
+
+            except Exception as error:
+                self.send_json(400, {'error': 'Invalid signature: %s' % error})
+                return
+
+            if server.take_throttle():
+                self.send_json(429, {'error': 'Too many requests'}, {'Retry-After': str(server.retry_after_seconds)} if server.retry_after_seconds is not None else {})
+                return
+
+            self.send_json(200, server.make_response(request, signature))
+
+        finally:
+            with server.lock:
+                server.num_requests_in_flight -= 1
+
+    def send_json(self, status_code : int, body : dict, headers : Optional[dict] = None):
+
+        content : bytes = dumps(body).encode('utf-8')
+
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+
+        pass
+
+class FakeShazamServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, host : str = '127.0.0.1', port : int = 0, match_probability : float = 0, no_match_retryms : Optional[int] = None,
+                 latency_seconds : float = 0, latency_jitter_seconds : float = 0, max_requests_per_second : Optional[float] = None,
+                 retry_after_seconds : Optional[int] = None, seed : int = 0):
+
+        super().__init__((host, port), FakeShazamHandler)
+
+        self.match_probability : float = match_probability
+        self.no_match_retryms : Optional[int] = no_match_retryms
+        self.latency_seconds : float = latency_seconds
+        self.latency_jitter_seconds : float = latency_jitter_seconds
+        self.max_requests_per_second : Optional[float] = max_requests_per_second
+        self.retry_after_seconds : Optional[int] = retry_after_seconds
+        self.throttle_next_requests : int = 0
+
+        self.lock : Lock = Lock()
+        self.random : Random = Random(seed)
+
+        self.num_connections : int = 0
+        self.num_requests : int = 0
+        self.num_throttled : int = 0
+        self.num_requests_in_flight : int = 0
+        self.max_requests_in_flight : int = 0 # Peak number of requests being answered at once
+
+        self.tokens : float = max_requests_per_second or 0
+        self.tokens_updated_at : float = monotonic()
+
+    @property
+    def base_url(self) -> str:
+
+        return 'http://%s:%d' % self.server_address[:2]
+
+    """
+        Serve requests from a daemon thread, until self.shutdown() is
+        called.
+    """
+
+    def start(self) -> 'FakeShazamServer':
+
+        Thread(target = self.serve_forever, daemon = True).start()
+
+        return self
+
+    def stop(self):
+
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+
+        return self.start()
+
+    def __exit__(self, *exception_info):
+
+        self.stop()
+
+    """
+        Return whether the current request should be answered 429.
+    """
+
+    def take_throttle(self) -> bool:
+
+        with self.lock:
+
+            throttled : bool = False
+
+            if self.throttle_next_requests > 0:
+                self.throttle_next_requests -= 1
+                throttled = True
+
+            elif self.max_requests_per_second:
+
+                now : float = monotonic()
+
+                self.tokens = min(self.max_requests_per_second, self.tokens + (now - self.tokens_updated_at) * self.max_requests_per_second)
+                self.tokens_updated_at = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                else:
+                    throttled = True
+
+            self.num_throttled += throttled
+
+            return throttled
+
+    def make_response(self, request : dict, signature : DecodedMessage) -> dict:
+
+        signature_hash : int = int.from_bytes(blake2b(request['signature']['uri'].encode('ascii'), digest_size = 8).digest(), 'little')
+
+        response : dict = {
+            'matches': [],
+            'samplems': request['signature']['samplems'],
+            'timestamp': int(time() * 1000),
+            'timezone': request['timezone'],
+            'tagid': '%016X' % signature_hash
+        }
+
+        if (signature_hash >> 11) / (1 << 53) < self.match_probability:
+
+            track_key : str = str(signature_hash % 1000000000)
+
+            response['matches'] = [{'id': track_key, 'offset': 0.0, 'timeskew': 0.0, 'frequencyskew': 0.0}]
+            response['track'] = {
+                'key': track_key,
+                'title': 'Fake track %s' % track_key,
+                'subtitle': 'Fake artist',
+                'share': {'subject': 'Fake track %s - Fake artist' % track_key, 'href': 'https://www.shazam.com/track/%s' % track_key},
+                'images': {},
+                'sections': [],
+                'hub': {'actions': []}
+            }
+
+        elif self.no_match_retryms is not None:
+            response['retryms'] = self.no_match_retryms
+
+        return response
+
+
+if __name__ == '__main__':
+
+    args = ArgumentParser(description = 'Serve a local stand-in for the ' +
+        'recognition endpoint of the Shazam API.')
+
+    args.add_argument('--host', default = '127.0.0.1')
+
+    args.add_argument('--port', type = int, default = 8080)
+
+    args.add_argument('--match-probability', type = float, default = 0.3, help = 'The ' +
+        'proportion of signatures which match a track.')
+
+    args.add_argument('--no-match-retryms', type = int, help = 'The "retryms" ' +
+        'to send along no matches.')
+
+    args.add_argument('--latency', type = float, default = 0.2, help = 'The ' +
+        'delay before every answer, in seconds.')
+
+    args.add_argument('--latency-jitter', type = float, default = 0.1, help = 'The ' +
+        'maximal random delay added to --latency, in seconds.')
+
+    args.add_argument('--max-requests-per-second', type = float, help = 'The ' +
+        'rate above which requests are answered 429.')
+
+    args.add_argument('--retry-after', type = int, help = 'The Retry-After ' +
+        'of 429 answers, in seconds.')
+
+    args = args.parse_args()
+
+    server = FakeShazamServer(args.host, args.port, args.match_probability, args.no_match_retryms, args.latency,
+        args.latency_jitter, args.max_requests_per_second, args.retry_after)
+
+    print('Serving a fake Shazam API on %s (Ctrl+C to stop)' % server.base_url)
+
+    try:
+        server.serve_forever()
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        server.server_close()
+
+        print('%d requests (%d answered 429) over %d connections' % (server.num_requests, server.num_throttled, server.num_connections))
@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+from os.path import dirname, realpath
+from argparse import ArgumentParser
+from time import perf_counter
+from typing import Dict, List, Optional, Any
+from numpy import percentile
+import asyncio
+import logging
+
+TESTS_DIR = realpath(dirname(__file__))
+
+ROOT_DIR = realpath(TESTS_DIR + '/..')
+FINGERPRINTING_DIR = realpath(ROOT_DIR + '/fingerprinting')
+UTILS_DIR = realpath(ROOT_DIR + '/utils')
+
+import sys
+sys.path.append(FINGERPRINTING_DIR)
+sys.path.append(UTILS_DIR)
+
+from communication import ShazamClient, AsyncShazamClient
+from signature_format import DecodedMessage
+from algorithm import SignatureGenerator
+from rate_limiter import RateLimiter
+from audio_file_to_recognized_song import recognize, recognize_async
+from benchmark import SAMPLE_RATE, generate_noise
+from fake_shazam_server import FakeShazamServer
+
+"""
+    Load test of the recognition stage of the pipeline (recognize() and
+    recognize_async() of audio_file_to_recognized_song.py, with their
+    RateLimiter) against a local FakeShazamServer, reporting the requests
+    per second, the latency percentiles of the requests and the time spent
+    waiting in the rate limiter.
+
+    The signatures of the synthetic sounds are generated before the timed
+    run (with the settings of the pipeline), so that only the recognition
+    stage is measured.
+
+    Sample usage:
+
+        ./load_test.py --sounds 200 --latency 0.2 --concurrency 8 --max-requests-per-second 20
+"""
+
+
+"""
+    ShazamClient recording the duration of every request.
+"""
+
+class TimedShazamClient(ShazamClient):
+
+    def __init__(self, *args, **kwargs):
+
+        super().__init__(*args, **kwargs)
+
+        self.latencies_seconds : List[float] = []
+
+    def recognize_song_from_signature(self, signature : DecodedMessage, timeout : Optional[float] = None) -> dict:
+
+        start_time : float = perf_counter()
+
+        results : dict = super().recognize_song_from_signature(signature, timeout)
+
+        self.latencies_seconds.append(perf_counter() - start_time)
+
+        return results
+
+
+"""
+    Stand-in for a SignatureGenerator, returning signatures generated
+    beforehand.
+"""
+
+class ReplayedSignatures:
+
+    def __init__(self, signatures : List[DecodedMessage]):
+
+        self.signatures : List[DecodedMessage] = signatures
+        self.samples_processed : int = 0
+
+    def get_next_signature(self) -> DecodedMessage:
+
+        if not self.signatures:
+            return None
+
+        signature : DecodedMessage = self.signatures.pop(0)
+
+        self.samples_processed += signature.number_samples
+
+        return signature
+
+
+def generate_sound_signatures(num_sounds : int, length_seconds : int) -> List[List[DecodedMessage]]:
+
+    sound_signatures : List[List[DecodedMessage]] = []
+
+    for sound_index in range(num_sounds):
+
+        # Same settings as prepare_signature_generator() of the pipeline
+
+        signature_generator = SignatureGenerator()
+        signature_generator.feed_input(generate_noise(length_seconds * SAMPLE_RATE, seed = sound_index))
+        signature_generator.MAX_TIME_SECONDS = 16
+        signature_generator.ROLLING_WINDOW_MODE = True
+
+        sound_signatures.append(list(iter(signature_generator.get_next_signature, None)))
+
+    return sound_signatures
+
+
+def run_load_test(server : FakeShazamServer, sound_signatures : List[List[DecodedMessage]], concurrency : int, rate_limiter : RateLimiter) -> Dict[str, Any]:
+
+    shazam_client = TimedShazamClient(server.base_url, pool_maxsize = concurrency)
+
+    start_time : float = perf_counter()
+
+    if concurrency > 1:
+
+        async def recognize_all() -> List[dict]:
+
+            async_shazam_client = AsyncShazamClient(server.base_url, max_concurrency = concurrency)
+            async_shazam_client.client.close()
+            async_shazam_client.client = shazam_client
+
+            sounds_semaphore = asyncio.Semaphore(concurrency)
+
+            async def recognize_sound(signatures : List[DecodedMessage]) -> dict:
+
+                async with sounds_semaphore:
+                    return await recognize_async(async_shazam_client, ReplayedSignatures(signatures), rate_limiter)
+
+            return await asyncio.gather(*(recognize_sound(signatures) for signatures in sound_signatures))
+
+        all_results : List[dict] = asyncio.run(recognize_all())
+
+    else:
+
+        all_results : List[dict] = [recognize(shazam_client, ReplayedSignatures(signatures), rate_limiter) for signatures in sound_signatures]
+
+    elapsed_seconds : float = perf_counter() - start_time
+
+    shazam_client.close()
+
+    latencies_ms = [latency_seconds * 1000 for latency_seconds in shazam_client.latencies_seconds] or [0]
+
+    return {
+        'sounds': len(sound_signatures),
+        'matched_sounds': sum(1 for results in all_results if isinstance(results, dict) and results.get('matches')),
+        'requests': len(shazam_client.latencies_seconds),
+        'throttled_requests': server.num_throttled,
+        'elapsed_seconds': elapsed_seconds,
+        'requests_per_second': len(shazam_client.latencies_seconds) / elapsed_seconds,
+        'latency_p50_ms': percentile(latencies_ms, 50),
+        'latency_p95_ms': percentile(latencies_ms, 95),
+        'latency_p99_ms': percentile(latencies_ms, 99),
+        'latency_max_ms': max(latencies_ms),
+        'rate_limiter_sleep_seconds': rate_limiter.sleep_seconds,
+        'final_rate': rate_limiter.get_rate()
+    }
+
+
+if __name__ == '__main__':
+
+    args = ArgumentParser(description = 'Load test the recognition stage ' +
+        'of the pipeline against a local fake Shazam API.')
+
+    args.add_argument('--sounds', type = int, default = 100, help = 'The ' +
+        'number of synthetic sounds to recognize.')
+
+    args.add_argument('--length', type = int, default = 14, help = 'The ' +
+        'length of the synthetic sounds, in seconds.')
+
+    args.add_argument('--concurrency', type = int, default = 1, help = 'The ' +
+        'number of requests in flight (above 1, recognize_async() is used).')
+
+    args.add_argument('--rate', type = float, default = 10, help = 'The ' +
+        'initial rate of the rate limiter, in requests per second.')
+
+    args.add_argument('--backoff', type = float, default = 1, help = 'The ' +
+        'pause after a 429 without Retry-After, in seconds.')
+
+    args.add_argument('--match-probability', type = float, default = 0.3, help = 'The ' +
+        'proportion of signatures which match a track.')
+
+    args.add_argument('--no-match-retryms', type = int, help = 'The "retryms" ' +
+        'sent along no matches.')
+
+    args.add_argument('--latency', type = float, default = 0.1, help = 'The ' +
+        'delay of the server before every answer, in seconds.')
+
+    args.add_argument('--latency-jitter', type = float, default = 0.05, help = 'The ' +
+        'maximal random delay added to --latency, in seconds.')
+
+    args.add_argument('--max-requests-per-second', type = float, help = 'The ' +
+        'rate above which the server answers 429.')
+
+    args.add_argument('--retry-after', type = int, help = 'The Retry-After ' +
+        'of 429 answers, in seconds.')
+
+    args = args.parse_args()
+
+    logging.getLogger('songrec').setLevel(logging.WARNING)
+
+    sound_signatures : List[List[DecodedMessage]] = generate_sound_signatures(args.sounds, args.length)
+
+    with FakeShazamServer(match_probability = args.match_probability, no_match_retryms = args.no_match_retryms,
+        latency_seconds = args.latency, latency_jitter_seconds = args.latency_jitter,
+        max_requests_per_second = args.max_requests_per_second, retry_after_seconds = args.retry_after) as server:
+
+        results : Dict[str, Any] = run_load_test(server, sound_signatures, args.concurrency, RateLimiter(args.rate, args.backoff))
+
+    for name, value in results.items():
+        print('%-28s %s' % (name, '%.3f' % value if isinstance(value, float) else value))
@@ -1,17 +1,44 @@
 #!/usr/bin/python3
 #-*- encoding: Utf-8 -*-
-from os.path import dirname, realpath
+from os.path import dirname, realpath, exists, basename
+from os import remove
 from unittest import TestCase, main
+from unittest.mock import patch
+from array import array
+from numpy import frombuffer, concatenate, zeros, stack, int16, shares_memory
+from tempfile import TemporaryDirectory
+import wave
+from time import sleep, perf_counter
+import asyncio
 
-UTILS_DIR = realpath(dirname(__file__))
+TESTS_DIR = realpath(dirname(__file__))
 
-ROOT_DIR = realpath(UTILS_DIR + '/..')
+ROOT_DIR = realpath(TESTS_DIR + '/..')
 FINGERPRINTING_DIR = realpath(ROOT_DIR + '/fingerprinting')
+UTILS_DIR = realpath(ROOT_DIR + '/utils')
 
 import sys
 sys.path.append(FINGERPRINTING_DIR)
+sys.path.append(UTILS_DIR)
 
-from signature_format import DecodedMessage
+from signature_format import DecodedMessage, FrequencyPeak, FrequencyPeakColumns, FrequencyBand
+from algorithm import SignatureGenerator
+from signature_cache import SignatureCache
+from signature_archive import SignatureArchive
+from landmark_index import LandmarkIndex
+from landmark_store import LandmarkStore
+from communication import ShazamClient, AsyncShazamClient
+from response_cache import ResponseCache
+from benchmark import SIGNAL_GENERATORS, GOLDEN_OUTPUTS_PATH, generate_signatures, generate_noise
+from fake_shazam_server import FakeShazamServer
+from rate_limiter import RateLimiter, FileRateLimiterBackend
+from audio_file_to_recognized_song import recognize
+from audio_files_to_fingerprints import fingerprint_many, fingerprint_file_to_binary
+from compare_fingerprint_precisions import compare_precisions
+from duplicate_sounds import DuplicateSounds, save_unless_duplicate
+from io import BytesIO
+from hashlib import sha256
+from json import load
 
 
 STUPEFLIP_DATA_URI_SAMPLE = 'data:audio/vnd.shazam.sig;base64,gCX+ynzKnegoBQAAAJwRlAAAAAAAAAAAAAAAAAAAABgAAAAAAAAAAACGAQAAAHwAAAAAQCgFAABAAANgeAAAACdVdK4MAT15RAgN3XWPCjsqeFUPHjR5JQ4VQXh5CR6/dF0OS3h2zg0MvHaHD1FneFgMEtdmRQ4PZ2z4DhF2dZIMNHZwTQ834XZIDAOkaYwQBqpqLA8wVHKtDCWfczEPNGF90AwZXnmqCRPEejgJBY18xA8nGnDzDEEAA2ByAQAAGVlxRRkJinLDGgazd8QQAbN0aCsBOm5iJQoXbXwWBQRsBRMDyHY6Hh9fc88QBt1qaSgIdXeLIQUGdgcmBRxwsRYBRnU8Hgo7anIsBBJxpSQCNXT5FR9ja1MdAkt2iBIK+3QwJgZTdWwZDNFq0xUMG3OqIQNOeDMtJzhv6R4AaG4wKwVDd84XAb50UScDi24/HgllbRgZDz5tliwFWXIDFQB+cQkjITltLRQDpHYcGAEIc8QnAQluqB8SIHMFGRE3bmocBiVxuCoIw3HOFgCZdD4tIoB0ER4VSWzWJQ/CbYQcAYhyvCoKKnv/GAksbc4eJ/d9PSUBg3nrGAFxcSstLeJwkSYKF3QrHgAyb/olDzRvOCAAB3k2LRPhcYIsASlz/RIA0G9MJBgWcB0cAc5wjyUGCnNhGQSVd/EmA9B0uhoIl3IYLQE4cFImFZJ1RR4GonRPKAHBeIgUFWlsEB8II4AKEQiSdpAhFAtpLB4BZmSFKQAAQgADYIsBAAAMA3IWPAWTcoo2DiRwiE0BwnDpMgZecVNLAfpxkUMAVnQJSALmb88zCqd03jcABHLvTgZDb7w/ANJw+08T+3ISPhKGcH9DD6VzyzIA9XKaRTV3bnIvATRysjwC5XG7OAmNcT8yBEBwhD8PL3R/MwDNcBttEMRy7DImfHvBMwb2dL87Dl91Jm5O/XTIZADKcwVrAQJzEl4Oa3RdVgEIeck9ATR6+UkGrnbvVAMPdRpQAQV0ZTgB+3bHMRSEeMU6Ez5+ckoAM324VgUFfYg8BZ90r0Qf7H8zMgPWdXE2Aeh7kU8BfHgAQwHxe6dLAHl4SlgIEX9rPg6denRGE+l5+0oCr4KWMQWxebRLDax/cDwB93mESRN5e0BMAq6Cbj8JMoR7PgBbenNXA858zkoI5H36SA43et5FE/h50TERoHcbTwH4eNg0AdZ3TToL1HeaOACEeNQ8APqBNEEBqXc/TgZ8ebBNATeDvUBbKWuJPAHhYTBiBbdtDUsBkmW0XgICdL44AB1r/FQSeWu7OgBDAANghgEAAAv0aDh4ACtneoYBcGbUjwA0Zy6dALtoQqca4mfRcgHUZhSGAepqEKQKZmp6cADXZwabAeRlqpEFLmq3cVYWbv5wFHZof3cAimZphwANZjOeAU9rQKcIv2WscSX0aMCcABRq0J8APWZVrQFzaoCFAKNsh5gB6myJdgzCaQJ7DwJwWosAJWqQjwCnb5KSAPptCZwB4G56fwZ9bhmVDp9rU3cWBW3DrgcgazCbBkFt3ZIT+Wm5qA2zaXJ+ALVpF5YA8mnBmQFKaz+KAGZs65ESWmxvhACIafeqAbZqQHEAA20ffADaao+kAc5q+XQAHGpGkMLkYkylDMlrBHIWUmRUdgMxZWWPA8tr2a4J8mY2eQD4ai2bBAdq0ZITDGhLhgBUZl2eAFhng6gCfGLIgQtKZ4xwGc1j5ZsBK2QBeQFQanV0AfRjsaEBeGItiQEDZeF8DS9kDHoSe2UsdwFtZU5+CmFpLngOZGQ4hw0rXOeOAJ1gmagB4F4DmwEJYQKACANd6J4VuFJtrAAA'
@@ -27,6 +54,707 @@ class Tests(TestCase):
         assert message.encode_to_uri() == STUPEFLIP_DATA_URI_SAMPLE
         assert message.encode_to_json() == DecodedMessage.decode_from_binary(message.encode_to_binary()).encode_to_json()
     
+    def test_distant_peaks_round_trip(self):
+        
+        message = DecodedMessage()
+        message.sample_rate_hz = 16000
+        message.number_samples = 16000 * 600
+        message.frequency_band_to_sound_peaks = {
+            FrequencyBand._520_1450: [
+                FrequencyPeak(fft_pass_number, 6000 + position, 2000 + position, 16000)
+                for position, fft_pass_number in enumerate([0, 254, 509, 509, 800, 70000, 70001])
+            ],
+            FrequencyBand._3500_5500: []
+        }
+        
+        binary = message.encode_to_binary()
+        
+        # Offsets of 255 passes or more are stored as absolute FFT pass
+        # numbers, in extra records
+        
+        assert binary.count(b'\xff') >= 3
+        
+        decoded_message = DecodedMessage.decode_from_binary(binary)
+        
+        assert decoded_message.encode_to_json() == message.encode_to_json()
+        assert decoded_message.encode_to_binary() == binary
+    
+    def test_columnar_peaks_match_peak_objects(self):
+        
+        message = DecodedMessage.decode_from_uri(STUPEFLIP_DATA_URI_SAMPLE)
+        columnar_message = DecodedMessage.decode_from_uri(STUPEFLIP_DATA_URI_SAMPLE, columnar = True)
+        
+        assert columnar_message.encode_to_uri() == STUPEFLIP_DATA_URI_SAMPLE
+        assert columnar_message.encode_to_json() == message.encode_to_json()
+        assert message.to_columnar().encode_to_uri() == STUPEFLIP_DATA_URI_SAMPLE
+        
+        for frequency_band, frequency_peaks in message.frequency_band_to_sound_peaks.items():
+            
+            peak_columns = columnar_message.frequency_band_to_sound_peaks[frequency_band]
+            
+            assert isinstance(peak_columns, FrequencyPeakColumns) and len(peak_columns) == len(frequency_peaks)
+            
+            assert peak_columns.get_frequencies_hz().tolist() == [frequency_peak.get_frequency_hz() for frequency_peak in frequency_peaks]
+            assert peak_columns.get_amplitudes_pcm().tolist() == [frequency_peak.get_amplitude_pcm() for frequency_peak in frequency_peaks]
+            assert peak_columns.get_seconds().tolist() == [frequency_peak.get_seconds() for frequency_peak in frequency_peaks]
+            
+            assert peak_columns[-1].fft_pass_number == frequency_peaks[-1].fft_pass_number
+            assert [frequency_peak.peak_magnitude for frequency_peak in peak_columns[2:5]] == [frequency_peak.peak_magnitude for frequency_peak in frequency_peaks[2:5]]
+    
+    def test_batched_fft_matches_per_hop_fft(self):
+        
+        samples = [(position * 7919) % 65536 - 32768 for position in range(128 * 40)]
+        
+        per_hop_generator = SignatureGenerator()
+        
+        for position in range(0, len(samples), 128):
+            per_hop_generator.do_fft(samples[position:position + 128])
+        
+        batched_generator = SignatureGenerator()
+        fft_outputs_batch = batched_generator.do_fft_batch(samples)
+        
+        assert len(fft_outputs_batch) == 40
+        
+        for hop in range(40):
+            assert (fft_outputs_batch[hop] == per_hop_generator.fft_outputs[hop]).all()
+        
+        assert (batched_generator.ring_buffer_of_samples.in_chronological_order() == per_hop_generator.ring_buffer_of_samples.in_chronological_order()).all()
+    
+    def test_feed_input_accepts_buffers_without_copying(self):
+        
+        samples = [(position * 7919) % 65536 - 32768 for position in range(16000 * 4)]
+        samples_array = array('h', samples)
+        
+        signatures = []
+        
+        for fed_samples in [samples, samples_array, samples_array.tobytes(), memoryview(samples_array.tobytes()), frombuffer(samples_array, dtype = int16)]:
+            
+            signature_generator = SignatureGenerator()
+            signature_generator.feed_input(fed_samples)
+            
+            signatures.append(signature_generator.get_next_signature().encode_to_binary())
+        
+        assert all(signature == signatures[0] for signature in signatures)
+        
+        signature_generator = SignatureGenerator()
+        signature_generator.feed_input(samples_array)
+        
+        assert shares_memory(signature_generator.input_pending_processing, frombuffer(samples_array, dtype = int16))
+        
+        # Input fed in many chunks is appended to a geometrically grown buffer
+        
+        signature_generator = SignatureGenerator()
+        
+        for position in range(0, len(samples_array), 100):
+            signature_generator.feed_input(samples_array[position:position + 100])
+        
+        assert (signature_generator.input_pending_processing == frombuffer(samples_array, dtype = int16)).all()
+        assert len(signature_generator.input_buffer) < 2 * len(samples_array)
+        assert signature_generator.get_next_signature().encode_to_binary() == signatures[0]
+    
+    def test_streaming_signatures_match_whole_input_signatures(self):
+        
+        samples = array('h', [(position * 7919) % 65536 - 32768 for position in range(16000 * 8)])
+        
+        signature_generator = SignatureGenerator()
+        signature_generator.feed_input(samples)
+        
+        signatures = []
+        
+        while True:
+            signature = signature_generator.get_next_signature()
+            if not signature:
+                break
+            signatures.append(signature.encode_to_binary())
+        
+        streaming_signature_generator = SignatureGenerator()
+        
+        streamed_signatures = [
+            signature.encode_to_binary()
+            for signature in streaming_signature_generator.iter_signatures(samples[position:position + 1000] for position in range(0, len(samples), 1000))
+        ]
+        
+        assert len(signatures) > 1
+        assert streamed_signatures == signatures
+        assert len(streaming_signature_generator.input_pending_processing) < 128
+    
+    def test_rolling_window_signatures_are_cut_from_shared_peaks(self):
+        
+        samples = array('h', [(position * 7919) % 65536 - 32768 for position in range(16000 * 8)])
+        
+        signature_generator = SignatureGenerator()
+        signature_generator.ROLLING_WINDOW_MODE = True
+        signature_generator.ROLLING_WINDOW_STEP_SECONDS = 1
+        signature_generator.feed_input(samples)
+        
+        first_signature = signature_generator.get_next_signature()
+        second_signature = signature_generator.get_next_signature()
+        
+        assert first_signature.number_samples / 16000 >= 3.1
+        assert second_signature.encode_to_binary() == signature_generator.get_signature_at(1, second_signature.number_samples / 16000).encode_to_binary()
+        
+        # Overlapping windows see the same peaks, shifted by the window offset
+        
+        for frequency_band, frequency_peaks in first_signature.frequency_band_to_sound_peaks.items():
+            
+            shifted_peaks = [
+                (frequency_peak.fft_pass_number - 125, frequency_peak.corrected_peak_frequency_bin)
+                for frequency_peak in frequency_peaks if frequency_peak.fft_pass_number >= 125
+            ]
+            
+            assert shifted_peaks == [
+                (frequency_peak.fft_pass_number, frequency_peak.corrected_peak_frequency_bin)
+                for frequency_peak in second_signature.frequency_band_to_sound_peaks[frequency_band]
+            ][:len(shifted_peaks)]
+    
+    def test_streamed_rolling_windows_match_whole_input_windows(self):
+        
+        samples = generate_noise(16000 * 20)
+        
+        signature_generator = SignatureGenerator()
+        signature_generator.ROLLING_WINDOW_MODE = True
+        signature_generator.ROLLING_WINDOW_STEP_SECONDS = 1
+        signature_generator.feed_input(samples)
+        
+        signatures = list(iter(signature_generator.get_next_signature, None))
+        
+        streaming_signature_generator = SignatureGenerator()
+        streaming_signature_generator.ROLLING_WINDOW_MODE = True
+        streaming_signature_generator.ROLLING_WINDOW_STEP_SECONDS = 1
+        
+        streamed_signatures = list(streaming_signature_generator.iter_signatures(samples[position:position + 1000] for position in range(0, len(samples), 1000)))
+        
+        assert [signature.encode_to_binary() for signature in streamed_signatures] == [signature.encode_to_binary() for signature in signatures]
+        
+        # No fragments of the last window are cut after it
+        
+        assert len(signatures) == 18
+        assert min(signature.number_samples for signature in signatures) >= 3 * 16000
+    
+    def test_signature_cache_returns_the_generated_signatures(self):
+        
+        samples = array('h', [(position * 7919) % 65536 - 32768 for position in range(16000 * 8)])
+        input_hash = SignatureCache.hash_samples(samples)
+        
+        with TemporaryDirectory() as cache_dir:
+            
+            signature_cache = SignatureCache(cache_dir)
+            
+            def generate_cached_signatures():
+                
+                signature_generator = SignatureGenerator()
+                signature_generator.feed_input(samples)
+                
+                return [
+                    signature.encode_to_binary()
+                    for signature in iter(lambda: signature_cache.get_next_signature(signature_generator, input_hash), None)
+                ]
+            
+            generated_signatures = generate_cached_signatures()
+            
+            # The second run should only read from the cache
+            
+            with patch.object(SignatureGenerator, 'do_fft_batch', side_effect = AssertionError('cache miss')) as do_fft_batch:
+                cached_signatures = generate_cached_signatures()
+            
+            assert len(generated_signatures) > 1
+            assert cached_signatures == generated_signatures
+            assert not do_fft_batch.called
+            
+            # Writing an entry again does not count its size twice
+            
+            approximate_size_bytes = signature_cache.approximate_size_bytes
+            signature_cache.put(signature_cache.make_key(input_hash, SignatureGenerator()), generated_signatures[0])
+            
+            assert approximate_size_bytes == sum(map(len, generated_signatures)) == signature_cache.approximate_size_bytes
+    
+    def test_signatures_match_golden_outputs(self):
+        
+        with open(GOLDEN_OUTPUTS_PATH) as golden_outputs_file:
+            golden_outputs = load(golden_outputs_file)
+        
+        for signal_kind, generate_signal in SIGNAL_GENERATORS.items():
+            
+            signatures = generate_signatures(generate_signal(14 * 16000))
+            
+            assert [sha256(signature.encode_to_binary()).hexdigest() for signature in signatures] == golden_outputs['%s-14s' % signal_kind]
+    
+    def test_single_precision_peaks_agree_with_double_precision_peaks(self):
+        
+        for signal_kind, generate_signal in SIGNAL_GENERATORS.items():
+            
+            comparison = compare_precisions(generate_signal(14 * 16000), 3.1)
+            
+            assert comparison['num_candidate_signatures'] == comparison['num_reference_signatures'], signal_kind
+            
+            for frequency_band, counts in comparison['band_to_counts'].items():
+                assert counts['added'] == counts['missing'] == 0, (signal_kind, frequency_band)
+    
+    def test_stats_count_hops_and_peaks_without_changing_signatures(self):
+        
+        samples = SIGNAL_GENERATORS['chirps'](14 * 16000)
+        
+        signature_generator = SignatureGenerator()
+        stats = signature_generator.enable_stats()
+        signature_generator.feed_input(samples)
+        
+        signatures = list(iter(signature_generator.get_next_signature, None))
+        
+        assert [signature.encode_to_binary() for signature in signatures] == [signature.encode_to_binary() for signature in generate_signatures(samples)]
+        
+        assert stats.hops_processed == stats.stage_calls['do_peak_spreading'] == sum(signature.number_samples for signature in signatures) // 128
+        assert stats.stage_calls['do_peak_recognition'] > 0 and stats.stage_seconds['do_fft_batch'] > 0
+        
+        for frequency_band, num_peaks in stats.frequency_band_to_num_peaks.items():
+            assert num_peaks == sum(len(signature.frequency_band_to_sound_peaks.get(frequency_band, [])) for signature in signatures)
+    
+    def test_silent_frames_are_skipped_without_changing_signatures(self):
+        
+        chirps = SIGNAL_GENERATORS['chirps'](4 * 16000)
+        samples = concatenate([zeros(3200, dtype = int16), chirps, zeros(2 * 16000, dtype = int16), chirps])
+        
+        signatures = {}
+        num_recognitions = {}
+        
+        for skip_silent_frames in [False, True]:
+            
+            signature_generator = SignatureGenerator()
+            signature_generator.SKIP_SILENT_FRAMES = skip_silent_frames
+            stats = signature_generator.enable_stats()
+            signature_generator.feed_input(samples)
+            
+            signatures[skip_silent_frames] = [signature.encode_to_binary() for signature in iter(signature_generator.get_next_signature, None)]
+            num_recognitions[skip_silent_frames] = stats.stage_calls['do_peak_recognition']
+        
+        assert signatures[True] == signatures[False]
+        assert num_recognitions[True] < num_recognitions[False]
+    
+    def test_stereo_44100_hz_input_is_resampled_in_the_generator(self):
+        
+        mono_samples = SIGNAL_GENERATORS['chirps'](44100 * 5)
+        stereo_samples = stack([mono_samples, mono_samples // 2], axis = 1).ravel()
+        
+        signature_generator = SignatureGenerator()
+        signature_generator.feed_input(stereo_samples, 44100, 2)
+        
+        assert len(signature_generator.input_pending_processing) == 16000 * 5
+        
+        signatures = [signature.encode_to_binary() for signature in iter(signature_generator.get_next_signature, None)]
+        
+        signature_generator = SignatureGenerator()
+        chunks = (stereo_samples[position:position + 9000] for position in range(0, len(stereo_samples), 9000))
+        
+        assert [signature.encode_to_binary() for signature in signature_generator.iter_signatures(chunks, 44100, 2)] == signatures
+        
+        with self.assertRaises(ValueError):
+            SignatureGenerator().feed_input(stereo_samples, 22050, 2)
+    
+    def test_fingerprint_many_matches_single_process_fingerprints(self):
+        
+        with TemporaryDirectory() as sounds_dir:
+            
+            input_files = []
+            
+            for seed in range(3):
+                
+                input_files.append('%s/sound-%d.wav' % (sounds_dir, seed))
+                
+                with wave.open(input_files[-1], 'wb') as wave_file:
+                    wave_file.setnchannels(1)
+                    wave_file.setsampwidth(2)
+                    wave_file.setframerate(16000)
+                    wave_file.writeframes(generate_noise(16000 * 4, seed = seed).tobytes())
+            
+            input_files.append(sounds_dir + '/broken.wav')
+            
+            with open(input_files[-1], 'wb') as broken_file:
+                broken_file.write(b'Not a sound')
+            
+            results = {input_file: (signature_binary, error) for input_file, signature_binary, error in fingerprint_many(input_files, workers = 2, chunksize = 1, archive_path = sounds_dir + '/archive')}
+            
+            assert sorted(results) == sorted(input_files)
+            
+            for input_file in input_files[:-1]:
+                
+                signature_binary, error = results[input_file]
+                
+                assert error is None
+                assert DecodedMessage.decode_from_binary(signature_binary).encode_to_binary() == fingerprint_file_to_binary(input_file)[1]
+            
+            assert results[input_files[-1]][0] is None and results[input_files[-1]][1]
+            
+            # The generated signatures were archived
+            
+            with SignatureArchive(sounds_dir + '/archive', read_only = True) as archive:
+                assert sorted(bytes(signature_binary) for key, signature_binary in archive.iter_binaries()) == sorted(results[input_file][0] for input_file in input_files[:-1])
+    
+    def test_duplicate_sounds_are_removed_and_get_the_result_of_their_representative(self):
+        
+        def make_wave(samples, num_channels = 1):
+            
+            wave_content = BytesIO()
+            
+            with wave.open(wave_content, 'wb') as wave_file:
+                wave_file.setnchannels(num_channels)
+                wave_file.setsampwidth(2)
+                wave_file.setframerate(16000)
+                wave_file.writeframes(stack([samples] * num_channels, axis = 1).tobytes())
+            
+            return wave_content.getvalue()
+        
+        samples = generate_noise(16000 * 2)
+        
+        with TemporaryDirectory() as sounds_dir:
+            
+            duplicate_sounds = DuplicateSounds(sounds_dir + '/duplicates.json')
+            
+            # The same bytes, then the same audio in another layout
+            
+            for tiktok_sound_id, content in [(1, make_wave(samples)), (2, make_wave(samples)), (3, make_wave(samples, num_channels = 2)), (4, make_wave(samples[::-1].copy()))]:
+                save_unless_duplicate(duplicate_sounds, content, '%s/%d.wav' % (sounds_dir, tiktok_sound_id), tiktok_sound_id)
+            
+            assert [exists('%s/%d.wav' % (sounds_dir, tiktok_sound_id)) for tiktok_sound_id in range(1, 5)] == [True, False, False, True]
+            
+            duplicate_sounds.save()
+            
+            duplicate_sounds = DuplicateSounds(sounds_dir + '/duplicates.json')
+            
+            assert duplicate_sounds.representative_to_duplicates == {'1': ['2', '3']}
+            
+            results = duplicate_sounds.fan_out_results([
+                {'file': sounds_dir + '/1.wav', 'result': {'matches': [{'id': '42'}]}},
+                {'file': sounds_dir + '/4.wav', 'result': {'matches': []}}
+            ])
+            
+            assert sorted((basename(item['file']), item['result']['matches']) for item in results) == [
+                ('1.wav', [{'id': '42'}]), ('2.wav', [{'id': '42'}]), ('3.wav', [{'id': '42'}]), ('4.wav', [])
+            ]
+            
+            # Recognized groups are forgotten
+            
+            assert duplicate_sounds.representative_to_duplicates == {} and duplicate_sounds.hash_to_representative == {}
+            
+            # A representative downloaded again is written again, and groups without a result are forgotten
+            
+            for tiktok_sound_id, content in [(5, make_wave(samples)), (6, make_wave(samples))]:
+                save_unless_duplicate(duplicate_sounds, content, '%s/%d.wav' % (sounds_dir, tiktok_sound_id), tiktok_sound_id)
+            
+            remove(sounds_dir + '/5.wav')
+            save_unless_duplicate(duplicate_sounds, make_wave(samples), sounds_dir + '/5.wav', 5)
+            
+            assert exists(sounds_dir + '/5.wav') and duplicate_sounds.representative_to_duplicates == {'5': ['6']}
+            
+            assert duplicate_sounds.fan_out_results([]) == []
+            assert duplicate_sounds.representative_to_duplicates == {} and duplicate_sounds.hash_to_representative == {}
+    
+    def test_signature_archive_round_trips_and_compacts(self):
+        
+        signatures = {
+            sha256(str(position).encode()).hexdigest()[:40]: signature.encode_to_binary()
+            for position, signature in enumerate(generate_signatures(SIGNAL_GENERATORS['chirps'](30 * 16000)))
+        }
+        
+        with TemporaryDirectory() as archive_dir:
+            
+            with SignatureArchive(archive_dir + '/archive') as signature_archive:
+                
+                signature_archive.put_many(signatures.items())
+                
+                replaced_key = next(iter(signatures))
+                signatures[replaced_key] = signatures[list(signatures)[-1]]
+                signature_archive.put(replaced_key, signatures[replaced_key])
+                
+                assert {key: signature_binary.tobytes() for key, signature_binary in signature_archive.iter_binaries(verify_crc = True)} == signatures
+            
+            # Losing the index, then compacting
+            
+            remove(archive_dir + '/archive.index')
+            
+            with SignatureArchive(archive_dir + '/archive') as signature_archive:
+                
+                assert all(signature_archive.get_binary(key) == signature_binary for key, signature_binary in signatures.items())
+                
+                signature_archive.compact(keep = lambda key, signature_binary: key != replaced_key)
+                del signatures[replaced_key]
+            
+            with SignatureArchive(archive_dir + '/archive', read_only = True) as signature_archive:
+                
+                assert len(signature_archive) == len(signatures) and replaced_key not in signature_archive
+                assert {key: signature.encode_to_binary() for key, signature in signature_archive.iter_signatures()} == signatures
+    
+    def test_landmark_index_matches_crops_of_indexed_sounds(self):
+        
+        def generate_whole_signature(samples):
+            
+            signature_generator = SignatureGenerator()
+            signature_generator.MAX_TIME_SECONDS = 16
+            signature_generator.feed_input(samples)
+            
+            return signature_generator.get_next_signature()
+        
+        chirps = SIGNAL_GENERATORS['chirps'](30 * 16000)
+        
+        landmark_index = LandmarkIndex()
+        landmark_index.add(1, generate_whole_signature(chirps[:14 * 16000]), {'track': {'key': '1'}})
+        landmark_index.add(2, generate_whole_signature(SIGNAL_GENERATORS['noise'](14 * 16000)))
+        
+        with TemporaryDirectory() as index_dir:
+            
+            landmark_index.save(index_dir + '/index.npz')
+            landmark_index = LandmarkIndex.load(index_dir + '/index.npz')
+        
+        crop = (chirps[3 * 16000 + 77:13 * 16000] * 0.5).astype(int16)
+        
+        sound_id, num_landmarks, offset_seconds = landmark_index.find_best_match(generate_whole_signature(crop))
+        
+        assert sound_id == 1 and landmark_index.get_metadata(sound_id) == {'track': {'key': '1'}}
+        assert abs(offset_seconds - 3) < 0.02
+        
+        assert landmark_index.find_best_match(generate_whole_signature(SIGNAL_GENERATORS['tone'](10 * 16000))) is None
+    
+    def test_landmark_store_merges_and_shares_its_write_ahead_segment(self):
+        
+        signatures = []
+        
+        for position in range(3):
+            
+            signature_generator = SignatureGenerator()
+            signature_generator.MAX_TIME_SECONDS = 10
+            signature_generator.feed_input(SIGNAL_GENERATORS['chirps'](30 * 16000)[position * 10 * 16000:(position + 1) * 10 * 16000])
+            
+            signatures.append(signature_generator.get_next_signature())
+        
+        with TemporaryDirectory() as store_dir:
+            
+            landmark_index = LandmarkIndex()
+            landmark_store = LandmarkStore(store_dir + '/store')
+            
+            for sound_id, signature in enumerate(signatures):
+                
+                landmark_index.add(sound_id, signature, {'sound': sound_id})
+                landmark_store.add(sound_id, signature, {'sound': sound_id})
+                
+                if sound_id == 1:
+                    landmark_store.merge()
+            
+            with LandmarkStore(store_dir + '/store', read_only = True) as reader:
+                
+                assert len(reader) == 3 and reader.get_metadata(2) == {'sound': 2}
+                
+                with self.assertRaises(PermissionError):
+                    LandmarkStore(store_dir + '/store') # A single writer at once
+                
+                for signature in signatures:
+                    assert landmark_index.find_matches(signature) == landmark_store.find_matches(signature) == reader.find_matches(signature)
+                
+                landmark_store.merge()
+                landmark_store.close()
+                
+                assert reader.find_best_match(signatures[2])[0] == 2 and reader.get_metadata(0) == {'sound': 0}
+    
+    def test_shazam_client_reuses_its_connection(self):
+        
+        with FakeShazamServer() as server:
+            
+            signature = DecodedMessage.decode_from_uri(STUPEFLIP_DATA_URI_SAMPLE)
+            
+            with ShazamClient(server.base_url) as shazam_client:
+                
+                results = [shazam_client.recognize_song_from_signature(signature) for attempt in range(3)]
+            
+            assert all(result['samplems'] == int(signature.number_samples / 16) and result['timezone'].startswith('Europe/') for result in results)
+            assert server.num_connections == 1
+    
+    def test_async_shazam_client_overlaps_requests_within_deadlines(self):
+        
+        async def recognize_concurrently(server, signature):
+            
+            async with AsyncShazamClient(server.base_url, max_concurrency = 4) as shazam_client:
+                
+                results = await asyncio.gather(*[shazam_client.recognize_song_from_signature(signature) for attempt in range(4)])
+                
+                return results, await shazam_client.recognize_song_from_signature(signature, deadline_seconds = 0.05)
+        
+        with FakeShazamServer(latency_seconds = 0.3) as server:
+            
+            results, late_result = asyncio.run(recognize_concurrently(server, DecodedMessage.decode_from_uri(STUPEFLIP_DATA_URI_SAMPLE)))
+            
+            assert server.max_requests_in_flight == 4
+            assert all(result['matches'] == [] for result in results)
+            assert 'Deadline' in late_result['error']
+    
+    def test_recognize_retries_throttled_signatures_after_retry_after(self):
+        
+        signature_generator = SignatureGenerator()
+        signature_generator.feed_input(generate_noise(16000 * 4))
+        
+        with FakeShazamServer(match_probability = 1, retry_after_seconds = 1) as server:
+            
+            server.throttle_next_requests = 1
+            
+            rate_limiter = RateLimiter(100)
+            
+            with ShazamClient(server.base_url) as shazam_client:
+                start_time = perf_counter()
+                results = recognize(shazam_client, signature_generator, rate_limiter)
+            
+            assert results['track']['key'] == results['matches'][0]['id']
+            assert server.num_requests == 2 and rate_limiter.num_throttled == 1
+            assert perf_counter() - start_time >= 1
+    
+    def test_recognize_logs_the_start_of_unmatched_rolling_windows(self):
+        
+        samples = generate_noise(16000 * 12)
+        
+        def make_signature_generator():
+            
+            signature_generator = SignatureGenerator()
+            signature_generator.feed_input(samples)
+            signature_generator.MAX_TIME_SECONDS = 4
+            signature_generator.ROLLING_WINDOW_MODE = True
+            
+            return signature_generator
+        
+        # Windows follow each other, each starting where the previous one ended
+        
+        window_lengths = [signature.number_samples for signature in iter(make_signature_generator().get_next_signature, None)]
+        window_starts = [sum(window_lengths[:position]) / 16000 for position in range(len(window_lengths))]
+        
+        with FakeShazamServer() as server, ShazamClient(server.base_url) as shazam_client:
+            
+            with self.assertLogs('songrec', 'INFO') as logs:
+                recognize(shazam_client, make_signature_generator(), RateLimiter(100))
+        
+        assert len(window_starts) > 2
+        assert [float(message.split('starting at ')[1].split(' ')[0]) for message in logs.output if 'starting at' in message] == window_starts
+    
+    def test_recognize_gives_up_on_signatures_throttled_beyond_the_retry_cap(self):
+        
+        signature_generator = SignatureGenerator()
+        signature_generator.feed_input(generate_noise(16000 * 4))
+        
+        with FakeShazamServer(match_probability = 1) as server:
+            
+            server.throttle_next_requests = 10
+            
+            rate_limiter = RateLimiter(100, backoff_seconds = 0)
+            
+            with ShazamClient(server.base_url) as shazam_client:
+                results = recognize(shazam_client, signature_generator, rate_limiter, max_retries_after_429 = 2)
+            
+            assert results['status_code'] == 429 and results['error']
+            assert server.num_requests == 3 and server.throttle_next_requests == 7
+    
+    def test_rate_limiter_increases_additively_and_halves_once_per_cooldown(self):
+        
+        with patch('rate_limiter.time.time', return_value = 1000.0) as time:
+            
+            rate_limiter = RateLimiter(4)
+            
+            for index in range(10):
+                rate_limiter.update({'matches': []})
+            
+            assert abs(rate_limiter.get_rate() - (4 + 10 * RateLimiter.RATE_INCREASE_PER_SUCCESS)) < 1e-9
+            
+            # 429 answers to requests sent before the decrease are not counted again
+            
+            rate_limiter.update({'error': 'Too many requests', 'status_code': 429})
+            rate_limiter.update({'error': 'Too many requests', 'status_code': 429})
+            
+            assert abs(rate_limiter.get_rate() - 2.05) < 1e-9
+            
+            time.return_value += RateLimiter.THROTTLE_COOLDOWN_SECONDS + 1
+            rate_limiter.update({'error': 'Too many requests', 'status_code': 429})
+            
+            assert abs(rate_limiter.get_rate() - 1.025) < 1e-9
+            assert rate_limiter.num_throttled == 3
+            
+            # Errors other than 429 leave the rate as it is
+            
+            rate_limiter.update({'error': 'Connection refused'})
+            
+            assert abs(rate_limiter.get_rate() - 1.025) < 1e-9
+    
+    def test_rate_limiter_pauses_for_retryms_or_backoff(self):
+        
+        with patch('rate_limiter.time.time', return_value = 1000.0) as time:
+            
+            rate_limiter = RateLimiter(10, backoff_seconds = 60)
+            
+            assert rate_limiter.try_acquire() == 0
+            
+            rate_limiter.update({'error': 'Too many requests', 'status_code': 429, 'retryms': 3000})
+            
+            assert rate_limiter.try_acquire() == 3
+            
+            time.return_value += 3
+            
+            assert rate_limiter.try_acquire() == 0
+            
+            rate_limiter.update({'error': 'Too many requests', 'status_code': 429})
+            
+            assert rate_limiter.try_acquire() == 60
+    
+    def test_file_rate_limiter_backends_share_their_state(self):
+        
+        with TemporaryDirectory() as temporary_directory, patch('rate_limiter.time.time', return_value = 1000.0):
+            
+            state_path = temporary_directory + '/rate_limiter.json'
+            
+            first_rate_limiter = RateLimiter(1, backend = FileRateLimiterBackend(state_path))
+            second_rate_limiter = RateLimiter(1, backend = FileRateLimiterBackend(state_path))
+            
+            # Both take tokens from the same bucket
+            
+            assert first_rate_limiter.try_acquire() == 0
+            assert second_rate_limiter.try_acquire() == 0
+            assert first_rate_limiter.try_acquire() == 1
+            
+            # And are paused and slowed down together
+            
+            first_rate_limiter.update({'error': 'Too many requests', 'status_code': 429, 'retryms': 5000})
+            
+            assert second_rate_limiter.try_acquire() == 5
+            assert second_rate_limiter.get_rate() == 0.5
+    
+    def test_response_cache_expires_no_matches_first_and_evicts(self):
+        
+        signatures = [DecodedMessage.decode_from_uri(STUPEFLIP_DATA_URI_SAMPLE) for index in range(4)]
+        
+        for index, signature in enumerate(signatures):
+            signature.number_samples -= index * 16
+        
+        with TemporaryDirectory() as cache_dir:
+            
+            response_cache = ResponseCache(cache_dir + '/responses.db', match_ttl_seconds = 60, no_match_ttl_seconds = 0.2, max_entries = 3)
+            
+            response_cache.put(signatures[0], {'matches': [{'id': '1'}], 'track': {'key': '1'}})
+            response_cache.put(signatures[1], {'matches': [], 'retryms': 3000})
+            response_cache.put(signatures[2], {'error': '429 Client Error', 'status_code': 429})
+            
+            assert response_cache.get(signatures[0])['track']['key'] == '1'
+            assert response_cache.get(signatures[1]) == {'matches': []}
+            assert response_cache.get(signatures[2]) is None
+            
+            sleep(0.3)
+            
+            assert response_cache.get(signatures[1]) is None
+            
+            response_cache.close()
+            
+            # Shared with the next runs, until evicted
+            
+            response_cache = ResponseCache(cache_dir + '/responses.db', max_entries = 3)
+            
+            assert response_cache.get(signatures[0]) is not None
+            
+            for signature in signatures[1:]:
+                response_cache.put(signature, {'matches': [{'id': '2'}]})
+            
+            assert response_cache.get(signatures[0]) is None and response_cache.get(signatures[3]) is not None
+            
+            response_cache.close()
+    
     
 if __name__ == '__main__':
     
@@ -12,6 +12,7 @@ from psycopg2.extras import DictCursor
 from logging_config import configure_logger
 from env_config import env_config
 from helpers import StatusFetchShazam
+from duplicate_sounds import DuplicateSounds
 
 # Constants
 BLOCKED_KEYWORDS_NOT_TO_REGISTER_SOUND_IN_DB = ["Arewa Trend Music", "DJ SU LAMA DEKAT",
@@ -294,11 +295,17 @@ def analyse_shazam_api_response_json():
     with open(shazam_api_response_path, 'r', encoding='utf-8') as file:
         data = json.load(file)
 
+    # Sounds which were downloaded several times were only recognized once
+    duplicate_sounds = DuplicateSounds(env_config.duplicate_sounds_path)
+    data = duplicate_sounds.fan_out_results(data)
+
     update_shazam_info(data)
 
     with open(shazam_api_response_path, 'w', encoding='utf-8') as json_file:
         json.dump([], json_file)
 
+    duplicate_sounds.save()
+
 
 if __name__ == '__main__':
     analyse_shazam_api_response_json()
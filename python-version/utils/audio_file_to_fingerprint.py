@@ -4,6 +4,7 @@ from numpy import array as nparray, sin, pi, arange, concatenate
 from os.path import dirname, realpath
 from argparse import ArgumentParser
 from pydub import AudioSegment
+from typing import Optional
 
 UTILS_DIR = realpath(dirname(__file__))
 
@@ -15,30 +16,27 @@ sys.path.append(FINGERPRINTING_DIR)
 
 from signature_format import DecodedMessage
 from algorithm import SignatureGenerator
+from signature_cache import SignatureCache
+from resampling import SUPPORTED_SAMPLE_RATES_HZ
 
 """
     Sample usage: ./audio_file_to_fingerprint.py ../tests/stupeflip.wav
 """
 
 
-if __name__ == '__main__':
-
-    args = ArgumentParser(description = 'Generate a Shazam fingerprint from a ' +
-        'sound file, and print it to the standard output.')
-    
-    args.add_argument('input_file', help = 'The .WAV or .MP3 file to generate ' +
-        'an audio fingerprint for.')
+def audio_file_to_fingerprint(input_file : str, signature_cache : Optional[SignatureCache] = None) -> DecodedMessage:
     
-    args = args.parse_args()
+    audio = AudioSegment.from_file(input_file)
     
-    audio = AudioSegment.from_file(args.input_file)
+    # The signature generator downmixes and resamples the decoded audio
+    # itself, as long as it is at a usual sample rate
     
     audio = audio.set_sample_width(2)
-    audio = audio.set_frame_rate(16000)
-    audio = audio.set_channels(1)
+    if audio.frame_rate not in SUPPORTED_SAMPLE_RATES_HZ:
+        audio = audio.set_frame_rate(16000)
     
     signature_generator = SignatureGenerator()
-    signature_generator.feed_input(audio.get_array_of_samples())
+    signature_generator.feed_input(audio.get_array_of_samples(), audio.frame_rate, audio.channels)
     
     # Prefer starting at the middle at the song, and with a
     # substantial bit of music to provide.
@@ -47,7 +45,29 @@ if __name__ == '__main__':
     if audio.duration_seconds > 12 * 3:
         signature_generator.samples_processed += 16000 * (int(audio.duration_seconds / 2) - 6)
     
-    print(signature_generator.get_next_signature().encode_to_uri())
+    if signature_cache:
+        return signature_cache.get_next_signature(signature_generator,
+            SignatureCache.hash_samples(signature_generator.input_pending_processing))
+    
+    return signature_generator.get_next_signature()
+
+
+if __name__ == '__main__':
+
+    args = ArgumentParser(description = 'Generate a Shazam fingerprint from a ' +
+        'sound file, and print it to the standard output.')
+    
+    args.add_argument('input_file', help = 'The .WAV or .MP3 file to generate ' +
+        'an audio fingerprint for.')
+    
+    args.add_argument('--cache-dir', help = 'A directory where to cache ' +
+        'generated fingerprints, keyed by the contents of the decoded audio.')
+    
+    args = args.parse_args()
+    
+    signature_cache = SignatureCache(args.cache_dir) if args.cache_dir else None
+    
+    print(audio_file_to_fingerprint(args.input_file, signature_cache).encode_to_uri())
     
     
     
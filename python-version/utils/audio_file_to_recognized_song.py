@@ -4,6 +4,7 @@ import os
 import sys
 import json
 import time
+import asyncio
 
 from json import dumps
 from os.path import dirname, realpath, join
@@ -11,6 +12,7 @@ from pydub import AudioSegment
 
 from logging_config import configure_logger
 from env_config import env_config
+from rate_limiter import RateLimiter, MemoryRateLimiterBackend, FileRateLimiterBackend, PostgresRateLimiterBackend
 
 UTILS_DIR = realpath(dirname(__file__))
 SCRIPT_DIR = dirname(realpath(__file__))
@@ -19,84 +21,270 @@ FINGERPRINTING_DIR = realpath(ROOT_DIR + '/fingerprinting')
 
 sys.path.append(FINGERPRINTING_DIR)
 from algorithm import SignatureGenerator
-from communication import recognize_song_from_signature
+from communication import ShazamClient, AsyncShazamClient
+from signature_cache import SignatureCache
+from resampling import SUPPORTED_SAMPLE_RATES_HZ
+from landmark_store import LandmarkStore
+from response_cache import ResponseCache
 
 
 logger = configure_logger()
 
 
-class RateLimiter:
-    def __init__(self, max_requests_per_unit=env_config.max_requests_before_rate_limit_reached):
-        self.max_requests_per_unit = max_requests_per_unit
-        self.current_requests = 0
-        self.max_time_unit = env_config.sleep_time_after_rate_limit_reached
+def preprocess_audio(audio):
+    # Downmixing and resampling to 16 kHz is left to SignatureGenerator, except for unusual sample rates
+    audio = audio.set_sample_width(2)
+    if audio.frame_rate not in SUPPORTED_SAMPLE_RATES_HZ:
+        audio = audio.set_frame_rate(16000)
+    return audio
 
-    def increment(self):
-        self.current_requests += 1
-        if self.current_requests >= self.max_requests_per_unit:
-            logger.info('Rate limit reached, waiting for %s seconds...', self.max_time_unit)
-            time.sleep(self.max_time_unit)
-            self.current_requests = 0
 
-    def reset(self):
-        self.current_requests = 0
+def find_local_match(landmark_index, signature):
+    """Return the Shazam response of an already recognized sound which the signature is a copy of, if any."""
+    match = landmark_index.find_best_match(signature)
+    if not match:
+        return None
 
+    track_key, num_landmarks, offset_seconds = match
+    results = landmark_index.get_metadata(track_key)
+    if not results:
+        return None
 
-def preprocess_audio(audio):
-    audio = audio.set_sample_width(2)
-    audio = audio.set_frame_rate(16000)
-    audio = audio.set_channels(1)
-    return audio
+    logger.info('Matched Shazam track %s locally (%d landmarks, %.1f seconds in), skipping the Shazam request',
+                track_key, num_landmarks, offset_seconds)
+    return results
 
 
-def recognize(signature_generator, rate_limiter):
-    results = '(Not enough data)'
+def index_recognized_sound(landmark_index, signature, results):
+    track_key = results.get('track', {}).get('key', '')
+    if str(track_key).isdigit() and not getattr(landmark_index, 'read_only', False):
+        landmark_index.add(int(track_key), signature, results)
 
-    while True:
-        signature = signature_generator.get_next_signature()
-        if not signature:
-            break
 
-        results = recognize_song_from_signature(signature)
-        rate_limiter.increment()
+class Recognition:
+    """
+    State of the recognition of one sound, shared by the blocking and the asyncio drivers (recognize() and
+    recognize_async()), which only differ in how they wait: it decides what to do with every signature and
+    Shazam response, while the drivers send the requests and sleep.
+    """
+
+    def __init__(self, signature_generator, signature_cache=None, input_hash=None, landmark_index=None,
+                 response_cache=None, max_retries_after_429=None):
+        self.signature_generator = signature_generator
+        self.signature_cache = signature_cache
+        self.input_hash = input_hash
+        self.landmark_index = landmark_index
+        self.response_cache = response_cache
+        if max_retries_after_429 is None:
+            max_retries_after_429 = env_config.shazam_max_retries_after_429
+        self.max_retries_after_429 = max_retries_after_429
+
+        self.results = '(Not enough data)'
+        self.first_signature = None
+        self.num_retries_after_429 = 0  # Of the current signature
+
+    def get_next_signature(self):
+        if self.signature_cache:
+            return self.signature_cache.get_next_signature(self.signature_generator, self.input_hash)
+
+        return self.signature_generator.get_next_signature()
+
+    def find_local_match(self, signature):
+        """Return the results of a known sound which the first signature is a copy of, if any."""
+        if self.landmark_index is None or self.first_signature is not None:
+            return None
+
+        # The first signature spans the whole (cut) sound, reused and crops of known sounds are answered locally
+        self.first_signature = signature
+        return find_local_match(self.landmark_index, signature)
+
+    def get_cached_results(self, signature):
+        return self.response_cache.get(signature) if self.response_cache else None
+
+    def handle_response(self, signature, results):
+        """Return the Shazam response to the signature, or None if the request should be sent again."""
+        if results.get('status_code', None) == 429:
+            if self.num_retries_after_429 < self.max_retries_after_429:
+                self.num_retries_after_429 += 1
+                logger.info('Rate limit reached because 429 too many requests, retrying the same signature (%d/%d)',
+                            self.num_retries_after_429, self.max_retries_after_429)
+                return None
+
+            logger.warning('Still answered 429 too many requests after %d retries, giving up',
+                           self.max_retries_after_429)
+            return results
+
+        self.num_retries_after_429 = 0
+
+        if self.response_cache:
+            self.response_cache.put(signature, results)
+
+        return results
+
+    def handle_results(self, results):
+        """
+        Return the number of seconds to wait before trying the next signature, or None if the recognition is over.
+        """
+        self.results = results
 
         if results.get('error', None):
-            status_code = results.get('status_code', None)
-            if status_code == 429:
-                logger.info('Rate limit reached because 429 too many requests, waiting for %s seconds...',
-                            rate_limiter.max_time_unit)
-
-                time.sleep(rate_limiter.max_time_unit)
-                rate_limiter.reset()
-                continue
-            else:
-                logger.error('Error recognizing song: %s', results['error'])
-                break
+            logger.error('Error recognizing song: %s', results['error'])
+            return None
 
         if results.get('matches', []):
-            break
+            if self.landmark_index is not None:
+                index_recognized_sound(self.landmark_index, self.first_signature, results)
+            return None
 
         if results.get('retryms', None):
             retry_time_ms = results['retryms']
             logger.info('[Note: No matching songs found, retrying in %d ms...]', retry_time_ms)
-            time.sleep(retry_time_ms / 1000)
+            return retry_time_ms / 1000
+
+        if self.signature_generator.ROLLING_WINDOW_MODE:
+            logger.info('[Note: No matching songs for the window starting at %g seconds]',
+                        self.signature_generator.last_signature_offset / 16000)
         else:
             logger.info('[Note: No matching songs for the first %g seconds]',
-                        signature_generator.samples_processed / 16000)
+                        self.signature_generator.samples_processed / 16000)
+        return 0
 
-    return results
 
+def recognize(shazam_client, signature_generator, rate_limiter, signature_cache=None, input_hash=None,
+              landmark_index=None, response_cache=None, max_retries_after_429=None):
+    recognition = Recognition(signature_generator, signature_cache, input_hash, landmark_index, response_cache,
+                              max_retries_after_429)
+
+    while True:
+        signature = recognition.get_next_signature()
+        if not signature:
+            break
+
+        local_results = recognition.find_local_match(signature)
+        if local_results:
+            return local_results
+
+        results = recognition.get_cached_results(signature)
+        while results is None:
+            rate_limiter.acquire()
+            response = shazam_client.recognize_song_from_signature(signature)
+            rate_limiter.update(response)
+            results = recognition.handle_response(signature, response)
+
+        wait_seconds = recognition.handle_results(results)
+        if wait_seconds is None:
+            break
+        time.sleep(wait_seconds)
+
+    return recognition.results
+
+
+async def recognize_async(shazam_client, signature_generator, rate_limiter, signature_cache=None, input_hash=None,
+                          landmark_index=None, response_cache=None, max_retries_after_429=None):
+    """Asyncio counterpart of recognize(), generating signatures in a worker thread."""
+    recognition = Recognition(signature_generator, signature_cache, input_hash, landmark_index, response_cache,
+                              max_retries_after_429)
+
+    while True:
+        signature = await asyncio.to_thread(recognition.get_next_signature)
+        if not signature:
+            break
+
+        local_results = recognition.find_local_match(signature)
+        if local_results:
+            return local_results
+
+        results = recognition.get_cached_results(signature)
+        while results is None:
+            await rate_limiter.acquire_async()
+            response = await shazam_client.recognize_song_from_signature(signature)
+            await rate_limiter.update_async(response)
+            results = recognition.handle_response(signature, response)
+
+        wait_seconds = recognition.handle_results(results)
+        if wait_seconds is None:
+            break
+        await asyncio.sleep(wait_seconds)
+
+    return recognition.results
+
+
+def get_rate_limiter():
+    """
+    Return the rate limiter of the Shazam requests, whose state is shared with the other processes using the
+    same SHAZAM_RATE_LIMITER_STATE_PATH file ("file" backend) or database ("postgres" backend).
+    """
+    backend_name = env_config.shazam_rate_limiter_backend
+
+    if backend_name == 'file':
+        backend = FileRateLimiterBackend(env_config.shazam_rate_limiter_state_path)
+    elif backend_name == 'postgres':
+        backend = PostgresRateLimiterBackend(env_config.database_url)
+    else:
+        backend = MemoryRateLimiterBackend()
 
-def process_audio_file(file_path: str, rate_limiter: RateLimiter):
+    return RateLimiter(env_config.max_requests_before_rate_limit_reached / env_config.sleep_time_after_rate_limit_reached,
+                       env_config.sleep_time_after_rate_limit_reached, backend)
+
+
+def get_signature_cache():
+    if not env_config.signature_cache_dir:
+        return None
+
+    return SignatureCache(env_config.signature_cache_dir, env_config.signature_cache_max_size_mb * 1024 * 1024)
+
+
+def get_response_cache():
+    if not env_config.shazam_response_cache_path:
+        return None
+
+    return ResponseCache(env_config.shazam_response_cache_path,
+                         env_config.shazam_response_cache_match_ttl_days * 24 * 3600,
+                         env_config.shazam_response_cache_no_match_ttl_days * 24 * 3600,
+                         env_config.shazam_response_cache_max_entries)
+
+
+def close_response_cache(response_cache):
+    if response_cache is not None:
+        logger.info('%d Shazam responses found in the cache, %d requested', response_cache.num_hits,
+                    response_cache.num_misses)
+        response_cache.close()
+
+
+def get_landmark_index():
+    if not env_config.landmark_index_path:
+        return None
+
+    try:
+        return LandmarkStore(env_config.landmark_index_path)
+    except PermissionError as error:
+        # Another handler of the host is the writer, only look up the sounds it indexes
+        logger.warning('%s, opening it read-only', error)
+
+    try:
+        return LandmarkStore(env_config.landmark_index_path, read_only=True)
+    except FileNotFoundError:
+        # The writer has not created the table yet
+        logger.warning('The landmark index %s is not created yet, running without it',
+                       env_config.landmark_index_path)
+        return None
+
+
+def process_audio_file(file_path: str, shazam_client: ShazamClient, rate_limiter: RateLimiter,
+                       signature_cache: SignatureCache = None, fingerprint_stats: dict = None,
+                       landmark_index: LandmarkStore = None, response_cache: ResponseCache = None):
+    """
+    Recognize a file. When a "fingerprint_stats" dict is passed (or LOG_FINGERPRINT_STATS is set), the
+    per-stage profiling data of the signature generator is stored into it (respectively logged).
+    """
     try:
-        audio = AudioSegment.from_file(file_path)
-        audio_processed = preprocess_audio(audio)
+        signature_generator = prepare_signature_generator(file_path, fingerprint_stats)
+
+        input_hash = SignatureCache.hash_samples(signature_generator.input_pending_processing) if signature_cache else None
+        results = recognize(shazam_client, signature_generator, rate_limiter, signature_cache, input_hash,
+                            landmark_index, response_cache)
 
-        logger.info("Running recognition attempt...")
-        signature_generator = SignatureGenerator()
-        signature_generator.feed_input(audio_processed.get_array_of_samples())
-        signature_generator.MAX_TIME_SECONDS = 16
-        results = recognize(signature_generator, rate_limiter)
+        report_fingerprint_stats(file_path, signature_generator, fingerprint_stats)
 
         return file_path, results
 
@@ -105,33 +293,146 @@ def process_audio_file(file_path: str, rate_limiter: RateLimiter):
         return file_path, {"error": str(e)}
 
 
-def main():
+async def process_audio_file_async(file_path: str, shazam_client: AsyncShazamClient, rate_limiter: RateLimiter,
+                                   signature_cache: SignatureCache = None, landmark_index: LandmarkStore = None,
+                                   response_cache: ResponseCache = None):
+    """Asyncio counterpart of process_audio_file(), decoding and fingerprinting the file in a worker thread."""
+    try:
+        signature_generator = await asyncio.to_thread(prepare_signature_generator, file_path)
+
+        input_hash = await asyncio.to_thread(SignatureCache.hash_samples, signature_generator.input_pending_processing) if signature_cache else None
+        results = await recognize_async(shazam_client, signature_generator, rate_limiter, signature_cache, input_hash,
+                                        landmark_index, response_cache)
+
+        report_fingerprint_stats(file_path, signature_generator)
+
+        return file_path, results
+
+    except Exception as e:
+        logger.error('Error processing file %s: %s', file_path, e, exc_info=True)
+        return file_path, {"error": str(e)}
+
+
+def prepare_signature_generator(file_path: str, fingerprint_stats: dict = None):
+    audio = AudioSegment.from_file(file_path)
+    audio_processed = preprocess_audio(audio)
+    samples = audio_processed.get_array_of_samples()
+
+    logger.info("Running recognition attempt...")
+    signature_generator = SignatureGenerator()
+    signature_generator.feed_input(samples, audio_processed.frame_rate, audio_processed.channels)
+    signature_generator.MAX_TIME_SECONDS = 16
+    # Retried windows are cut from peaks computed once for the whole file
+    signature_generator.ROLLING_WINDOW_MODE = True
+
+    if fingerprint_stats is not None or env_config.log_fingerprint_stats:
+        signature_generator.enable_stats()
+
+    return signature_generator
+
+
+def report_fingerprint_stats(file_path: str, signature_generator: SignatureGenerator, fingerprint_stats: dict = None):
+    if signature_generator.stats:
+        stats = signature_generator.stats.to_dict()
+        if fingerprint_stats is not None:
+            fingerprint_stats.update(stats)
+        if env_config.log_fingerprint_stats:
+            logger.info('Fingerprinting stats for %s: %s', file_path, dumps(stats))
+
+
+def list_audio_files():
+    return [join(env_config.download_dir, file_name) for file_name in os.listdir(env_config.download_dir)
+            if file_name.endswith('.wav') or file_name.endswith('.mp3')]
+
+
+def prepare_json_output():
     json_output_path = env_config.shazam_api_response_path
 
     if not os.path.exists(json_output_path):
         with open(json_output_path, 'w', encoding='utf-8') as json_file:
             json.dump([], json_file)
 
-    rate_limiter = RateLimiter()
+    return json_output_path
 
-    for file_name in os.listdir(env_config.download_dir):
-        if file_name.endswith('.wav') or file_name.endswith('.mp3'):
-            file_path = join(env_config.download_dir, file_name)
-            logger.info('Processing file: %s', file_path)
 
-            file_path, result = process_audio_file(file_path, rate_limiter)
+def save_result(json_output_path: str, file_path: str, result):
+    with open(json_output_path, 'r+', encoding='utf-8') as json_file:
+        all_results = json.load(json_file)
+        all_results.append({"file": file_path, "result": result})
+        json_file.seek(0)
+        json.dump(all_results, json_file, indent=4, ensure_ascii=False)
+        json_file.truncate()
+
+
+def close_landmark_index(landmark_index):
+    if landmark_index is not None:
+        logger.info('%d recognized sounds in the landmark index %s', len(landmark_index),
+                    env_config.landmark_index_path)
+        landmark_index.close()
+
+
+def main():
+    json_output_path = prepare_json_output()
+
+    rate_limiter = get_rate_limiter()
+    signature_cache = get_signature_cache()
+    landmark_index = get_landmark_index()
+    response_cache = get_response_cache()
+
+    try:
+        with ShazamClient() as shazam_client:
+            for file_path in list_audio_files():
+                logger.info('Processing file: %s', file_path)
+
+                file_path, result = process_audio_file(file_path, shazam_client, rate_limiter, signature_cache,
+                                                       landmark_index=landmark_index, response_cache=response_cache)
+
+                save_result(json_output_path, file_path, result)
+                os.remove(file_path)
+    finally:
+        close_landmark_index(landmark_index)
+        close_response_cache(response_cache)
+
+    logger.info('All results have been saved to %s (%.1f seconds spent waiting for the rate limiter)',
+                json_output_path, rate_limiter.sleep_seconds)
+
+
+async def main_async(concurrency: int):
+    """
+    Recognize the files of the sounds directory with up to "concurrency" files, and as many Shazam requests, in
+    flight at once, so that network waits overlap with the decoding and fingerprinting of other files.
+    """
+    json_output_path = prepare_json_output()
+
+    rate_limiter = get_rate_limiter()
+    signature_cache = get_signature_cache()
+    landmark_index = get_landmark_index()
+    response_cache = get_response_cache()
+    files_semaphore = asyncio.Semaphore(concurrency)
+
+    async def process(shazam_client, file_path):
+        async with files_semaphore:
+            logger.info('Processing file: %s', file_path)
 
-            with open(json_output_path, 'r+', encoding='utf-8') as json_file:
-                all_results = json.load(json_file)
-                all_results.append({"file": file_path, "result": result})
-                json_file.seek(0)
-                json.dump(all_results, json_file, indent=4, ensure_ascii=False)
-                json_file.truncate()
+            file_path, result = await process_audio_file_async(file_path, shazam_client, rate_limiter,
+                                                               signature_cache, landmark_index, response_cache)
 
+            save_result(json_output_path, file_path, result)
             os.remove(file_path)
 
-    logger.info('All results have been saved to %s', json_output_path)
+    try:
+        async with AsyncShazamClient(max_concurrency=concurrency) as shazam_client:
+            await asyncio.gather(*(process(shazam_client, file_path) for file_path in list_audio_files()))
+    finally:
+        close_landmark_index(landmark_index)
+        close_response_cache(response_cache)
+
+    logger.info('All results have been saved to %s (%.1f seconds spent waiting for the rate limiter)',
+                json_output_path, rate_limiter.sleep_seconds)
 
 
 if __name__ == '__main__':
-    main()
+    if env_config.shazam_concurrency > 1:
+        asyncio.run(main_async(env_config.shazam_concurrency))
+    else:
+        main()
@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+from os.path import dirname, realpath
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from os import cpu_count
+from typing import Iterable, Iterator, Optional, Tuple
+from base64 import b64encode
+from functools import partial, lru_cache
+from hashlib import blake2b
+from contextlib import nullcontext
+
+UTILS_DIR = realpath(dirname(__file__))
+
+ROOT_DIR = realpath(UTILS_DIR + '/..')
+FINGERPRINTING_DIR = realpath(ROOT_DIR + '/fingerprinting')
+
+import sys
+sys.path.append(FINGERPRINTING_DIR)
+
+from signature_format import DATA_URI_PREFIX
+from audio_file_to_fingerprint import audio_file_to_fingerprint
+from signature_cache import SignatureCache
+from signature_archive import SignatureArchive
+
+"""
+    Sample usage: ./audio_files_to_fingerprints.py --workers 16 ../sounds/*.mp3
+"""
+
+
+"""
+    Open the signature cache in "cache_dir" once per worker process, rather
+    than once per file.
+"""
+
+@lru_cache(maxsize = None)
+def get_signature_cache(cache_dir : str) -> SignatureCache:
+
+    return SignatureCache(cache_dir)
+
+
+"""
+    Decode and fingerprint a single file, in a worker process. The
+    signature is sent back to the parent process in its binary form, which
+    is much cheaper to pickle than a DecodedMessage and its peaks.
+"""
+
+def fingerprint_file_to_binary(input_file : str, cache_dir : Optional[str] = None) -> Tuple[str, Optional[bytes], Optional[str]]:
+
+    try:
+        signature_cache = get_signature_cache(cache_dir) if cache_dir else None
+
+        return input_file, audio_file_to_fingerprint(input_file, signature_cache).encode_to_binary(), None
+
+    except Exception as error:
+        return input_file, None, str(error)
+
+
+"""
+    Fingerprint many audio files at once, spreading the decoding and the
+    signature generation over a pool of worker processes (one per core by
+    default). Files are dispatched to workers by chunks of "chunksize".
+    Workers share the signature cache in "cache_dir", if passed.
+
+    When "archive_path" is passed, the generated signatures are also
+    appended to the SignatureArchive at this path (by the parent process,
+    its only writer), keyed by the digest of their binary form so that
+    identical signatures are only kept once.
+
+    Yields (file path, binary signature, error message) tuples in
+    completion order, the signature being None when an error occurred. Use
+    DecodedMessage.decode_from_binary() to obtain the signatures back.
+"""
+
+def fingerprint_many(input_files : Iterable[str], workers : Optional[int] = None, chunksize : int = 4, cache_dir : Optional[str] = None, archive_path : Optional[str] = None) -> Iterator[Tuple[str, Optional[bytes], Optional[str]]]:
+
+    with Pool(workers or cpu_count()) as pool, (SignatureArchive(archive_path) if archive_path else nullcontext()) as archive:
+
+        for input_file, signature_binary, error in pool.imap_unordered(partial(fingerprint_file_to_binary, cache_dir = cache_dir), input_files, chunksize = chunksize):
+
+            if archive is not None and signature_binary is not None:
+                archive.put(blake2b(signature_binary, digest_size = 20).digest(), signature_binary)
+
+            yield input_file, signature_binary, error
+
+
+if __name__ == '__main__':
+
+    args = ArgumentParser(description = 'Generate Shazam fingerprints for ' +
+        'many sound files using several processes, and print them to the ' +
+        'standard output as they are completed (one "path<TAB>data-URI" ' +
+        'line per file).')
+
+    args.add_argument('input_files', nargs = '+', help = 'The .WAV or .MP3 ' +
+        'files to generate audio fingerprints for.')
+
+    args.add_argument('--workers', type = int, default = None, help = 'The ' +
+        'number of worker processes (defaults to the number of CPU cores).')
+
+    args.add_argument('--chunksize', type = int, default = 4, help = 'The ' +
+        'number of files dispatched to a worker process at once.')
+
+    args.add_argument('--cache-dir', help = 'A directory where to cache ' +
+        'generated fingerprints, keyed by the contents of the decoded audio.')
+
+    args.add_argument('--archive', help = 'The path prefix of a signature ' +
+        'archive (its .data and .index files) where to keep the generated ' +
+        'fingerprints.')
+
+    args = args.parse_args()
+
+    for input_file, signature_binary, error in fingerprint_many(args.input_files, args.workers, args.chunksize, args.cache_dir, args.archive):
+
+        if signature_binary is None:
+            print('Error fingerprinting %s: %s' % (input_file, error), file = sys.stderr)
+            continue
+
+        print('%s\t%s' % (input_file, DATA_URI_PREFIX + b64encode(signature_binary).decode('ascii')))
@@ -0,0 +1,194 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+from os.path import dirname, realpath, isdir, join
+from argparse import ArgumentParser
+from collections import Counter
+from itertools import zip_longest
+from typing import Dict, List, Any
+from os import listdir
+from json import dumps
+from numpy import float32, float64
+from pydub import AudioSegment
+
+UTILS_DIR = realpath(dirname(__file__))
+
+ROOT_DIR = realpath(UTILS_DIR + '/..')
+FINGERPRINTING_DIR = realpath(ROOT_DIR + '/fingerprinting')
+
+import sys
+sys.path.append(FINGERPRINTING_DIR)
+
+from signature_format import DecodedMessage, FrequencyBand
+from algorithm import SignatureGenerator
+
+"""
+    Sample usage: ./compare_fingerprint_precisions.py ../sounds/
+
+    Generate the signatures of every file of a corpus both in the default
+    double precision mode and in the reduced precision (float32) mode of
+    SignatureGenerator, and report peak-level differences per frequency
+    band, so that the latter can be proven not to hurt match rates.
+
+    Peaks are compared over a single signature spanning each whole file, so
+    that a window boundary moved by a differing peak count does not
+    misalign the comparison of all the following windows. The numbers of
+    MAX_TIME_SECONDS signatures of both modes are reported too.
+"""
+
+
+STORED_FREQUENCY_BANDS = list(FrequencyBand)[1:] # The first band, below 250 Hz, is not stored
+
+
+def generate_signatures(s16le_mono_samples, dtype, max_time_seconds : float) -> List[DecodedMessage]:
+
+    signature_generator = SignatureGenerator(dtype = dtype)
+    signature_generator.MAX_TIME_SECONDS = max_time_seconds
+    signature_generator.feed_input(s16le_mono_samples)
+
+    return list(iter(signature_generator.get_next_signature, None))
+
+
+"""
+    Cut a single signature spanning the whole input out of the peaks of a
+    rolling window mode generator.
+"""
+
+def generate_whole_input_signature(s16le_mono_samples, dtype) -> DecodedMessage:
+
+    signature_generator = SignatureGenerator(dtype = dtype)
+    signature_generator.ROLLING_WINDOW_MODE = True
+    signature_generator.feed_input(s16le_mono_samples)
+
+    return signature_generator.get_signature_at(0, len(s16le_mono_samples) / 16000)
+
+
+"""
+    Count, for each frequency band, the peaks of the candidate signature
+    that are also in the reference one ("matched", same FFT pass and FFT
+    bin), that are not ("added"), the peaks of the reference signature that
+    are missing from the candidate one ("missing"), and the matched peaks
+    whose interpolated magnitude or frequency differ ("changed").
+"""
+
+def compare_signatures(reference : DecodedMessage, candidate : DecodedMessage) -> Dict[FrequencyBand, Counter]:
+
+    band_to_counts : Dict[FrequencyBand, Counter] = {}
+
+    for frequency_band in STORED_FREQUENCY_BANDS:
+
+        reference_peaks = {
+            (frequency_peak.fft_pass_number, round(frequency_peak.corrected_peak_frequency_bin / 64)): frequency_peak
+            for frequency_peak in reference.frequency_band_to_sound_peaks.get(frequency_band, [])
+        }
+        candidate_peaks = {
+            (frequency_peak.fft_pass_number, round(frequency_peak.corrected_peak_frequency_bin / 64)): frequency_peak
+            for frequency_peak in candidate.frequency_band_to_sound_peaks.get(frequency_band, [])
+        }
+
+        counts = band_to_counts[frequency_band] = Counter({'matched': 0, 'added': 0, 'missing': 0, 'changed': 0})
+
+        for peak_key, frequency_peak in candidate_peaks.items():
+
+            reference_peak = reference_peaks.get(peak_key)
+
+            if reference_peak is None:
+                counts['added'] += 1
+                continue
+
+            counts['matched'] += 1
+
+            if (reference_peak.peak_magnitude, reference_peak.corrected_peak_frequency_bin) != (frequency_peak.peak_magnitude, frequency_peak.corrected_peak_frequency_bin):
+                counts['changed'] += 1
+
+        counts['missing'] += len(reference_peaks.keys() - candidate_peaks.keys())
+
+    return band_to_counts
+
+
+"""
+    Compare the double and single precision fingerprints of some samples:
+    peak-level differences per frequency band over the whole input, and
+    numbers of MAX_TIME_SECONDS signatures (which differ if a window
+    boundary moved) and of identical ones.
+"""
+
+def compare_precisions(s16le_mono_samples, max_time_seconds : float) -> Dict[str, Any]:
+
+    band_to_counts : Dict[FrequencyBand, Counter] = compare_signatures(
+        generate_whole_input_signature(s16le_mono_samples, float64),
+        generate_whole_input_signature(s16le_mono_samples, float32))
+
+    references : List[DecodedMessage] = generate_signatures(s16le_mono_samples, float64, max_time_seconds)
+    candidates : List[DecodedMessage] = generate_signatures(s16le_mono_samples, float32, max_time_seconds)
+
+    return {
+        'band_to_counts': band_to_counts,
+        'num_reference_signatures': len(references),
+        'num_candidate_signatures': len(candidates),
+        'num_identical_signatures': sum(
+            reference is not None and candidate is not None and reference.encode_to_binary() == candidate.encode_to_binary()
+            for reference, candidate in zip_longest(references, candidates))
+    }
+
+
+if __name__ == '__main__':
+
+    args = ArgumentParser(description = 'Compare the signatures generated in ' +
+        'double and single precision modes over a corpus of sound files, and ' +
+        'print peak-level differences as JSON to the standard output.')
+
+    args.add_argument('input_files', nargs = '+', help = 'The .WAV or .MP3 ' +
+        'files (or directories of files) to compare signatures for.')
+
+    args.add_argument('--max-time-seconds', type = float, default = 3.1, help = 'The ' +
+        'MAX_TIME_SECONDS setting of the signature generator.')
+
+    args = args.parse_args()
+
+    input_files : List[str] = []
+
+    for input_file in args.input_files:
+        if isdir(input_file):
+            input_files += sorted(join(input_file, file_name) for file_name in listdir(input_file)
+                if file_name.endswith('.wav') or file_name.endswith('.mp3'))
+        else:
+            input_files.append(input_file)
+
+    total_band_to_counts : Dict[FrequencyBand, Counter] = {frequency_band: Counter() for frequency_band in STORED_FREQUENCY_BANDS}
+    num_signatures = num_identical_signatures = num_signature_count_mismatches = 0
+
+    for input_file in input_files:
+
+        audio = AudioSegment.from_file(input_file)
+
+        audio = audio.set_sample_width(2)
+        audio = audio.set_frame_rate(16000)
+        audio = audio.set_channels(1)
+
+        comparison : Dict[str, Any] = compare_precisions(audio.get_array_of_samples(), args.max_time_seconds)
+
+        num_signatures += comparison['num_reference_signatures']
+        num_identical_signatures += comparison['num_identical_signatures']
+
+        for frequency_band, counts in comparison['band_to_counts'].items():
+            total_band_to_counts[frequency_band].update(counts)
+
+        if comparison['num_reference_signatures'] != comparison['num_candidate_signatures']:
+            num_signature_count_mismatches += 1
+
+            print('Signature count mismatch for %s: %d in double precision, %d in single precision' % (input_file,
+                comparison['num_reference_signatures'], comparison['num_candidate_signatures']), file = sys.stderr)
+
+        print(dumps({
+            'file': input_file,
+            'num_signatures': {'float64': comparison['num_reference_signatures'], 'float32': comparison['num_candidate_signatures']},
+            'bands': {frequency_band.name.strip('_'): dict(counts) for frequency_band, counts in comparison['band_to_counts'].items()}
+        }))
+
+    print(dumps({
+        'num_files': len(input_files),
+        'num_signatures': num_signatures,
+        'num_identical_signatures': num_identical_signatures,
+        'num_signature_count_mismatches': num_signature_count_mismatches,
+        'bands': {frequency_band.name.strip('_'): dict(counts) for frequency_band, counts in total_band_to_counts.items()}
+    }, indent = 4))
@@ -0,0 +1,134 @@
+import os
+import json
+
+from hashlib import blake2b
+from typing import Dict, List, Optional
+from pydub import AudioSegment
+
+from logging_config import configure_logger
+
+logger = configure_logger()
+
+
+def hash_raw_bytes(content: bytes) -> str:
+    return 'raw:' + blake2b(content, digest_size=20).hexdigest()
+
+
+def hash_decoded_pcm(file_path: str) -> Optional[str]:
+    """
+    Hash the audio of a file once decoded and normalized to 16 kHz mono 16-bit PCM, so that copies which
+    differ only by their container or tags are detected too.
+    """
+    try:
+        audio = AudioSegment.from_file(file_path)
+    except Exception as error:
+        logger.warning('Could not decode %s to hash its audio: %s', file_path, error)
+        return None
+
+    audio = audio.set_channels(1).set_frame_rate(16000).set_sample_width(2)
+    return 'pcm:' + blake2b(audio.raw_data, digest_size=20).hexdigest()
+
+
+class DuplicateSounds:
+    """
+    Groups of downloaded TikTok sounds with identical contents, kept in a JSON file between the download step
+    (which only keeps the file of the first sound of every group, its representative) and the analysis step
+    (which applies the Shazam result of the representative to the whole group).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.hash_to_representative: Dict[str, str] = {}
+        self.representative_to_duplicates: Dict[str, List[str]] = {}
+
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as manifest_file:
+                manifest = json.load(manifest_file)
+
+            self.hash_to_representative = manifest.get('hashes', {})
+            self.representative_to_duplicates = manifest.get('duplicates', {})
+
+    def save(self):
+        temporary_path = self.path + '.tmp'
+
+        with open(temporary_path, 'w', encoding='utf-8') as manifest_file:
+            json.dump({'hashes': self.hash_to_representative, 'duplicates': self.representative_to_duplicates},
+                      manifest_file, indent=4)
+
+        os.replace(temporary_path, self.path)
+
+    def find_representative(self, content_hash: Optional[str]) -> Optional[str]:
+        return self.hash_to_representative.get(content_hash) if content_hash else None
+
+    def add_representative(self, tiktok_sound_id, content_hashes: List[Optional[str]]):
+        for content_hash in content_hashes:
+            if content_hash:
+                self.hash_to_representative.setdefault(content_hash, str(tiktok_sound_id))
+
+    def add_duplicate(self, representative: str, tiktok_sound_id):
+        duplicates = self.representative_to_duplicates.setdefault(representative, [])
+
+        if str(tiktok_sound_id) != representative and str(tiktok_sound_id) not in duplicates:
+            duplicates.append(str(tiktok_sound_id))
+
+    def fan_out_results(self, results: List[dict]) -> List[dict]:
+        """
+        Return the Shazam results with a copy of the result of every representative for each of its duplicates,
+        and forget all the groups: the sounds directory is cleaned after every analysis, so a representative
+        without a result will not be recognized later and its group would otherwise be kept forever.
+        """
+        fanned_out_results = list(results)
+
+        for item in results:
+            file_path = item.get('file', '')
+            base, ext = os.path.splitext(os.path.basename(file_path))
+
+            for tiktok_sound_id in self.representative_to_duplicates.pop(base, []):
+                fanned_out_results.append({
+                    'file': os.path.join(os.path.dirname(file_path), tiktok_sound_id + ext),
+                    'result': item.get('result', {})
+                })
+
+        for representative, duplicates in self.representative_to_duplicates.items():
+            logger.warning('TikTok sound %s has no Shazam result, its duplicates %s are not recognized',
+                           representative, ', '.join(duplicates))
+
+        self.hash_to_representative = {}
+        self.representative_to_duplicates = {}
+
+        if len(fanned_out_results) > len(results):
+            logger.info('Applying the Shazam results of %d sounds to %d duplicate sounds',
+                        len(results), len(fanned_out_results) - len(results))
+
+        return fanned_out_results
+
+def save_unless_duplicate(duplicate_sounds: DuplicateSounds, content: bytes, file_path: str, tiktok_sound_id):
+    """
+    Save a downloaded sound, unless its bytes or its decoded audio are identical to those of a sound already
+    downloaded, in which case it is only recorded as a duplicate of the latter (which will be recognized for both).
+    """
+    raw_hash = hash_raw_bytes(content)
+    representative = duplicate_sounds.find_representative(raw_hash)
+    pcm_hash = None
+
+    # A sound downloaded again matches its own hashes, it is not a duplicate and its file must be written again
+    if representative is not None and representative == str(tiktok_sound_id):
+        representative = None
+
+    if representative is None:
+        with open(file_path, 'wb') as file:
+            file.write(content)
+
+        pcm_hash = hash_decoded_pcm(file_path)
+        representative = duplicate_sounds.find_representative(pcm_hash)
+
+        if representative is not None and representative != str(tiktok_sound_id):
+            os.remove(file_path)
+
+    if representative is not None and representative != str(tiktok_sound_id):
+        duplicate_sounds.add_duplicate(representative, tiktok_sound_id)
+        logger.info('TikTok sound %s is a duplicate of %s, it will not be recognized separately',
+                    tiktok_sound_id, representative)
+        return
+
+    duplicate_sounds.add_representative(tiktok_sound_id, [raw_hash, pcm_hash])
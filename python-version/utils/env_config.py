@@ -11,9 +11,9 @@ class EnvConfig:
         self._download_dir = None
 
     def _get_env_var(self, var_name, default=None, required=False, cast_type=str):
-        """Retrieve and cache environment variables."""
+        """Retrieve and cache environment variables, variables set to an empty value getting the default."""
         if var_name not in self._config:
-            value = os.getenv(var_name, default)
+            value = os.getenv(var_name) or default
 
             if required and not value:
                 raise ValueError(f'{var_name} environment variable not set')
@@ -38,6 +38,11 @@ class EnvConfig:
     def shazam_api_response_path(self):
         return self._get_env_var('SHAZAM_API_RESPONSE_PATH', required=True)
 
+    @property
+    def duplicate_sounds_path(self):
+        default_path = os.path.splitext(self.shazam_api_response_path)[0] + '_duplicates.json'
+        return self._get_env_var('DUPLICATE_SOUNDS_PATH') or default_path
+
     @property
     def limit_tiktok_sounds_to_fetch(self):
         return self._get_env_var('TIKTOK_SOUNDS_TO_FETCH_LIMIT', 4000, cast_type=int)
@@ -50,6 +55,55 @@ class EnvConfig:
     def sleep_time_after_rate_limit_reached(self):
         return self._get_env_var('SHAZAM_SLEEP_TIME_AFTER_RATE_LIMIT_REACHED', 60, cast_type=int)
 
+    @property
+    def shazam_max_retries_after_429(self):
+        return self._get_env_var('SHAZAM_MAX_RETRIES_AFTER_429', 5, cast_type=int)
+
+    @property
+    def shazam_concurrency(self):
+        return self._get_env_var('SHAZAM_CONCURRENCY', 1, cast_type=int) or 1
+
+    @property
+    def shazam_rate_limiter_backend(self):
+        return self._get_env_var('SHAZAM_RATE_LIMITER_BACKEND', 'memory').lower()
+
+    @property
+    def shazam_rate_limiter_state_path(self):
+        default_path = os.path.splitext(self.shazam_api_response_path)[0] + '_rate_limiter.json'
+        return self._get_env_var('SHAZAM_RATE_LIMITER_STATE_PATH') or default_path
+
+    @property
+    def signature_cache_dir(self):
+        return self._get_env_var('SIGNATURE_CACHE_DIR')
+
+    @property
+    def signature_cache_max_size_mb(self):
+        return self._get_env_var('SIGNATURE_CACHE_MAX_SIZE_MB', 256, cast_type=int)
+
+    @property
+    def log_fingerprint_stats(self):
+        return self._get_env_var('LOG_FINGERPRINT_STATS', 'false').lower() in ('1', 'true', 'yes')
+
+    @property
+    def landmark_index_path(self):
+        return self._get_env_var('LANDMARK_INDEX_PATH')
+
+    @property
+    def shazam_response_cache_path(self):
+        return self._get_env_var('SHAZAM_RESPONSE_CACHE_PATH')
+
+    @property
+    def shazam_response_cache_match_ttl_days(self):
+        return self._get_env_var('SHAZAM_RESPONSE_CACHE_MATCH_TTL_DAYS', 30, cast_type=float)
+
+    @property
+    def shazam_response_cache_no_match_ttl_days(self):
+        return self._get_env_var('SHAZAM_RESPONSE_CACHE_NO_MATCH_TTL_DAYS', 1, cast_type=float)
+
+    @property
+    def shazam_response_cache_max_entries(self):
+        return self._get_env_var('SHAZAM_RESPONSE_CACHE_MAX_ENTRIES', 100000, cast_type=int)
+
     @property
     def handler_code(self):
         return self._get_env_var('HANDLER_CODE', socket.gethostname(), cast_type=str)
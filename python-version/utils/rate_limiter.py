@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+# -*- encoding: Utf-8 -*-
+import json
+import time
+import fcntl
+import asyncio
+import threading
+
+from contextlib import contextmanager
+from hashlib import blake2b
+
+from logging_config import configure_logger
+
+logger = configure_logger()
+
+
+class MemoryRateLimiterBackend:
+    """Rate limiter state shared by the threads of a single process."""
+
+    def __init__(self):
+        self.state = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def locked_state(self):
+        with self.lock:
+            yield self.state
+
+
+class FileRateLimiterBackend:
+    """Rate limiter state shared by the processes of a host, as a JSON file locked with flock()."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @contextmanager
+    def locked_state(self):
+        with open(self.path, 'a+', encoding='utf-8') as state_file:
+            fcntl.flock(state_file, fcntl.LOCK_EX)  # Released when the file is closed
+
+            state_file.seek(0)
+            content = state_file.read()
+            state = json.loads(content) if content else {}
+
+            yield state
+
+            state_file.seek(0)
+            state_file.truncate()
+            json.dump(state, state_file)
+            state_file.flush()
+
+
+class PostgresRateLimiterBackend:
+    """
+    Rate limiter state shared by the processes of several hosts, as a row of the database which is only accessed
+    under a transaction-level advisory lock.
+    """
+
+    def __init__(self, database_url: str, name: str = 'shazam'):
+        import psycopg2
+
+        self.name = name
+        self.lock_key = int.from_bytes(blake2b(name.encode('utf-8'), digest_size=8).digest(), 'big', signed=True)
+        self.lock = threading.Lock()
+
+        self.connection = psycopg2.connect(database_url)
+
+        with self.connection, self.connection.cursor() as cursor:
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS rate_limiter_state (
+                name    TEXT PRIMARY KEY,
+                state   TEXT NOT NULL
+            );
+            ''')
+
+    @contextmanager
+    def locked_state(self):
+        with self.lock, self.connection, self.connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s);', (self.lock_key,))
+
+            cursor.execute('SELECT state FROM rate_limiter_state WHERE name = %s;', (self.name,))
+            row = cursor.fetchone()
+            state = json.loads(row[0]) if row else {}
+
+            yield state
+
+            cursor.execute('''
+            INSERT INTO rate_limiter_state (name, state)
+            VALUES (%s, %s)
+            ON CONFLICT (name) DO UPDATE SET state = EXCLUDED.state;
+            ''', (self.name, json.dumps(state)))
+
+
+class RateLimiter:
+    """
+    Token bucket limiting the rate of Shazam requests, whose rate adapts to the allowance of the server (AIMD):
+    it grows by RATE_INCREASE_PER_SUCCESS requests per second after every successful request, and is multiplied
+    by RATE_DECREASE_FACTOR when the server answers 429 (the 429 answers received within THROTTLE_COOLDOWN_SECONDS
+    of a decrease, sent before it, are not counted again). A 429 also pauses all requests for the "retryms" it
+    carries, or for "backoff_seconds" by default.
+
+    The state of the bucket lives in a backend, so that it may be shared by the threads of a process
+    (MemoryRateLimiterBackend), the processes of a host (FileRateLimiterBackend) or several hosts
+    (PostgresRateLimiterBackend), which then share the same allowance.
+
+    Call acquire() (or acquire_async()) before every request, and update() (or update_async()) with its results.
+    """
+
+    CAPACITY = 2  # Maximal burst of requests
+
+    MIN_RATE = 1 / 120
+    MAX_RATE = 20
+
+    RATE_INCREASE_PER_SUCCESS = 0.01
+    RATE_DECREASE_FACTOR = 0.5
+    THROTTLE_COOLDOWN_SECONDS = 10
+
+    def __init__(self, initial_rate: float, backoff_seconds: float = 60, backend=None):
+        self.initial_rate = min(max(initial_rate, self.MIN_RATE), self.MAX_RATE)
+        self.backoff_seconds = backoff_seconds
+        self.backend = backend or MemoryRateLimiterBackend()
+
+        self.sleep_seconds = 0.0  # Time spent waiting by this process
+        self.num_throttled = 0
+
+    def refill(self, state: dict, now: float):
+        state.setdefault('rate', self.initial_rate)
+        state.setdefault('tokens', self.CAPACITY)
+        state.setdefault('updated_at', now)
+        state.setdefault('paused_until', 0)
+        state.setdefault('decreased_at', 0)
+
+        state['tokens'] = min(self.CAPACITY, state['tokens'] + max(now - state['updated_at'], 0) * state['rate'])
+        state['updated_at'] = now
+
+    def try_acquire(self) -> float:
+        """Take a token if one is available and return 0, otherwise return the time to wait for one."""
+        now = time.time()
+
+        with self.backend.locked_state() as state:
+            self.refill(state, now)
+
+            if state['paused_until'] > now:
+                return state['paused_until'] - now
+
+            if state['tokens'] >= 1:
+                state['tokens'] -= 1
+                return 0
+
+            return (1 - state['tokens']) / state['rate']
+
+    def acquire(self):
+        while True:
+            wait_seconds = self.try_acquire()
+            if not wait_seconds:
+                break
+
+            time.sleep(wait_seconds)
+            self.sleep_seconds += wait_seconds
+
+    async def acquire_async(self):
+        """Asyncio counterpart of acquire(), querying the backend (which may block on a lock) in a worker thread."""
+        while True:
+            wait_seconds = await asyncio.to_thread(self.try_acquire)
+            if not wait_seconds:
+                break
+
+            await asyncio.sleep(wait_seconds)
+            self.sleep_seconds += wait_seconds
+
+    def update(self, results: dict):
+        if results.get('status_code') == 429:
+            self.on_throttled(results['retryms'] / 1000 if results.get('retryms') else None)
+        elif not results.get('error'):
+            self.on_success()
+
+    async def update_async(self, results: dict):
+        await asyncio.to_thread(self.update, results)
+
+    def on_success(self):
+        with self.backend.locked_state() as state:
+            self.refill(state, time.time())
+            state['rate'] = min(state['rate'] + self.RATE_INCREASE_PER_SUCCESS, self.MAX_RATE)
+
+    def on_throttled(self, retry_after_seconds: float = None):
+        now = time.time()
+        pause_seconds = retry_after_seconds if retry_after_seconds is not None else self.backoff_seconds
+
+        self.num_throttled += 1
+
+        with self.backend.locked_state() as state:
+            self.refill(state, now)
+
+            if now - state['decreased_at'] > self.THROTTLE_COOLDOWN_SECONDS:
+                state['rate'] = max(state['rate'] * self.RATE_DECREASE_FACTOR, self.MIN_RATE)
+                state['decreased_at'] = now
+
+            state['tokens'] = 0
+            state['paused_until'] = max(state['paused_until'], now + pause_seconds)
+
+            logger.info('Rate limit reached, pausing requests for %g seconds, then sending %.3g requests/second',
+                        pause_seconds, state['rate'])
+
+    def get_rate(self) -> float:
+        with self.backend.locked_state() as state:
+            self.refill(state, time.time())
+            return state['rate']
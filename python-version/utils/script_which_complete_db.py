@@ -6,6 +6,7 @@ from psycopg2.extras import DictCursor
 from env_config import env_config
 from logging_config import configure_logger
 from helpers import StatusFetchShazam
+from duplicate_sounds import DuplicateSounds, save_unless_duplicate
 
 logger = configure_logger()
 RESET_HANDLER_FETCHING_SHAZAM_STARTED_AFTER_NUMBER_OF_HOURS = 3
@@ -95,38 +96,43 @@ def fetch_tiktok_play_urls():
                 # Fetch all rows
                 rows = cursor.fetchall()
 
-                # Download each file and save it to the directory
-                for row in rows:
-                    tiktoksounds_id = row['id']
-                    tiktok_play_url = row['tiktok_play_url']
-                    tiktok_sound_id = row['tiktok_sound_id']
-
-                    try:
-                        # Determine the file name based on the URL and tiktok_sound_id
-                        if tiktok_play_url.endswith('.mp3'):
-                            file_name = f'{tiktok_sound_id}.mp3'
-                        else:
-                            file_extension = os.path.splitext(tiktok_play_url)[1]
-                            file_name = f'{tiktok_sound_id}{file_extension}'
-
-                        file_path = os.path.join(env_config.download_dir, file_name)
-
-                        # Download the file
-                        response = requests.get(tiktok_play_url, timeout=60)
-                        response.raise_for_status()
-
-                        # Save the file to the specified directory
-                        with open(file_path, 'wb') as file:
-                            file.write(response.content)
-
-                        # Print the tiktok_play_url to the terminal
-                        logger.info('Downloaded: %s', tiktok_play_url)
-                        update_tiktok_sound_fetch_shazam_status(
-                            connection, cursor, tiktoksounds_id, StatusFetchShazam.DOWNLOADED)
-                    except Exception as download_error:
-                        logger.error('Error downloading %s: %s', tiktok_play_url, download_error, exc_info=True)
-                        update_tiktok_sound_fetch_shazam_status(
-                            connection, cursor, tiktoksounds_id, StatusFetchShazam.NOT_FETCHED)
+                duplicate_sounds = DuplicateSounds(env_config.duplicate_sounds_path)
+
+                # Files of duplicates are removed as they are downloaded, so save the manifest even if the loop is interrupted
+                try:
+                    # Download each file and save it to the directory
+                    for row in rows:
+                        tiktoksounds_id = row['id']
+                        tiktok_play_url = row['tiktok_play_url']
+                        tiktok_sound_id = row['tiktok_sound_id']
+
+                        try:
+                            # Determine the file name based on the URL and tiktok_sound_id
+                            if tiktok_play_url.endswith('.mp3'):
+                                file_name = f'{tiktok_sound_id}.mp3'
+                            else:
+                                file_extension = os.path.splitext(tiktok_play_url)[1]
+                                file_name = f'{tiktok_sound_id}{file_extension}'
+
+                            file_path = os.path.join(env_config.download_dir, file_name)
+
+                            # Download the file
+                            response = requests.get(tiktok_play_url, timeout=60)
+                            response.raise_for_status()
+
+                            # Save the file to the specified directory, unless it is a copy of another one
+                            save_unless_duplicate(duplicate_sounds, response.content, file_path, tiktok_sound_id)
+
+                            # Print the tiktok_play_url to the terminal
+                            logger.info('Downloaded: %s', tiktok_play_url)
+                            update_tiktok_sound_fetch_shazam_status(
+                                connection, cursor, tiktoksounds_id, StatusFetchShazam.DOWNLOADED)
+                        except Exception as download_error:
+                            logger.error('Error downloading %s: %s', tiktok_play_url, download_error, exc_info=True)
+                            update_tiktok_sound_fetch_shazam_status(
+                                connection, cursor, tiktoksounds_id, StatusFetchShazam.NOT_FETCHED)
+                finally:
+                    duplicate_sounds.save()
 
     except Exception as error:
         logger.error('Error fetching data: %s', error, exc_info=True)